@@ -0,0 +1,424 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# asyncio counterpart of the management cluster client, for checking many
+# clusters concurrently on one event loop rather than a thread per request.
+#
+# Requests are made with aiohttp, which is an optional dependency installed
+# with the "async" extra. The TLS context, credentials, proxies, rate
+# limits, retry policy and circuit breaker of the blocking client are used.
+
+import asyncio
+import collections
+import gzip
+import ssl
+
+from oslo_log import log as logging
+import requests
+
+from magnum_capi_helm import conf
+from magnum_capi_helm import deadline
+from magnum_capi_helm import kubernetes
+from magnum_capi_helm import metrics
+from magnum_capi_helm import serialization
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover
+    aiohttp = None
+
+LOG = logging.getLogger(__name__)
+CONF = conf.CONF
+
+
+class Response:
+    """The parts of a requests.Response used with the Kubernetes API."""
+
+    def __init__(self, url, status_code, reason, headers, content):
+        self.url = url
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return serialization.json_loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(
+                f"{self.status_code} {self.reason} for url: {self.url}",
+                response=self,
+            )
+
+
+class AsyncClient:
+    """asyncio client for the same server as a kubernetes.Client.
+
+    The server, credentials, API discovery and any informer stores of the
+    given client are used. Must be used on a single event loop, ideally as
+    an async context manager so that the connections are closed.
+
+    Raises RuntimeError if aiohttp is not installed.
+    """
+
+    def __init__(self, client, max_connections=None):
+        if aiohttp is None:
+            raise RuntimeError(
+                "The async client requires aiohttp, install "
+                "magnum-capi-helm[async]"
+            )
+        self.sync_client = client
+        self.max_connections = (
+            max_connections or CONF.capi_helm.async_max_connections
+        )
+        self._session = None
+        self._resources = {}
+        self.headers = {
+            "User-Agent": "magnum-capi-helm",
+            "Accept": "application/json",
+            "Accept-Encoding": kubernetes.accept_encoding("get"),
+        }
+        authorization = client.headers.get("Authorization")
+        if authorization:
+            self.headers["Authorization"] = authorization
+        self.proxy = requests.utils.select_proxy(client.server, client.proxies)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self):
+        # Created on first use, as aiohttp needs the running event loop
+        if self._session is None:
+            ssl_context = None
+            if self.sync_client.server.startswith("https://"):
+                ssl_context = self.sync_client.tls_context()
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.max_connections, ssl=ssl_context
+                ),
+                headers=self.headers,
+                # Decompressed here, to record the bytes received
+                auto_decompress=False,
+                trust_env=self.sync_client.trust_env,
+            )
+        return self._session
+
+    async def request(
+        self, method, path, params=None, json=None, headers=None
+    ):
+        url = f"{self.sync_client.server}{path}"
+        data = None
+        request_headers = dict(headers or {})
+        if json is not None:
+            data = serialization.json_dumpb(json)
+            request_headers.setdefault("Content-Type", "application/json")
+        # Shares the circuit breaker, rate limits and retry policy of the
+        # blocking client
+        breaker = self.sync_client.circuit_breaker
+        if breaker is None:
+            return await self._request(
+                method, url, params, request_headers, data
+            )
+        if breaker.state != breaker.CLOSED:
+            # The probe blocks, so is made in a thread
+            await asyncio.get_running_loop().run_in_executor(
+                None, breaker.check, self.sync_client.probe_ready
+            )
+        try:
+            response = await self._request(
+                method, url, params, request_headers, data
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            breaker.record(False)
+            raise
+        breaker.record(
+            response.status_code not in kubernetes.RETRY_IDEMPOTENT_STATUSES
+        )
+        return response
+
+    async def _request(self, method, url, params, request_headers, data):
+        policy = self.sync_client.retry_policy
+        attempt = 0
+        while True:
+            delay = self.sync_client.rate_limit_delay(method)
+            if delay:
+                await asyncio.sleep(delay)
+            # As for the blocking client, the read timeout applies to each
+            # read rather than to the whole response
+            connect_timeout, read_timeout = self.sync_client.request_timeout()
+            try:
+                response = await self._send(
+                    method,
+                    url,
+                    params,
+                    request_headers,
+                    data,
+                    aiohttp.ClientTimeout(
+                        total=None,
+                        sock_connect=connect_timeout,
+                        sock_read=read_timeout,
+                    ),
+                )
+            except (aiohttp.ClientSSLError, ssl.SSLError):
+                raise
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if deadline.passed():
+                    raise deadline.DeadlineExceeded(
+                        f"{method} {url} did not finish before the deadline"
+                    ) from e
+                delay = policy.delay(attempt, method, request_headers)
+                if delay is None:
+                    raise
+                retry_reason = type(e).__name__
+            else:
+                LOG.debug(
+                    'Kubernetes API request: "%s %s" %s',
+                    method,
+                    url,
+                    response.status_code,
+                )
+                delay = policy.delay(
+                    attempt, method, request_headers, response
+                )
+                if delay is None:
+                    return response
+                retry_reason = response.status_code
+            attempt += 1
+            self.sync_client.retry_wait(
+                method, url, retry_reason, attempt, delay
+            )
+            await asyncio.sleep(delay)
+
+    async def _send(self, method, url, params, headers, data, timeout):
+        async with self._get_session().request(
+            method,
+            url,
+            params=params,
+            headers=headers,
+            data=data,
+            timeout=timeout,
+            proxy=self.proxy,
+        ) as response:
+            content = await response.read()
+        metrics.increment("api_response_bytes_received", len(content))
+        if response.headers.get("Content-Encoding", "").lower() == "gzip":
+            content = gzip.decompress(content)
+        metrics.increment("api_response_bytes_decoded", len(content))
+        return Response(
+            str(response.url),
+            response.status,
+            response.reason or "",
+            requests.structures.CaseInsensitiveDict(response.headers),
+            content,
+        )
+
+    async def get(self, path, params=None, headers=None):
+        return await self.request("GET", path, params=params, headers=headers)
+
+    async def patch(self, path, json=None, params=None, headers=None):
+        return await self.request(
+            "PATCH", path, params=params, json=json, headers=headers
+        )
+
+    async def delete(self, path, params=None):
+        return await self.request("DELETE", path, params=params)
+
+    def resource(self, resource_cls):
+        # Shared, so each kind is resolved once for the client
+        if resource_cls not in self._resources:
+            self._resources[resource_cls] = AsyncResource(self, resource_cls)
+        return self._resources[resource_cls]
+
+    async def get_capi_cluster(self, name, namespace):
+        return await self.resource(kubernetes.Cluster).fetch(name, namespace)
+
+    async def get_capi_openstackcluster(self, name, namespace):
+        return await self.resource(kubernetes.OpenstackCluster).fetch(
+            name, namespace
+        )
+
+    async def get_k8s_control_plane(self, name, namespace):
+        return await self.resource(kubernetes.K8sControlPlane).fetch(
+            name, namespace
+        )
+
+    async def get_machine_deployment(self, name, namespace):
+        return await self.resource(kubernetes.MachineDeployment).fetch(
+            name, namespace
+        )
+
+    async def list_all(self, resource_cls, namespace, labels=None):
+        """Returns the objects of a kind, or [] if it is not served."""
+        try:
+            return [
+                obj
+                async for obj in self.resource(
+                    resource_cls
+                ).fetch_all_by_label(labels or {}, namespace)
+            ]
+        except requests.exceptions.HTTPError as e:
+            if e.response.status_code != 404:
+                raise
+            return []
+
+    async def snapshot(self, namespaces, resources=None):
+        """Returns a kubernetes.Snapshot of the resources in the namespaces.
+
+        Every kind is listed in every namespace concurrently.
+        """
+        resources = resources or kubernetes.Snapshot.RESOURCES
+        lists = await asyncio.gather(
+            *(
+                self.list_all(resource_cls, namespace)
+                for resource_cls in resources
+                for namespace in namespaces
+            )
+        )
+        items = collections.defaultdict(list)
+        lists = iter(lists)
+        for resource_cls in resources:
+            for _ in namespaces:
+                items[resource_cls].extend(next(lists))
+        return kubernetes.Snapshot(
+            self.sync_client, namespaces, items=dict(items)
+        )
+
+
+class AsyncResource:
+    """Async counterpart of a kubernetes.Resource, with the same API.
+
+    The api_version, plural name and read consistency of the resource are
+    resolved as for the blocking resource. The resource is created on
+    first use in an executor, as that may block while the API groups are
+    discovered.
+    """
+
+    def __init__(self, client, resource_cls):
+        self.client = client
+        self._resource_cls = resource_cls
+        self._resource = None
+
+    async def _get_resource(self):
+        if self._resource is None:
+            self._resource = asyncio.get_running_loop().run_in_executor(
+                None, self._resource_cls, self.client.sync_client
+            )
+        return await self._resource
+
+    async def fetch(self, name, namespace=None, consistency=None):
+        """Fetches specified object from the target Kubernetes cluster.
+
+        If the object is not found, None is returned.
+        """
+        resource = await self._get_resource()
+        assert resource.namespaced == bool(namespace)
+        assert name is not None
+        consistency = resource._read_consistency(consistency)
+        if resource._is_absent(consistency):
+            return None
+        store = resource._get_store(consistency)
+        if store is not None:
+            return store.get(name, namespace)
+        params = None
+        if consistency == kubernetes.CACHED_READ:
+            params = {"resourceVersion": "0"}
+        response = await self.client.get(
+            resource.prepare_path(name, namespace), params=params
+        )
+        if 200 <= response.status_code < 300:
+            return response.json()
+        elif response.status_code == 404:
+            return None
+        else:
+            response.raise_for_status()
+
+    async def fetch_all_by_label(
+        self, labels, namespace=None, consistency=None
+    ):
+        """Fetches objects matching the labels from the target cluster."""
+        resource = await self._get_resource()
+        assert resource.namespaced == bool(namespace)
+        consistency = resource._read_consistency(consistency)
+        if resource._is_absent(consistency):
+            return
+        store = resource._get_store(consistency)
+        if store is not None:
+            for obj in store.list_by_label(labels, namespace):
+                yield obj
+            return
+        params, continue_params = kubernetes.list_page_params(
+            resource._list_params(labels, consistency)
+        )
+        path = resource.prepare_path(namespace=namespace)
+        while True:
+            response = await self.client.get(
+                path,
+                params=params,
+                headers=kubernetes.encoding_headers("list"),
+            )
+            try:
+                response.raise_for_status()
+            except requests.exceptions.HTTPError as e:
+                resource._list_failed(e)
+                raise
+            data = response.json()
+            for obj in data["items"] or []:
+                yield obj
+            continue_token = data["metadata"].get("continue")
+            if not continue_token:
+                break
+            params = {**continue_params, "continue": continue_token}
+
+    async def apply(self, name, data=None, namespace=None):
+        """Applies the given object to the target Kubernetes cluster."""
+        resource = await self._get_resource()
+        assert resource.namespaced == bool(namespace)
+        response = await self.client.patch(
+            resource.prepare_path(name, namespace),
+            json=resource._apply_body(name, data, namespace),
+            headers=dict(resource.APPLY_HEADERS),
+            params=dict(resource.APPLY_PARAMS),
+        )
+        response.raise_for_status()
+        return response.json()
+
+    async def delete(self, name, namespace=None):
+        """Deletes the specified object from the target cluster.
+
+        Objects that do not exist are ignored.
+        """
+        resource = await self._get_resource()
+        assert resource.namespaced == bool(namespace)
+        response = await self.client.delete(
+            resource.prepare_path(name, namespace)
+        )
+        if response.status_code != 404:
+            response.raise_for_status()
+
+    async def delete_all_by_label(self, label, value, namespace=None):
+        """Deletes all objects with the specified label from cluster."""
+        resource = await self._get_resource()
+        assert resource.namespaced == bool(namespace)
+        response = await self.client.delete(
+            resource.prepare_path(namespace=namespace),
+            params={"labelSelector": f"{label}={value}"},
+        )
+        response.raise_for_status()
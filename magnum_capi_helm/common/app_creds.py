@@ -17,7 +17,6 @@
 # https://github.com/vexxhost/magnum-cluster-api/blob/main/magnum_cluster_api/resources.py
 
 import secrets
-import yaml
 
 import certifi
 import keystoneauth1
@@ -28,6 +27,8 @@ from magnum.common import context as ctx
 from magnum.common import utils
 import magnum.conf
 
+from magnum_capi_helm import serialization
+
 CONF = magnum.conf.CONF
 LOG = logging.getLogger(__name__)
 
@@ -112,7 +113,7 @@ def get_app_cred_string_data(context, app_cred):
     clouds_dict = _get_app_cred_clouds_dict(context, app_cred)
     return {
         "cacert": _get_openstack_ca_certificate(),
-        "clouds.yaml": yaml.safe_dump(clouds_dict),
+        "clouds.yaml": serialization.yaml_dump(clouds_dict),
     }
 
 
@@ -124,8 +125,9 @@ def delete_app_cred(cluster, app_cred_id):
     kst = osc.keystone()
 
     LOG.debug(
-        f"Deleting application credential with ID {app_cred_id} "
-        f"for cluster {cluster.uuid}"
+        "Deleting application credential with ID %s for cluster %s",
+        app_cred_id,
+        cluster.uuid,
     )
 
     if hasattr(kst.client.application_credentials, "get"):
@@ -10,12 +10,22 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+import asyncio
+
 from magnum.conductor import monitors
 from magnum.i18n import _
 from magnum.objects import fields as m_fields
+from oslo_log import log as logging
+
+from magnum_capi_helm import conf
+from magnum_capi_helm import db_snapshot
+from magnum_capi_helm import deadline
 from magnum_capi_helm import driver_utils
 from magnum_capi_helm import kubernetes
+from magnum_capi_helm import status_watcher
 
+LOG = logging.getLogger(__name__)
+CONF = conf.CONF
 
 MONITOR_STATE_READY = _("Ready")
 
@@ -31,9 +41,15 @@ class CAPIMonitor(monitors.MonitorBase):
     @property
     def _k8s_client(self):
         if not self.__k8s_client:
-            self.__k8s_client = kubernetes.Client.load()
+            self.__k8s_client = kubernetes.Client.shared()
         return self.__k8s_client
 
+    def __del__(self):
+        # Give back our reference to the shared client
+        k8s_client = getattr(self, "_CAPIMonitor__k8s_client", None)
+        if k8s_client:
+            k8s_client.release()
+
     @property
     def metrics_spec(self):
         # TODO(dalees): Not yet implemented for CAPI helm driver
@@ -81,33 +97,124 @@ class CAPIMonitor(monitors.MonitorBase):
         The class variable data is updated with current status and reason.
 
         """
+        # Changes are reported by the status watcher, when enabled
+        watcher = status_watcher.get_watcher()
+        if watcher and not watcher.should_poll(self.cluster, "health"):
+            return
+
+        with db_snapshot.scope(self.cluster), kubernetes.read_consistency(
+            CONF.capi_helm.status_read_consistency
+        ):
+            try:
+                reason = {
+                    "cluster": self._poll_cluster(),
+                    "infrastructure": self._poll_infra(),
+                    "controlplane": self._poll_controlplane(),
+                    "nodegroup": self._poll_nodegroups(),
+                }
+            except kubernetes.CircuitOpen:
+                self._skip_unavailable()
+                return
+            self._set_health_status(reason)
+
+    async def poll_health_status_async(self, async_client):
+        """Async variant of poll_health_status.
+
+        The Cluster API resources for the cluster are fetched concurrently
+        using the given async_kubernetes.AsyncClient.
+        """
+        watcher = status_watcher.get_watcher()
+        if watcher and not watcher.should_poll(self.cluster, "health"):
+            return
+
+        namespace = driver_utils.cluster_namespace(self.cluster)
+        with db_snapshot.scope(self.cluster), kubernetes.read_consistency(
+            CONF.capi_helm.status_read_consistency
+        ):
+            # Loaded from the database in a thread, with the snapshot and
+            # deadline of this task
+            nodegroups = await asyncio.get_running_loop().run_in_executor(
+                None, deadline.propagate(self._worker_nodegroups)
+            )
+            try:
+                resources = await asyncio.gather(
+                    async_client.get_capi_cluster(
+                        self._resource_name(None), namespace
+                    ),
+                    async_client.get_capi_openstackcluster(
+                        self._resource_name(None), namespace
+                    ),
+                    async_client.get_k8s_control_plane(
+                        self._resource_name("control-plane"), namespace
+                    ),
+                    *(
+                        async_client.get_machine_deployment(
+                            self._resource_name(nodegroup.name), namespace
+                        )
+                        for nodegroup in nodegroups
+                    ),
+                )
+            except kubernetes.CircuitOpen:
+                self._skip_unavailable()
+                return
+            self._set_health_status(
+                {
+                    "cluster": self._cluster_reason(resources[0]),
+                    "infrastructure": self._infra_reason(resources[1]),
+                    "controlplane": self._controlplane_reason(resources[2]),
+                    "nodegroup": self._nodegroups_reason(
+                        zip(nodegroups, resources[3:])
+                    ),
+                }
+            )
+
+    def _skip_unavailable(self):
+        # The management cluster being unreachable says nothing about the
+        # health of the cluster, so leave the health status as it is
+        LOG.debug(
+            "Skipping health poll for cluster %s, management cluster is "
+            "unavailable",
+            self.cluster.uuid,
+        )
+
+    def _set_health_status(self, reason):
         # Start with a good state for everything
         status = m_fields.ClusterHealthStatus.HEALTHY
-        reason = {}
-
-        for monitor_type, monitor_func in [
-            ("cluster", self._poll_cluster),
-            ("infrastructure", self._poll_infra),
-            ("controlplane", self._poll_controlplane),
-            ("nodegroup", self._poll_nodegroups),
-        ]:
-            reason[monitor_type] = monitor_func()
+        for monitor_type in (
+            "cluster",
+            "infrastructure",
+            "controlplane",
+            "nodegroup",
+        ):
             if reason[monitor_type] != MONITOR_STATE_READY:
                 status = m_fields.ClusterHealthStatus.UNHEALTHY
 
         self.data["health_status"] = status
         self.data["health_status_reason"] = reason
 
+    def _resource_name(self, suffix):
+        return driver_utils.get_k8s_resource_name(self.cluster, suffix)
+
+    def _worker_nodegroups(self):
+        return [
+            nodegroup
+            for nodegroup in db_snapshot.get(self.cluster).nodegroups
+            if nodegroup.role != "master"
+        ]
+
     def _poll_cluster(self):
         """Get status from Cluster.
 
         This has most status info available as it bubbles up.
         """
         namespace = driver_utils.cluster_namespace(self.cluster)
-        resource_name = driver_utils.get_k8s_resource_name(self.cluster, None)
-        resource_cluster = self._k8s_client.get_capi_cluster(
-            resource_name, namespace
+        return self._cluster_reason(
+            self._k8s_client.get_capi_cluster(
+                self._resource_name(None), namespace
+            )
         )
+
+    def _cluster_reason(self, resource_cluster):
         if not resource_cluster:
             return "Cluster resource not found."
 
@@ -127,10 +234,13 @@ class CAPIMonitor(monitors.MonitorBase):
         This represents the CAPO Infrastructure component.
         """
         namespace = driver_utils.cluster_namespace(self.cluster)
-        resource_name = driver_utils.get_k8s_resource_name(self.cluster, None)
-        resource_capo = self._k8s_client.get_capi_openstackcluster(
-            resource_name, namespace
+        return self._infra_reason(
+            self._k8s_client.get_capi_openstackcluster(
+                self._resource_name(None), namespace
+            )
         )
+
+    def _infra_reason(self, resource_capo):
         if not resource_capo:
             return "Infrastructure resource not found."
 
@@ -153,12 +263,13 @@ class CAPIMonitor(monitors.MonitorBase):
         This CAPI controller manages the control plane machines
         """
         namespace = driver_utils.cluster_namespace(self.cluster)
-        resource_name = driver_utils.get_k8s_resource_name(
-            self.cluster, "control-plane"
-        )
-        resource_kcp = self._k8s_client.get_k8s_control_plane(
-            resource_name, namespace
+        return self._controlplane_reason(
+            self._k8s_client.get_k8s_control_plane(
+                self._resource_name("control-plane"), namespace
+            )
         )
+
+    def _controlplane_reason(self, resource_kcp):
         if not resource_kcp:
             return "Control plane resource not found."
 
@@ -179,17 +290,19 @@ class CAPIMonitor(monitors.MonitorBase):
         information on machineset and machine resources)
         """
         namespace = driver_utils.cluster_namespace(self.cluster)
-        nodegroup_reasons = []
-        for nodegroup in self.cluster.nodegroups:
-            if nodegroup.role == "master":
-                continue
-            resource_name = driver_utils.get_k8s_resource_name(
-                self.cluster, nodegroup.name
-            )
-            resource_md = self._k8s_client.get_machine_deployment(
-                resource_name, namespace
+        return self._nodegroups_reason(
+            (
+                nodegroup,
+                self._k8s_client.get_machine_deployment(
+                    self._resource_name(nodegroup.name), namespace
+                ),
             )
+            for nodegroup in self._worker_nodegroups()
+        )
 
+    def _nodegroups_reason(self, nodegroup_resources):
+        nodegroup_reasons = []
+        for nodegroup, resource_md in nodegroup_resources:
             if not resource_md:
                 nodegroup_reasons.append(
                     f"{nodegroup.name} resource not found."
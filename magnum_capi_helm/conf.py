@@ -11,6 +11,7 @@
 # limitations under the License.
 
 from oslo_config import cfg
+from oslo_config import types
 
 capi_helm_group = cfg.OptGroup(
     name="capi_helm", title="Helm Cluster API Driver configuration"
@@ -56,6 +57,25 @@ capi_helm_opts = [
             "by the config: capi_driver.helm_chart_repo"
         ),
     ),
+    cfg.StrOpt(
+        "helm_chart_cache_dir",
+        default="",
+        help=(
+            "Directory in which to cache downloaded helm charts, so each "
+            "chart version is only fetched from the chart repository "
+            "once. Defaults to no caching, in which case helm fetches the "
+            "chart from the repository for every operation."
+        ),
+    ),
+    cfg.IntOpt(
+        "helm_chart_cache_size",
+        default=512,
+        min=1,
+        help=(
+            "Maximum size in MiB of the helm chart cache. The least "
+            "recently used charts are removed when it is exceeded."
+        ),
+    ),
     cfg.StrOpt(
         "default_helm_chart_version",
         default="0.10.1",
@@ -66,6 +86,27 @@ capi_helm_opts = [
             "A cluster label can override this."
         ),
     ),
+    cfg.StrOpt(
+        "deploy_mode",
+        default="helm",
+        choices=["helm", "apply"],
+        help=(
+            "How the resources for a cluster are deployed. 'helm' installs "
+            "or upgrades a helm release. 'apply' renders the chart with "
+            "'helm template' and applies the resources directly with "
+            "server-side apply, pruning resources that are no longer "
+            "rendered, without storing a helm release."
+        ),
+    ),
+    cfg.IntOpt(
+        "apply_concurrency",
+        default=8,
+        min=1,
+        help=(
+            "Maximum number of resources applied concurrently when "
+            "deploy_mode is 'apply'."
+        ),
+    ),
     cfg.IntOpt(
         "minimum_flavor_ram",
         default=2048,
@@ -103,7 +144,8 @@ capi_helm_opts = [
             """
 
             Dictionary of cluster api resources to modify api_version
-            and plural names in string format.
+            and plural names in string format. An api_version given here
+            is used instead of the version found by API discovery.
 
 
             Example::
@@ -122,6 +164,17 @@ capi_helm_opts = [
             """
         ),
     ),
+    cfg.BoolOpt(
+        "skip_unchanged_helm_upgrades",
+        default=False,
+        help=(
+            "Skip the helm upgrade for a cluster when the chart, the "
+            "values and the deploy mode are unchanged since the last "
+            "upgrade, and that upgrade completed. Cluster updates and "
+            "upgrades always run the upgrade, so that a release that was "
+            "rolled back or changed by hand is reconciled."
+        ),
+    ),
     cfg.ListOpt(
         "k8s_control_plane_resource_conditions",
         default=[
@@ -135,6 +188,303 @@ capi_helm_opts = [
             "resource to consider as ready."
         ),
     ),
+    cfg.ListOpt(
+        "informer_resources",
+        default=[],
+        help=(
+            "List of Cluster API resource kinds to keep in an in-memory "
+            "cache, maintained using a list and watch against the "
+            "management cluster. Reads of these resources are served "
+            "from the cache once it is synced, falling back to direct "
+            "requests otherwise. Supported kinds are Cluster, "
+            "OpenstackCluster, K8sControlPlane, MachineDeployment, "
+            "Machine, Manifests, HelmRelease and HelmChartProxy. "
+            "Defaults to no caching."
+        ),
+    ),
+    cfg.IntOpt(
+        "informer_watch_timeout",
+        default=300,
+        min=1,
+        help=(
+            "Number of seconds each informer watch request stays open "
+            "before it is re-established from the last seen "
+            "resourceVersion."
+        ),
+    ),
+    cfg.IntOpt(
+        "api_discovery_ttl",
+        default=300,
+        min=0,
+        help=(
+            "Seconds to cache the API groups and versions served by the "
+            "management cluster. Discovery is used to pick a served version "
+            "of each Cluster API kind when the built in version is not "
+            "served, and to skip requests for kinds whose CRDs are not "
+            "installed. Set to 0 to disable discovery and use the "
+            "api_resources or built in versions."
+        ),
+    ),
+    cfg.FloatOpt(
+        "api_read_qps",
+        default=50.0,
+        min=0,
+        help=(
+            "Maximum sustained rate of read requests (GET) per second to the "
+            "management cluster from each conductor process, to avoid "
+            "overloading the API server. Set to 0 for no limit."
+        ),
+    ),
+    cfg.IntOpt(
+        "api_read_burst",
+        default=100,
+        min=1,
+        help=(
+            "Number of read requests to the management cluster that may be "
+            "made at once before api_read_qps applies."
+        ),
+    ),
+    cfg.FloatOpt(
+        "api_write_qps",
+        default=20.0,
+        min=0,
+        help=(
+            "Maximum sustained rate of write requests per second to the "
+            "management cluster from each conductor process. Set to 0 for "
+            "no limit."
+        ),
+    ),
+    cfg.IntOpt(
+        "api_write_burst",
+        default=40,
+        min=1,
+        help=(
+            "Number of write requests to the management cluster that may be "
+            "made at once before api_write_qps applies."
+        ),
+    ),
+    cfg.FloatOpt(
+        "api_connect_timeout",
+        default=10.0,
+        min=1,
+        help=(
+            "Seconds to wait for a connection to the management cluster "
+            "API server to be established."
+        ),
+    ),
+    cfg.FloatOpt(
+        "api_read_timeout",
+        default=60.0,
+        min=1,
+        help=(
+            "Seconds to wait for the management cluster API server to send "
+            "data on an open connection before the request fails."
+        ),
+    ),
+    cfg.IntOpt(
+        "status_update_timeout",
+        default=60,
+        min=0,
+        help=(
+            "Deadline in seconds for updating the status of one cluster. "
+            "Requests to the management cluster that would overrun it fail, "
+            "and the status is left unchanged until the next poll. Set to 0 "
+            "for no deadline."
+        ),
+    ),
+    cfg.IntOpt(
+        "operation_timeout",
+        default=600,
+        min=0,
+        help=(
+            "Deadline in seconds for driver operations that change a "
+            "cluster, such as create, update, resize and delete, covering "
+            "both requests to the management cluster and helm commands. Set "
+            "to 0 for no deadline."
+        ),
+    ),
+    cfg.IntOpt(
+        "helm_timeout",
+        default=300,
+        min=1,
+        help=(
+            "Seconds helm waits for individual Kubernetes operations, such "
+            "as hooks, during an upgrade or uninstall. Limited to the time "
+            "remaining before the operation deadline."
+        ),
+    ),
+    cfg.IntOpt(
+        "api_max_retries",
+        default=3,
+        min=0,
+        help=(
+            "Number of times a request to the management cluster is retried "
+            "when the API server is throttling requests (429) or temporarily "
+            "unavailable (502, 503, 504), or the connection fails. Requests "
+            "that are not idempotent are only retried after a 429. Set to 0 "
+            "to disable retries."
+        ),
+    ),
+    cfg.FloatOpt(
+        "api_retry_backoff",
+        default=0.5,
+        min=0,
+        help=(
+            "Base delay in seconds before retrying a request to the "
+            "management cluster. The delay is doubled for each retry, and "
+            "a random delay up to that value is used, unless the API server "
+            "gives a Retry-After."
+        ),
+    ),
+    cfg.FloatOpt(
+        "api_retry_max_backoff",
+        default=30.0,
+        min=0,
+        help=(
+            "Maximum delay in seconds before retrying a request to the "
+            "management cluster, including delays given by Retry-After."
+        ),
+    ),
+    cfg.IntOpt(
+        "api_circuit_failure_threshold",
+        default=5,
+        min=0,
+        help=(
+            "Number of consecutive failed requests to the management cluster, "
+            "after retries, before further requests fail immediately rather "
+            "than each waiting for its own failure. While requests are "
+            "failing, cluster status and health are left unchanged. Set to 0 "
+            "to disable."
+        ),
+    ),
+    cfg.IntOpt(
+        "api_circuit_reset_timeout",
+        default=30,
+        min=1,
+        help=(
+            "Seconds to fail requests to the management cluster for, after "
+            "api_circuit_failure_threshold failures, before checking whether "
+            "the API server is ready again using /readyz."
+        ),
+    ),
+    cfg.IntOpt(
+        "api_pool_maxsize",
+        default=64,
+        min=1,
+        help=(
+            "Number of keep-alive connections to the management cluster kept "
+            "by each conductor process. This should be at least the number "
+            "of threads making requests at once, such as the conductor "
+            "workers, otherwise connections are closed and reopened."
+        ),
+    ),
+    cfg.BoolOpt(
+        "api_pool_block",
+        default=False,
+        help=(
+            "Whether to wait for a connection to the management cluster to "
+            "become free when api_pool_maxsize connections are in use, "
+            "rather than opening another connection that is closed after "
+            "use. Waits are limited to api_connect_timeout."
+        ),
+    ),
+    cfg.IntOpt(
+        "api_pool_idle_timeout",
+        default=60,
+        min=0,
+        help=(
+            "Seconds a keep-alive connection to the management cluster can "
+            "be idle before it is closed rather than reused. This should be "
+            "less than the idle timeout of any load balancer in front of "
+            "the API server. Set to 0 to reuse connections however long "
+            "they have been idle."
+        ),
+    ),
+    cfg.BoolOpt(
+        "api_coalesce_reads",
+        default=True,
+        help=(
+            "Whether threads fetching the same object from the management "
+            "cluster at the same time share a single request and its "
+            "result. The number of requests saved is recorded in the "
+            "api_requests_collapsed metric."
+        ),
+    ),
+    cfg.ListOpt(
+        "api_compression_verbs",
+        item_type=types.String(choices=["get", "list", "watch"]),
+        default=["get", "list"],
+        help=(
+            "Kubernetes verbs for which gzip compressed responses are "
+            "requested from the management cluster. The API server only "
+            "compresses large responses, so this mostly saves bandwidth "
+            "for lists, at the cost of CPU time to decompress them. The "
+            "bytes received and decoded are recorded in the "
+            "api_response_bytes_received and api_response_bytes_decoded "
+            "metrics."
+        ),
+    ),
+    cfg.IntOpt(
+        "async_max_connections",
+        default=50,
+        min=1,
+        help=(
+            "Maximum number of connections to the management cluster opened "
+            "by the async client, which limits the number of concurrent "
+            "requests made by the async status and health checks."
+        ),
+    ),
+    cfg.StrOpt(
+        "status_read_consistency",
+        default="cached",
+        choices=[
+            (
+                "cached",
+                "Read from the API server watch cache, which may be "
+                "slightly stale but does not load etcd.",
+            ),
+            ("consistent", "Read from etcd through the API server."),
+        ],
+        help=(
+            "Read consistency for the Cluster API objects read by cluster "
+            "status updates and health monitoring. Decisions to clean up "
+            "deleted clusters and node groups always use consistent reads."
+        ),
+    ),
+    cfg.IntOpt(
+        "list_page_size",
+        default=500,
+        min=0,
+        help=(
+            "Maximum number of objects requested in each page when listing "
+            "objects in the management cluster. Pages are decoded as they "
+            "are received, so smaller pages reduce memory use for large "
+            "lists. Set to 0 to request all the objects at once."
+        ),
+    ),
+    cfg.BoolOpt(
+        "status_watch_enabled",
+        default=False,
+        help=(
+            "Watch the Cluster API clusters, control planes, machine "
+            "deployments and addons in the management cluster, and update "
+            "the status and health of a Magnum cluster as soon as any of "
+            "its objects change. The periodic status and health polls "
+            "remain as a safety net, see status_poll_interval."
+        ),
+    ),
+    cfg.IntOpt(
+        "status_poll_interval",
+        default=600,
+        min=0,
+        help=(
+            "When status_watch_enabled is set, the minimum number of "
+            "seconds between periodic status or health polls of a cluster. "
+            "Polls within this interval of the last check of the cluster "
+            "are skipped while the watches are synced, unless the cluster "
+            "or one of its node groups is in progress."
+        ),
+    ),
 ]
 
 capi_helm_cluster_labels_group = cfg.OptGroup(
@@ -0,0 +1,125 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# Operation scoped snapshots of the Magnum DB objects for a cluster.
+
+import contextlib
+import contextvars
+
+from magnum_capi_helm import metrics
+
+NODE_GROUP_ROLE_CONTROLLER = "master"
+
+# Snapshots in use by cluster object id, for the current thread or
+# asyncio task. Replaced rather than modified, so that tasks started within
+# a scope do not share changes.
+_snapshots = contextvars.ContextVar("db_snapshots", default={})
+
+
+class DBSnapshot:
+    """The node groups and template of a cluster, loaded once.
+
+    The cluster nodegroups and default_ng_worker properties query the
+    database on every access, so an operation that reads them repeatedly
+    uses a snapshot instead. The snapshot holds the same node group
+    objects for the whole operation, so changes made to them are seen.
+    Call refresh, or use save and destroy, when node groups are added or
+    removed during the operation.
+    """
+
+    def __init__(self, cluster):
+        self.cluster = cluster
+        self._nodegroups = None
+
+    @property
+    def nodegroups(self):
+        if self._nodegroups is None:
+            self._nodegroups = list(self.cluster.nodegroups)
+        else:
+            # Each of the properties below would otherwise query too
+            metrics.increment("db_queries_saved")
+        return self._nodegroups
+
+    @property
+    def default_ng_worker(self):
+        # Matches Cluster.default_ng_worker, without a separate query
+        return [
+            ng
+            for ng in self.nodegroups
+            if ng.is_default and ng.role != NODE_GROUP_ROLE_CONTROLLER
+        ][0]
+
+    @property
+    def master_count(self):
+        return sum(
+            ng.node_count
+            for ng in self.nodegroups
+            if ng.role == NODE_GROUP_ROLE_CONTROLLER
+        )
+
+    @property
+    def cluster_template(self):
+        # Lazy loaded once by the cluster object itself
+        return self.cluster.cluster_template
+
+    def refresh(self):
+        """Reload the node groups on next access."""
+        self._nodegroups = None
+
+    def _holds(self, obj):
+        return obj is self.cluster or any(
+            obj is ng for ng in self._nodegroups or []
+        )
+
+    def save(self, obj):
+        """Save an object, refreshing the snapshot if needed."""
+        obj.save()
+        if not self._holds(obj):
+            self.refresh()
+
+    def destroy(self, obj):
+        """Destroy an object, refreshing the snapshot."""
+        obj.destroy()
+        self.refresh()
+
+
+def get(cluster):
+    """Returns the snapshot in use for the cluster.
+
+    Outside of an operation, a new snapshot is returned so that the
+    objects are loaded from the database as usual.
+    """
+    snapshot = _snapshots.get().get(id(cluster))
+    if snapshot is not None and snapshot.cluster is cluster:
+        return snapshot
+    return DBSnapshot(cluster)
+
+
+@contextlib.contextmanager
+def scope(cluster):
+    """Use one snapshot for the cluster in the current context.
+
+    The snapshot is used in the current thread, or asyncio task and the
+    tasks it starts. Nested scopes for the same cluster share the outer
+    snapshot.
+    """
+    snapshots = _snapshots.get()
+    snapshot = snapshots.get(id(cluster))
+    if snapshot is not None and snapshot.cluster is cluster:
+        yield snapshot
+        return
+    snapshot = DBSnapshot(cluster)
+    token = _snapshots.set({**snapshots, id(cluster): snapshot})
+    try:
+        yield snapshot
+    finally:
+        _snapshots.reset(token)
@@ -0,0 +1,94 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# Deadlines for driver operations.
+#
+# A driver entry point sets a deadline for the current context, and the
+# Kubernetes and Helm clients limit their timeouts to the time remaining,
+# so that one slow request cannot make the operation overrun.
+
+import contextlib
+import contextvars
+import functools
+import time
+
+# The monotonic time of the deadline for the current thread or asyncio task,
+# or None if unbound
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    """The deadline for the current operation has passed."""
+
+
+@contextlib.contextmanager
+def scope(seconds):
+    """Bound the operations in the current context to the given seconds.
+
+    The deadline applies in the current thread, or asyncio task and the
+    tasks it starts. A nested scope cannot extend the deadline of an outer
+    scope. If seconds is None or 0, only the deadline of any outer scope
+    applies.
+    """
+    previous = _deadline.get()
+    deadline = time.monotonic() + seconds if seconds else None
+    if previous is not None and (deadline is None or previous < deadline):
+        deadline = previous
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining():
+    """Returns the seconds left before the deadline, or None if unbound."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def passed():
+    """Returns True if the deadline has passed."""
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def timeout(default):
+    """Returns the default timeout, limited to the time remaining.
+
+    Raises DeadlineExceeded if the deadline has already passed.
+    """
+    left = remaining()
+    if left is None:
+        return default
+    if left <= 0:
+        raise DeadlineExceeded("Operation deadline exceeded")
+    return left if default is None else min(default, left)
+
+
+def propagate(func):
+    """Wraps func to run in a copy of the current context.
+
+    Used for functions submitted to an executor, which otherwise run
+    without the deadline, or any other context variables such as the DB
+    snapshots. Each call gets its own copy, so the wrapper can be called
+    concurrently.
+    """
+    context = contextvars.copy_context()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return context.copy().run(func, *args, **kwargs)
+
+    return wrapper
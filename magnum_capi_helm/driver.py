@@ -9,30 +9,44 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import asyncio
+import contextlib
 import enum
+import functools
 import re
+import threading
 
 import requests
 import yaml
 
 from magnum.api import utils as api_utils
 from magnum.common import clients
+from magnum.common import context as magnum_context
 from magnum.common import exception
 from magnum.common import neutron
 from magnum.common import short_id
 from magnum.drivers.common import driver
+from magnum import objects
 from magnum.objects import fields
+from oslo_config import cfg
 from oslo_log import log as logging
 from oslo_utils import strutils
 from oslo_utils import uuidutils
 
+from magnum_capi_helm import async_kubernetes
 from magnum_capi_helm.common import app_creds
 from magnum_capi_helm.common import ca_certificates
 from magnum_capi_helm.common import capi_monitor
 from magnum_capi_helm import conf
+from magnum_capi_helm import db_snapshot
+from magnum_capi_helm import deadline
 from magnum_capi_helm import driver_utils
 from magnum_capi_helm import helm
 from magnum_capi_helm import kubernetes
+from magnum_capi_helm import metrics
+from magnum_capi_helm import release
+from magnum_capi_helm import serialization
+from magnum_capi_helm import status_watcher
 
 LOG = logging.getLogger(__name__)
 CONF = conf.CONF
@@ -53,6 +67,131 @@ def _gather_label_names():
 _REGISTERED_LABEL_NAMES = _gather_label_names()
 
 
+def _gather_label_types():
+    label_types = {}
+    for opt in conf.capi_helm_cluster_labels_opts:
+        label_types[opt.name] = type(opt)
+        for dep_opt in opt.deprecated_opts:
+            label_types[dep_opt.name] = type(opt)
+    return label_types
+
+
+_LABEL_TYPES = _gather_label_types()
+
+
+def _sanitize_label(value):
+    # NOTE(johngarbutt): filtering untrusted user input
+    return re.sub(r"[^a-zA-Z0-9\.\-\/ _]+", "", value)
+
+
+def _label_to_bool(value):
+    # None means the label is unset or not a boolean
+    return strutils.bool_from_string(value, default=None)
+
+
+def _label_to_int(value):
+    # None means the label is unset or not an integer
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def _label_to_csv(raw):
+    if not raw:
+        return []
+    return [
+        re.sub(r"[^a-zA-Z0-9\.\-\/\:]+", "", entry.strip())
+        for entry in str(raw).split(",")
+        if entry.strip()
+    ]
+
+
+def _operation_deadline(func):
+    """Runs a driver operation within [capi_helm]/operation_timeout."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with deadline.scope(CONF.capi_helm.operation_timeout):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+class ClusterLabels:
+    """The labels of a cluster, merged with those of its template.
+
+    The labels are merged and sanitised once, and labels with a boolean or
+    integer option in capi_helm_cluster_labels are converted up front, so
+    that the many lookups made during an operation are cheap. Changes to
+    the cluster labels after this is created are not seen.
+    """
+
+    def __init__(self, cluster):
+        self.cluster = cluster
+        all_labels = helm.mergeconcat(
+            cluster.cluster_template.labels, cluster.labels
+        )
+        self._empty = not all_labels
+        self._raw = {}
+        self._values = {}
+        self._converted = {}
+        self._csv = {}
+        for key, raw in (all_labels or {}).items():
+            if key not in _REGISTERED_LABEL_NAMES:
+                continue
+            self._raw[key] = raw
+            self._values[key] = _sanitize_label(raw)
+            opt_type = _LABEL_TYPES[key]
+            if opt_type is cfg.BoolOpt:
+                self._convert(key, _label_to_bool)
+            elif opt_type is cfg.IntOpt:
+                self._convert(key, _label_to_int)
+
+    def _check(self, key):
+        if key not in _REGISTERED_LABEL_NAMES:
+            raise ValueError(
+                f"Cluster label '{key}' is not registered in "
+                "capi_helm_cluster_labels. Add it to conf.py first."
+            )
+
+    def _convert(self, key, converter):
+        try:
+            return self._converted[key, converter]
+        except KeyError:
+            value = converter(self._values.get(key, ""))
+            self._converted[key, converter] = value
+            return value
+
+    def get(self, key, default):
+        self._check(key)
+        if self._empty:
+            return default
+        if key in self._values:
+            return self._values[key]
+        return _sanitize_label(default) if default else default
+
+    def get_bool(self, key, default):
+        self._check(key)
+        value = self._convert(key, _label_to_bool)
+        return default if value is None else value
+
+    def get_int(self, key, default):
+        self._check(key)
+        value = self._convert(key, _label_to_int)
+        return default if value is None else value
+
+    def get_csv(self, key, default):
+        self._check(key)
+        if not self._raw.get(key):
+            return _label_to_csv(default)
+        if key not in self._csv:
+            self._csv[key] = _label_to_csv(self._raw[key])
+        return list(self._csv[key])
+
+
 class NodeGroupState(enum.Enum):
     NOT_PRESENT = 1
     PENDING = 2
@@ -60,17 +199,81 @@ class NodeGroupState(enum.Enum):
     FAILED = 4
 
 
+# Whether the chart cache prewarm has been started in this process
+_chart_cache_prewarm_started = False
+_chart_cache_prewarm_lock = threading.Lock()
+
+
 class Driver(driver.Driver):
     def __init__(self):
         self._helm_client = helm.Client()
         self.__k8s_client = None
+        # Per-thread override of the kubernetes client, see _use_k8s_client
+        self._local = threading.local()
+        if self._helm_client.chart_cache:
+            self._start_chart_cache_prewarm()
+
+    def _start_chart_cache_prewarm(self):
+        # Once per process, in the background so that the first operation
+        # does not wait for the charts to be pulled
+        global _chart_cache_prewarm_started
+        with _chart_cache_prewarm_lock:
+            if _chart_cache_prewarm_started:
+                return
+            _chart_cache_prewarm_started = True
+        threading.Thread(
+            target=self._prewarm_chart_cache_background,
+            name="capi-chart-cache-prewarm",
+            daemon=True,
+        ).start()
+
+    def _prewarm_chart_cache_background(self):
+        try:
+            self.prewarm_chart_cache(
+                magnum_context.make_admin_context(all_tenants=True)
+            )
+        except Exception:
+            LOG.exception("Failed to prewarm the helm chart cache")
 
     @property
     def _k8s_client(self):
+        k8s_client = getattr(self._local, "k8s_client", None)
+        if k8s_client:
+            return k8s_client
         if not self.__k8s_client:
-            self.__k8s_client = kubernetes.Client.load()
+            self.__k8s_client = kubernetes.Client.shared()
         return self.__k8s_client
 
+    def __del__(self):
+        # Give back our reference to the shared client
+        k8s_client = getattr(self, "_Driver__k8s_client", None)
+        if k8s_client:
+            k8s_client.release()
+
+    def _get_release_client(self, cluster):
+        # Client used to install, upgrade and uninstall cluster releases.
+        # Either can uninstall releases deployed by the other, so clusters
+        # are still deleted after the deploy mode is changed.
+        if CONF.capi_helm.deploy_mode == "apply":
+            release_cls = release.ApplyClient
+        else:
+            release_cls = release.HelmClient
+        return release_cls(
+            self._helm_client,
+            self._k8s_client,
+            labels=self._k8s_resource_labels(cluster),
+        )
+
+    @contextlib.contextmanager
+    def _use_k8s_client(self, k8s_client):
+        """Use the given kubernetes client in the current thread."""
+        previous = getattr(self._local, "k8s_client", None)
+        self._local.k8s_client = k8s_client
+        try:
+            yield
+        finally:
+            self._local.k8s_client = previous
+
     @property
     def provides(self):
         return [
@@ -162,9 +365,10 @@ class Driver(driver.Driver):
             and self._nodegroup_machines_exist(cluster, nodegroup)
         ):
             LOG.debug(
-                f"Node group {nodegroup.name} "
-                f"for cluster {cluster.uuid} "
-                "machine deployment gone, but machines still found."
+                "Node group %s for cluster %s machine deployment gone, "
+                "but machines still found.",
+                nodegroup.name,
+                cluster.uuid,
             )
             ng_state = NodeGroupState.PENDING
 
@@ -186,18 +390,21 @@ class Driver(driver.Driver):
                     # Conductor will delete default nodegroups
                     # when cluster is deleted, but non default
                     # node groups should be deleted here.
-                    nodegroup.destroy()
+                    db_snapshot.get(cluster).destroy(nodegroup)
                 LOG.debug(
-                    f"Node group deleted: {nodegroup.name} "
-                    f"for cluster {cluster.uuid} "
-                    f"which is_default: {nodegroup.is_default}"
+                    "Node group deleted: %s for cluster %s "
+                    "which is_default: %s",
+                    nodegroup.name,
+                    cluster.uuid,
+                    nodegroup.is_default,
                 )
                 # signal the node group has been deleted
                 return None
 
             LOG.debug(
-                f"Node group not yet delete: {nodegroup.name} "
-                f"for cluster {cluster.uuid}"
+                "Node group not yet delete: %s for cluster %s",
+                nodegroup.name,
+                cluster.uuid,
             )
             return nodegroup
 
@@ -205,8 +412,10 @@ class Driver(driver.Driver):
         is_create_operation = nodegroup.status.startswith("CREATE_")
         if not is_update_operation and not is_create_operation:
             LOG.warning(
-                f"Node group: {nodegroup.name} in unexpected "
-                f"state: {nodegroup.status} in cluster {cluster.uuid}"
+                "Node group: %s in unexpected state: %s in cluster %s",
+                nodegroup.name,
+                nodegroup.status,
+                cluster.uuid,
             )
         elif ng_state == NodeGroupState.READY:
             nodegroup.status = (
@@ -215,10 +424,11 @@ class Driver(driver.Driver):
                 else fields.ClusterStatus.CREATE_COMPLETE
             )
             LOG.debug(
-                f"Node group ready: {nodegroup.name} "
-                f"in cluster {cluster.uuid}"
+                "Node group ready: %s in cluster %s",
+                nodegroup.name,
+                cluster.uuid,
             )
-            nodegroup.save()
+            db_snapshot.get(cluster).save(nodegroup)
 
         elif ng_state == NodeGroupState.FAILED:
             nodegroup.status = (
@@ -227,19 +437,24 @@ class Driver(driver.Driver):
                 else fields.ClusterStatus.CREATE_FAILED
             )
             LOG.debug(
-                f"Node group failed: {nodegroup.name} "
-                f"in cluster {cluster.uuid}"
+                "Node group failed: %s in cluster %s",
+                nodegroup.name,
+                cluster.uuid,
             )
-            nodegroup.save()
+            db_snapshot.get(cluster).save(nodegroup)
         elif ng_state == NodeGroupState.NOT_PRESENT:
             LOG.debug(
-                f"Node group not yet found: {nodegroup.name} "
-                f"state:{nodegroup.status} in cluster {cluster.uuid}"
+                "Node group not yet found: %s state:%s in cluster %s",
+                nodegroup.name,
+                nodegroup.status,
+                cluster.uuid,
             )
         else:
             LOG.debug(
-                f"Node group still pending: {nodegroup.name} "
-                f"state:{nodegroup.status} in cluster {cluster.uuid}"
+                "Node group still pending: %s state:%s in cluster %s",
+                nodegroup.name,
+                nodegroup.status,
+                cluster.uuid,
             )
 
         return nodegroup
@@ -247,15 +462,16 @@ class Driver(driver.Driver):
     def _nodegroup_machines_exist(self, cluster, nodegroup):
         cluster_name = driver_utils.chart_release_name(cluster)
         nodegroup_name = driver_utils.sanitized_name(nodegroup.name)
-        machines = self._k8s_client.get_all_machines_by_label(
-            {
-                "capi.stackhpc.com/cluster": cluster_name,
-                "capi.stackhpc.com/component": "worker",
-                "capi.stackhpc.com/node-group": nodegroup_name,
-            },
-            driver_utils.cluster_namespace(cluster),
-        )
-        return bool(machines)
+        # Decides whether the node group is deleted, so must not be stale
+        with kubernetes.read_consistency(kubernetes.CONSISTENT_READ):
+            return self._k8s_client.machines_exist_by_label(
+                {
+                    "capi.stackhpc.com/cluster": cluster_name,
+                    "capi.stackhpc.com/component": "worker",
+                    "capi.stackhpc.com/node-group": nodegroup_name,
+                },
+                driver_utils.cluster_namespace(cluster),
+            )
 
     def _update_cluster_api_address(self, cluster, capi_cluster):
         # As soon as we know the API address, we should set it
@@ -281,7 +497,7 @@ class Driver(driver.Driver):
             if cluster.api_address != api_address:
                 cluster.api_address = api_address
                 cluster.save()
-                LOG.debug(f"Found api_address for {cluster.uuid}")
+                LOG.debug("Found api_address for %s", cluster.uuid)
 
     def _update_status_updating(self, cluster, capi_cluster):
         # If the cluster is not yet ready then the create/update
@@ -298,7 +514,8 @@ class Driver(driver.Driver):
         is_update_operation = cluster.status.startswith("UPDATE_")
 
         # Check the status of the addons
-        addons = self._k8s_client.get_addons_by_label(
+        # Stop listing at the first addon that is not deployed
+        addons = self._k8s_client.iter_addons_by_label(
             {
                 "addons.stackhpc.com/cluster": driver_utils.chart_release_name(
                     cluster
@@ -324,8 +541,9 @@ class Driver(driver.Driver):
                 # If there are any addons that are not deployed or failed,
                 # wait for the next invocation to check again
                 LOG.debug(
-                    f"addon {addon['metadata']['name']} not yet deployed "
-                    f"for {cluster.uuid}"
+                    "addon %s not yet deployed for %s",
+                    addon["metadata"]["name"],
+                    cluster.uuid,
                 )
                 return
 
@@ -381,7 +599,7 @@ class Driver(driver.Driver):
     def _update_all_nodegroups_status(self, cluster):
         """Returns True if any node group still in progress."""
         nodegroups = []
-        for nodegroup in cluster.nodegroups:
+        for nodegroup in db_snapshot.get(cluster).nodegroups:
             if nodegroup.role == NODE_GROUP_ROLE_CONTROLLER:
                 updated_nodegroup = (
                     self._update_control_plane_nodegroup_status(
@@ -408,8 +626,39 @@ class Driver(driver.Driver):
         # Hence we only currently handle transitioning from IN_PROGRESS
         # states to COMPLETE
 
-        # TODO(mkjpryor) Add a timeout for create/update/delete
+        watcher = status_watcher.get_watcher()
+        if watcher and not watcher.should_poll(cluster, "status"):
+            LOG.debug(
+                "Skipping status poll for watched cluster %s", cluster.uuid
+            )
+            return
+
+        # Load the node groups once for all the status checks, which can
+        # use slightly stale Cluster API objects
+        with deadline.scope(
+            CONF.capi_helm.status_update_timeout
+        ), db_snapshot.scope(cluster), kubernetes.read_consistency(
+            CONF.capi_helm.status_read_consistency
+        ):
+            try:
+                self._update_cluster_status(context, cluster)
+            except deadline.DeadlineExceeded as e:
+                # Leave the status as it is until the next poll
+                LOG.warning(
+                    "Status update for cluster %s timed out: %s",
+                    cluster.uuid,
+                    e,
+                )
+            except kubernetes.CircuitOpen:
+                # The management cluster is unreachable, which says nothing
+                # about the cluster itself, so leave the status as it is
+                LOG.debug(
+                    "Skipping status update for cluster %s, management "
+                    "cluster is unavailable",
+                    cluster.uuid,
+                )
 
+    def _update_cluster_status(self, context, cluster):
         capi_cluster = self._get_capi_cluster(cluster)
 
         if capi_cluster:
@@ -431,10 +680,10 @@ class Driver(driver.Driver):
             # If the cluster does not exist yet,
             # create is still in progress
             if not capi_cluster:
-                LOG.debug(f"capi_cluster not yet created for {cluster.uuid}")
+                LOG.debug("capi_cluster not yet created for %s", cluster.uuid)
                 return
             if nodegroups_in_progress:
-                LOG.debug(f"Node groups are not all ready for {cluster.uuid}")
+                LOG.debug("Node groups are not all ready for %s", cluster.uuid)
                 return
             self._update_status_updating(cluster, capi_cluster)
 
@@ -443,9 +692,76 @@ class Driver(driver.Driver):
             # If the Cluster API cluster still exists,
             # the delete is still in progress
             if capi_cluster:
-                LOG.debug(f"capi_cluster still found for {cluster.uuid}")
+                LOG.debug("capi_cluster still found for %s", cluster.uuid)
                 return
-            self._update_status_deleting(context, cluster)
+            # Clean up only once a consistent read confirms it is gone
+            with kubernetes.read_consistency(kubernetes.CONSISTENT_READ):
+                if self._get_capi_cluster(cluster):
+                    LOG.debug("capi_cluster still found for %s", cluster.uuid)
+                    return
+                self._update_status_deleting(context, cluster)
+
+    def update_clusters_status(self, context, clusters):
+        """Update the status of many clusters from one snapshot.
+
+        Rather than fetching the Cluster API resources for each cluster in
+        turn, each kind of resource is listed once for every namespace
+        the clusters are in, then the usual status update is run for each
+        cluster against that snapshot.
+        """
+        try:
+            snapshot = kubernetes.Snapshot(
+                self._k8s_client, self._cluster_namespaces(clusters)
+            )
+        except kubernetes.CircuitOpen:
+            LOG.warning(
+                "Skipping status updates, management cluster is unavailable"
+            )
+            return
+        self._update_clusters_status_from(context, clusters, snapshot)
+
+    async def update_clusters_status_async(self, context, clusters):
+        """Async variant of update_clusters_status.
+
+        Every kind of resource is listed in every namespace concurrently on
+        the running event loop. The status of each cluster is then updated
+        from that snapshot as usual in an executor, as that saves to the
+        database and can make blocking requests.
+        """
+        try:
+            async with async_kubernetes.AsyncClient(
+                self._k8s_client
+            ) as client:
+                snapshot = await client.snapshot(
+                    self._cluster_namespaces(clusters)
+                )
+        except kubernetes.CircuitOpen:
+            LOG.warning(
+                "Skipping status updates, management cluster is unavailable"
+            )
+            return
+        await asyncio.get_running_loop().run_in_executor(
+            None,
+            deadline.propagate(self._update_clusters_status_from),
+            context,
+            clusters,
+            snapshot,
+        )
+
+    def _cluster_namespaces(self, clusters):
+        return sorted(
+            {driver_utils.cluster_namespace(cluster) for cluster in clusters}
+        )
+
+    def _update_clusters_status_from(self, context, clusters, snapshot):
+        with self._use_k8s_client(snapshot):
+            for cluster in clusters:
+                try:
+                    self.update_cluster_status(context, cluster)
+                except Exception:
+                    LOG.exception(
+                        "Failed to update status for cluster %s", cluster.uuid
+                    )
 
     def get_monitor(self, context, cluster):
         return capi_monitor.CAPIMonitor(context, cluster)
@@ -500,55 +816,45 @@ class Driver(driver.Driver):
                 driver_utils.cluster_namespace(cluster),
             )
 
+    @contextlib.contextmanager
+    def _use_cluster_labels(self, cluster_labels):
+        """Use the given resolved labels in the current thread."""
+        previous = getattr(self._local, "cluster_labels", None)
+        self._local.cluster_labels = cluster_labels
+        try:
+            yield
+        finally:
+            self._local.cluster_labels = previous
+
+    def _call_with_cluster_labels(self, cluster_labels, func, *args):
+        """Call func using the given resolved labels, e.g. in a worker."""
+        with self._use_cluster_labels(cluster_labels):
+            return func(*args)
+
+    def _cluster_labels(self, cluster):
+        cluster_labels = getattr(self._local, "cluster_labels", None)
+        if cluster_labels is not None and cluster_labels.cluster is cluster:
+            return cluster_labels
+        return ClusterLabels(cluster)
+
     def _label(self, cluster, key, default):
-        if key not in _REGISTERED_LABEL_NAMES:
-            raise ValueError(
-                f"Cluster label '{key}' is not registered in "
-                "capi_helm_cluster_labels. Add it to conf.py first."
-            )
-        all_labels = helm.mergeconcat(
-            cluster.cluster_template.labels, cluster.labels
-        )
-        if not all_labels:
-            return default
-        raw = all_labels.get(key, default)
-        # NOTE(johngarbutt): filtering untrusted user input
-        return re.sub(r"[^a-zA-Z0-9\.\-\/ _]+", "", raw)
+        return self._cluster_labels(cluster).get(key, default)
 
     def _get_label_bool(self, cluster, label, default):
-        cluster_label = self._label(cluster, label, "")
-        return strutils.bool_from_string(cluster_label, default=default)
+        return self._cluster_labels(cluster).get_bool(label, default)
 
     def _get_label_int(self, cluster, label, default):
-        cluster_label = self._label(cluster, label, "")
-        if not cluster_label:
-            return default
-        try:
-            return int(cluster_label)
-        except ValueError:
-            return default
+        return self._cluster_labels(cluster).get_int(label, default)
 
     def _get_label_csv(self, cluster, label, default):
         """Return a cluster label as a filtered list split on commas."""
-        if label not in _REGISTERED_LABEL_NAMES:
-            raise ValueError(
-                f"Cluster label '{label}' is not registered in "
-                "capi_helm_cluster_labels. Add it to conf.py first."
-            )
-        all_labels = helm.mergeconcat(
-            cluster.cluster_template.labels, cluster.labels
-        )
-        raw = (all_labels or {}).get(label, "") or default
-        if not raw:
-            return []
-        return [
-            re.sub(r"[^a-zA-Z0-9\.\-\/\:]+", "", entry.strip())
-            for entry in str(raw).split(",")
-            if entry.strip()
-        ]
+        return self._cluster_labels(cluster).get_csv(label, default)
 
     def _get_chart_version(self, cluster):
-        version = cluster.cluster_template.labels.get(
+        return self._get_template_chart_version(cluster.cluster_template)
+
+    def _get_template_chart_version(self, cluster_template):
+        version = cluster_template.labels.get(
             "capi_helm_chart_version",
             CONF.capi_helm.default_helm_chart_version,
         )
@@ -600,6 +906,44 @@ class Driver(driver.Driver):
             self._get_os_distro(image),
         )
 
+    def _get_values_digest_secret_name(self, cluster):
+        return driver_utils.get_k8s_resource_name(cluster, "values-digest")
+
+    def _get_values_digest(self, cluster):
+        # Fetch the digest of the values from the last upgrade, and the
+        # status of the release it was applied to
+        try:
+            data = self._k8s_client.get_secret_data(
+                self._get_values_digest_secret_name(cluster),
+                driver_utils.cluster_namespace(cluster),
+            )
+        except requests.exceptions.RequestException as e:
+            LOG.warning(
+                "Failed to fetch helm values digest for cluster %s: %s",
+                cluster.uuid,
+                e,
+            )
+            data = None
+        data = data or {}
+        return data.get("digest"), data.get("status")
+
+    def _set_values_digest(self, cluster, digest, status):
+        try:
+            self._k8s_client.apply_secret(
+                self._get_values_digest_secret_name(cluster),
+                {
+                    "metadata": {"labels": self._k8s_resource_labels(cluster)},
+                    "stringData": {"digest": digest, "status": status},
+                },
+                driver_utils.cluster_namespace(cluster),
+            )
+        except requests.exceptions.RequestException as e:
+            LOG.warning(
+                "Failed to store helm values digest for cluster %s: %s",
+                cluster.uuid,
+                e,
+            )
+
     def _get_app_cred_secret_name(self, cluster):
         return driver_utils.get_k8s_resource_name(cluster, "cloud-credentials")
 
@@ -616,7 +960,7 @@ class Driver(driver.Driver):
                 secret_name, secret_namespace, "clouds.yaml"
             )
             if clouds_dict_str:
-                clouds_dict = yaml.safe_load(clouds_dict_str)
+                clouds_dict = serialization.yaml_load(clouds_dict_str)
                 auth_dict = clouds_dict["clouds"]["openstack"]["auth"]
                 return auth_dict["application_credential_id"]
             else:
@@ -625,8 +969,9 @@ class Driver(driver.Driver):
             msg = str(e)
 
         LOG.error(
-            "Failed to fetch application credential for cluster "
-            f"{cluster.uuid}: {msg}"
+            "Failed to fetch application credential for cluster %s: %s",
+            cluster.uuid,
+            msg,
         )
 
     def _get_etcd_config(self, cluster):
@@ -757,8 +1102,10 @@ class Driver(driver.Driver):
         for flavor in flavors:
             vcpus = flavor.vcpus
             LOG.debug(
-                f"Checking if {requested_flavor} matches "
-                f"{flavor.id} or {flavor.name}"
+                "Checking if %s matches %s or %s",
+                requested_flavor,
+                flavor.id,
+                flavor.name,
             )
             if requested_flavor in [flavor.id, flavor.name]:
                 if vcpus < CONF.capi_helm.minimum_flavor_vcpus:
@@ -776,7 +1123,7 @@ class Driver(driver.Driver):
         )
 
     def _is_default_worker_nodegroup(self, cluster, nodegroup):
-        return cluster.default_ng_worker.id == nodegroup.id
+        return db_snapshot.get(cluster).default_ng_worker.id == nodegroup.id
 
     def _get_node_counts(self, cluster, nodegroup):
 
@@ -824,9 +1171,10 @@ class Driver(driver.Driver):
         min_nodes, max_nodes = self._get_node_counts(cluster, nodegroup)
 
         LOG.debug(
-            f"Checking if node group {nodegroup.name} has valid "
-            f"node count parameters (count, min, max) = "
-            f"{(nodegroup.node_count, min_nodes, max_nodes)}"
+            "Checking if node group %s has valid "
+            "node count parameters (count, min, max) = %s",
+            nodegroup.name,
+            (nodegroup.node_count, min_nodes, max_nodes),
         )
 
         if min_nodes is not None:
@@ -917,7 +1265,7 @@ class Driver(driver.Driver):
             "api_master_lb_allowed_cidrs",
             CONF.capi_helm_cluster_labels.api_master_lb_allowed_cidrs,
         )
-        LOG.debug(f"CIDR list {cidrs}")
+        LOG.debug("CIDR list %s", cidrs)
         return cidrs or False
 
     def _storageclass_definitions(self, context, cluster):
@@ -939,14 +1287,15 @@ class Driver(driver.Driver):
         # type returned by cinder.
         default_volume_type = CONF.capi_helm.csi_cinder_default_volume_type
         LOG.debug(
-            f"Default volume type: {default_volume_type}"
-            f" Volume types: {volume_types}"
+            "Default volume type: %s Volume types: %s",
+            default_volume_type,
+            volume_types,
         )
         if not default_volume_type:
             default_volume_type = volume_types[0]
             LOG.warning(
-                f"Default volume type not defined."
-                f" Using {default_volume_type}."
+                "Default volume type not defined. Using %s.",
+                default_volume_type,
             )
         elif default_volume_type not in volume_types:
             # If default does not exist throw an error.
@@ -998,17 +1347,93 @@ class Driver(driver.Driver):
                 nodegroup_set.append(nodegroup_item)
         return nodegroup_set
 
-    def _update_helm_release(self, context, cluster, nodegroups=None):
-        lconf = CONF.capi_helm_cluster_labels
-        if nodegroups is None:
-            nodegroups = cluster.nodegroups
+    def _update_helm_release(
+        self, context, cluster, nodegroups=None, force=False
+    ):
+        # With skip_unchanged_helm_upgrades, the upgrade is skipped if the
+        # values are unchanged since the last completed upgrade, unless it
+        # is forced
+        # Resolve the cluster labels and node groups once, for all the values
+        with db_snapshot.scope(cluster), self._use_cluster_labels(
+            self._cluster_labels(cluster)
+        ):
+            values = self._get_helm_values(context, cluster, nodegroups)
+
+        chart_version = self._get_chart_version(cluster)
+        digest = helm.values_digest(
+            CONF.capi_helm.helm_chart_name,
+            values,
+            repo=CONF.capi_helm.helm_chart_repo,
+            version=chart_version,
+            deploy_mode=CONF.capi_helm.deploy_mode,
+        )
+        skip_unchanged = CONF.capi_helm.skip_unchanged_helm_upgrades
+        if skip_unchanged and not force:
+            # Only skipped if the last upgrade with these values completed,
+            # rather than e.g. failing part way or being interrupted
+            if self._get_values_digest(cluster) == (digest, "deployed"):
+                LOG.info(
+                    "Skipping helm upgrade for cluster %s, values are "
+                    "unchanged",
+                    cluster.uuid,
+                )
+                metrics.increment("helm_upgrade_skipped")
+                return
+        if skip_unchanged:
+            # Recorded first, so an upgrade that does not complete is not
+            # skipped when retried, or when the values are changed back
+            self._set_values_digest(cluster, digest, "pending-upgrade")
 
-        image_id, kube_version, os_distro = self._get_image_details(
-            context, cluster.cluster_template.image_id
+        self._get_release_client(cluster).install_or_upgrade(
+            driver_utils.chart_release_name(cluster),
+            CONF.capi_helm.helm_chart_name,
+            values,
+            repo=CONF.capi_helm.helm_chart_repo,
+            version=chart_version,
+            namespace=driver_utils.cluster_namespace(cluster),
         )
+        metrics.increment("helm_upgrade")
+        self._set_values_digest(cluster, digest, "deployed")
+
+    def _get_helm_values(self, context, cluster, nodegroups=None):
+        lconf = CONF.capi_helm_cluster_labels
+        if nodegroups is None:
+            nodegroups = db_snapshot.get(cluster).nodegroups
 
-        network_id = self._get_fixed_network_id(context, cluster)
-        subnet_id = neutron.get_fixed_subnet_id(context, cluster.fixed_subnet)
+        # The OpenStack lookups are independent, so make them concurrently,
+        # with a worker for each
+        lookups = [
+            (
+                self._get_image_details,
+                context,
+                cluster.cluster_template.image_id,
+            ),
+            (self._get_fixed_network_id, context, cluster),
+            (neutron.get_fixed_subnet_id, context, cluster.fixed_subnet),
+            (
+                neutron.get_external_network_id,
+                context,
+                cluster.cluster_template.external_network_id,
+            ),
+            (
+                self._call_with_cluster_labels,
+                self._cluster_labels(cluster),
+                self._storageclass_definitions,
+                context,
+                cluster,
+            ),
+        ]
+        with driver_utils.get_executor(len(lookups)) as executor:
+            lookup_futures = [executor.submit(*lookup) for lookup in lookups]
+        # Exiting the executor waits for all the lookups, then the
+        # first error (in the original order) is raised unchanged
+        (
+            (image_id, kube_version, os_distro),
+            network_id,
+            subnet_id,
+            external_network_id,
+            storageclass_definitions,
+        ) = [future.result() for future in lookup_futures]
 
         values = {
             "kubernetesVersion": kube_version,
@@ -1029,9 +1454,7 @@ class Driver(driver.Driver):
             },
             "clusterNetworking": {
                 "dnsNameservers": self._get_dns_nameservers(cluster),
-                "externalNetworkId": neutron.get_external_network_id(
-                    context, cluster.cluster_template.external_network_id
-                ),
+                "externalNetworkId": external_network_id,
                 "internalNetwork": {
                     "networkFilter": (
                         {"id": network_id} if network_id else None
@@ -1048,7 +1471,7 @@ class Driver(driver.Driver):
             "osDistro": os_distro,
             "controlPlane": {
                 "machineFlavor": cluster.master_flavor_id,
-                "machineCount": cluster.master_count,
+                "machineCount": db_snapshot.get(cluster).master_count,
                 "healthCheck": {
                     "enabled": self._get_autoheal_enabled(cluster),
                 },
@@ -1061,9 +1484,7 @@ class Driver(driver.Driver):
             "nodeGroups": self._process_node_groups(cluster, nodegroups),
             "addons": {
                 "openstack": {
-                    "csiCinder": self._storageclass_definitions(
-                        context, cluster
-                    ),
+                    "csiCinder": storageclass_definitions,
                     "cloudConfig": {
                         "LoadBalancer": {
                             "lb-provider": self._get_octavia_provider(cluster),
@@ -1192,7 +1613,9 @@ class Driver(driver.Driver):
             values = helm.mergeconcat(values, k8s_keystone_auth_config)
             LOG.debug(
                 "Enable K8s keystone auth webhook for"
-                f" project: {context.project_id} auth url: {context.auth_url}"
+                " project: %s auth url: %s",
+                context.project_id,
+                context.auth_url,
             )
 
         api_lb_allowed_cidrs = self._get_allowed_cidrs(cluster)
@@ -1207,13 +1630,33 @@ class Driver(driver.Driver):
             cni_config = {"addons": {"cni": {"type": cni_type}}}
             values = helm.mergeconcat(values, cni_config)
 
-        self._helm_client.install_or_upgrade(
-            driver_utils.chart_release_name(cluster),
-            CONF.capi_helm.helm_chart_name,
-            values,
-            repo=CONF.capi_helm.helm_chart_repo,
-            version=self._get_chart_version(cluster),
-            namespace=driver_utils.cluster_namespace(cluster),
+        return values
+
+    def prewarm_chart_cache(self, context):
+        """Fetch the charts used by cluster templates into the chart cache.
+
+        Caches the default chart version and every version set by the
+        capi_helm_chart_version label of a visible cluster template. Use
+        an admin context for all tenants to include every template.
+        """
+        chart_cache = self._helm_client.chart_cache
+        if not chart_cache:
+            return
+        versions = {CONF.capi_helm.default_helm_chart_version}
+        for cluster_template in objects.ClusterTemplate.list(context):
+            if cluster_template.hidden:
+                continue
+            if "capi_helm_chart_version" in (cluster_template.labels or {}):
+                versions.add(
+                    self._get_template_chart_version(cluster_template)
+                )
+        chart_cache.prewarm(
+            (
+                CONF.capi_helm.helm_chart_name,
+                CONF.capi_helm.helm_chart_repo,
+                version,
+            )
+            for version in sorted(versions)
         )
 
     def _generate_release_name(self, cluster):
@@ -1233,34 +1676,39 @@ class Driver(driver.Driver):
         # be sure to save this before we use it
         cluster.save()
 
+    @_operation_deadline
     def create_cluster(self, context, cluster, cluster_create_timeout):
         LOG.info("Starting to create cluster %s", cluster.uuid)
 
         self._validate_allowed_flavor(context, cluster.master_flavor_id)
-        nodegroups = cluster.nodegroups
-        for ng in nodegroups:
-            self._validate_allowed_flavor(context, ng.flavor_id)
-        # we generate this name (on the initial create call only)
-        # so we hit no issues with duplicate cluster names
-        # and it makes renaming clusters in the API possible
-        self._generate_release_name(cluster)
-
-        # NOTE(johngarbutt) all node groups should already
-        # be in the CREATE_IN_PROGRESS state
-        self._k8s_client.ensure_namespace(
-            driver_utils.cluster_namespace(cluster)
-        )
-        self._create_appcred_secret(context, cluster)
-        self._ensure_certificate_secrets(context, cluster)
+        with db_snapshot.scope(cluster) as snapshot:
+            for ng in snapshot.nodegroups:
+                self._validate_allowed_flavor(context, ng.flavor_id)
+            # we generate this name (on the initial create call only)
+            # so we hit no issues with duplicate cluster names
+            # and it makes renaming clusters in the API possible
+            self._generate_release_name(cluster)
+
+            # NOTE(johngarbutt) all node groups should already
+            # be in the CREATE_IN_PROGRESS state
+            self._k8s_client.ensure_namespace(
+                driver_utils.cluster_namespace(cluster)
+            )
+            self._create_appcred_secret(context, cluster)
+            self._ensure_certificate_secrets(context, cluster)
 
-        self._update_helm_release(context, cluster)
+            self._update_helm_release(context, cluster)
 
+    @_operation_deadline
     def update_cluster(
         self, context, cluster, scale_manager=None, rollback=False
     ):
         # we get here if cluster was patched with new node_count
-        self._update_helm_release(context, cluster)
+        # An explicit update always reconciles the release, e.g. if it was
+        # rolled back or changed by hand
+        self._update_helm_release(context, cluster, force=True)
 
+    @_operation_deadline
     def delete_cluster(self, context, cluster):
         LOG.info("Starting to delete cluster %s", cluster.uuid)
 
@@ -1281,11 +1729,12 @@ class Driver(driver.Driver):
             # Helm release.
             # Note that this just marks the resources for deletion,
             # it does not wait for the resources to be deleted.
-            self._helm_client.uninstall_release(
+            self._get_release_client(cluster).uninstall_release(
                 release_name,
                 namespace=driver_utils.cluster_namespace(cluster),
             )
 
+    @_operation_deadline
     def resize_cluster(
         self,
         context,
@@ -1299,6 +1748,7 @@ class Driver(driver.Driver):
             LOG.warning("Removing specific nodes is not currently supported")
         self._update_helm_release(context, cluster)
 
+    @_operation_deadline
     def upgrade_cluster(
         self,
         context,
@@ -1312,50 +1762,63 @@ class Driver(driver.Driver):
         # TODO(mkjpryor) check that the upgrade is viable
         # e.g. not a downgrade, not an upgrade by more than one minor version
 
-        # Updating the template will likely apply for all nodegroups
-        # So mark them all as having an update in progress
-        for nodegroup in cluster.nodegroups:
-            nodegroup.status = fields.ClusterStatus.UPDATE_IN_PROGRESS
-            self._validate_allowed_flavor(context, nodegroup.flavor_id)
-            nodegroup.save()
-
-        # Move the cluster to the new template
-        cluster.cluster_template_id = cluster_template.uuid
-        cluster.status = fields.ClusterStatus.UPDATE_IN_PROGRESS
-        cluster.save()
-        cluster.refresh()
+        with db_snapshot.scope(cluster) as snapshot:
+            # Updating the template will likely apply for all nodegroups
+            # So mark them all as having an update in progress
+            for nodegroup in snapshot.nodegroups:
+                nodegroup.status = fields.ClusterStatus.UPDATE_IN_PROGRESS
+                self._validate_allowed_flavor(context, nodegroup.flavor_id)
+                snapshot.save(nodegroup)
+
+            # Move the cluster to the new template
+            cluster.cluster_template_id = cluster_template.uuid
+            cluster.status = fields.ClusterStatus.UPDATE_IN_PROGRESS
+            cluster.save()
+            cluster.refresh()
 
-        self._update_helm_release(context, cluster)
+            self._update_helm_release(context, cluster, force=True)
 
+    @_operation_deadline
     def create_nodegroup(self, context, cluster, nodegroup):
         nodegroup.status = fields.ClusterStatus.CREATE_IN_PROGRESS
         self._validate_allowed_flavor(context, nodegroup.flavor_id)
-        if self._get_autoscale_enabled(cluster):
-            self._validate_allowed_node_counts(cluster, nodegroup)
-        nodegroup.save()
-
-        self._update_helm_release(context, cluster)
-
+        # Resolve the cluster labels once, for the checks and the values
+        with self._use_cluster_labels(ClusterLabels(cluster)):
+            if self._get_autoscale_enabled(cluster):
+                self._validate_allowed_node_counts(cluster, nodegroup)
+            with db_snapshot.scope(cluster) as snapshot:
+                snapshot.save(nodegroup)
+                self._update_helm_release(context, cluster)
+
+    @_operation_deadline
     def update_nodegroup(self, context, cluster, nodegroup):
         nodegroup.status = fields.ClusterStatus.UPDATE_IN_PROGRESS
         self._validate_allowed_flavor(context, nodegroup.flavor_id)
-        if self._get_autoscale_enabled(cluster):
-            self._validate_allowed_node_counts(cluster, nodegroup)
-        nodegroup.save()
-
-        self._update_helm_release(context, cluster)
-
+        # Resolve the cluster labels once, for the checks and the values
+        with self._use_cluster_labels(ClusterLabels(cluster)):
+            if self._get_autoscale_enabled(cluster):
+                self._validate_allowed_node_counts(cluster, nodegroup)
+            with db_snapshot.scope(cluster) as snapshot:
+                snapshot.save(nodegroup)
+                self._update_helm_release(context, cluster)
+
+    @_operation_deadline
     def delete_nodegroup(self, context, cluster, nodegroup):
         nodegroup.status = fields.ClusterStatus.DELETE_IN_PROGRESS
-        nodegroup.save()
+        with db_snapshot.scope(cluster) as snapshot:
+            snapshot.save(nodegroup)
 
-        # Remove the nodegroup being deleted from the nodegroups
-        # for the Helm release
-        self._update_helm_release(
-            context,
-            cluster,
-            [ng for ng in cluster.nodegroups if ng.name != nodegroup.name],
-        )
+            # Remove the nodegroup being deleted from the nodegroups
+            # for the Helm release
+            self._update_helm_release(
+                context,
+                cluster,
+                [
+                    ng
+                    for ng in snapshot.nodegroups
+                    if ng.name != nodegroup.name
+                ],
+            )
 
     def rotate_credential(self, context, cluster):
         # Current cluster owner to revert to if rotation fails
@@ -1368,7 +1831,9 @@ class Driver(driver.Driver):
             else cluster.uuid
         )
 
-        LOG.info(f"Rotating application credential for cluster {cluster_name}")
+        LOG.info(
+            "Rotating application credential for cluster %s", cluster_name
+        )
 
         # Set new owner now to ensure resource labels are applied correctly
         cluster.user_id = context.user_id
@@ -1392,21 +1857,26 @@ class Driver(driver.Driver):
         except exceptions as e:
             error_msg = str(e)
             LOG.warning(
-                "Failed to rotate application credential for cluster "
-                f"{cluster_name}: {e}"
+                "Failed to rotate application credential for cluster %s: %s",
+                cluster_name,
+                e,
             )
         else:
             if not new_app_cred:
                 error_msg = "Application credential secret is unset."
                 LOG.critical(
                     "Failed to rotate application credential for cluster "
-                    f"{cluster_name}: {error_msg}"
+                    "%s: %s",
+                    cluster_name,
+                    error_msg,
                 )
             elif new_app_cred.id == old_app_cred_id:
                 error_msg = "Application credential secret failed to apply."
                 LOG.error(
                     "Failed to rotate application credential for cluster "
-                    f"{cluster_name}: {error_msg}"
+                    "%s: %s",
+                    cluster_name,
+                    error_msg,
                 )
             # Update user-id label on existing secrets if it has changed
             elif cluster.user_id != old_user_id:
@@ -1415,14 +1885,19 @@ class Driver(driver.Driver):
                 except requests.exceptions.RequestException as e:
                     error_msg = str(e)
                     LOG.error(
-                        f"Failed to transfer ownership of cluster "
-                        f"{cluster_name} from {old_user_id} to "
-                        f"{cluster.user_id}: {e}"
+                        "Failed to transfer ownership of cluster "
+                        "%s from %s to %s: %s",
+                        cluster_name,
+                        old_user_id,
+                        cluster.user_id,
+                        e,
                     )
                 else:
                     LOG.info(
-                        f"Ownership of cluster {cluster_name} transferred "
-                        f"from {cluster.user_id} to {context.user_id}"
+                        "Ownership of cluster %s transferred from %s to %s",
+                        cluster_name,
+                        cluster.user_id,
+                        context.user_id,
                     )
 
         if error_msg:
@@ -1446,7 +1921,9 @@ class Driver(driver.Driver):
                 )
                 LOG.warning(
                     "Failed to delete application credential for "
-                    f"cluster {cluster_name}: {e}"
+                    "cluster %s: %s",
+                    cluster_name,
+                    e,
                 )
 
         cluster.status = fields.ClusterStatus.UPDATE_COMPLETE
@@ -12,7 +12,11 @@
 
 # Collection of static functions that are shared within the driver.
 
+from concurrent import futures
 import re
+import sys
+
+import futurist
 
 from magnum_capi_helm import conf
 
@@ -43,3 +47,18 @@ def chart_release_name(cluster):
 
 def get_k8s_resource_name(cluster, name):
     return sanitized_name(chart_release_name(cluster), name)
+
+
+def get_executor(max_workers):
+    """Returns an executor for running blocking calls concurrently.
+
+    Green threads are used when the thread module has been monkey patched
+    by eventlet, e.g. in an eventlet based conductor, otherwise native
+    threads are used.
+    """
+    patcher = sys.modules.get("eventlet.patcher")
+    if patcher and patcher.is_monkey_patched("thread"):
+        return futurist.GreenThreadPoolExecutor(max_workers=max_workers)
+    # NOTE: futurist's native workers idle for a second before exiting,
+    # which delays shutdown of these short-lived executors
+    return futures.ThreadPoolExecutor(max_workers=max_workers)
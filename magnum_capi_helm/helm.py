@@ -10,20 +10,42 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import collections
+import contextlib
 import functools
+import hashlib
 import json
+import math
+import os
 import pathlib
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
 import typing as t
 
 from magnum.common import utils
 from oslo_concurrency import processutils
 from oslo_log import log as logging
+import yaml
 
 from magnum_capi_helm import conf
+from magnum_capi_helm import deadline
+from magnum_capi_helm import serialization
 
 LOG = logging.getLogger(__name__)
 CONF = conf.CONF
 
+# Rendered manifests, keyed by release and values digest
+_TEMPLATE_CACHE_SIZE = 64
+_template_cache = collections.OrderedDict()
+_template_cache_lock = threading.Lock()
+
+# Seconds helm is allowed to run past the deadline, as it is given the time
+# remaining as its own --timeout, and to exit once asked to stop
+_STOP_GRACE_PERIOD = 10
+
 # This code is loosely based on:
 #  https://github.com/azimuth-cloud/pyhelm3
 #  Ideally we can share this code in the future.
@@ -56,23 +78,280 @@ def mergeconcat(defaults, *overrides):
     return functools.reduce(mergeconcat2, overrides, defaults)
 
 
+def values_digest(
+    chart_ref, *values, repo=None, version=None, deploy_mode=None
+):
+    """Returns a digest of the chart and merged values for a release.
+
+    The values are serialised canonically, so the digest only changes
+    when the chart, the effective values or the deploy mode change.
+    """
+    payload = json.dumps(
+        {
+            "chart": str(chart_ref),
+            "repo": repo,
+            "version": version,
+            "deploy_mode": deploy_mode,
+            "values": mergeconcat({}, *values),
+        },
+        sort_keys=True,
+        separators=(",", ":"),
+        default=str,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+# Fields of the summary printed by helm upgrade, which is used rather than
+# --output json as that includes the whole rendered manifest
+_SUMMARY_FIELDS = {
+    "NAME": "name",
+    "NAMESPACE": "namespace",
+    "STATUS": "status",
+    "REVISION": "revision",
+}
+
+
+def parse_release_summary(output):
+    """Returns the release fields from the summary printed by helm."""
+    release = {}
+    for line in output.splitlines():
+        if line.startswith("NOTES:"):
+            break
+        key, sep, value = line.partition(":")
+        if sep and key in _SUMMARY_FIELDS:
+            release[_SUMMARY_FIELDS[key]] = value.strip()
+    if release.get("revision", "").isdigit():
+        release["revision"] = int(release["revision"])
+    return release
+
+
+class ChartCacheError(Exception):
+    """Raised when a chart cannot be added to the cache."""
+
+
+class ChartCache:
+    """Local cache of chart archives, keyed by repo, name and version.
+
+    Each chart version is pulled once, checked, and stored as a .tgz in
+    the cache directory. When the cache grows beyond its maximum size the
+    least recently used archives are removed, except those in use by this
+    process, see use, and those used within helm_timeout, which may be in
+    use by another process sharing the directory.
+    """
+
+    def __init__(self, client, directory, max_size):
+        self._client = client
+        self._directory = pathlib.Path(directory)
+        self._max_size = max_size
+        # Guards the fields below, and eviction
+        self._lock = threading.Lock()
+        # Held while pulling each archive, so other charts are not blocked
+        self._pull_locks = {}
+        # Number of users of each archive in this process
+        self._in_use = collections.Counter()
+
+    def _chart_path(self, chart_name, repo, version):
+        # Charts with the same name may come from different repos
+        source = hashlib.sha256(f"{repo or ''}|{chart_name}".encode())
+        name = chart_name.rstrip("/").rsplit("/", 1)[-1]
+        return (
+            self._directory / source.hexdigest()[:16] / f"{name}-{version}.tgz"
+        )
+
+    def get(self, chart_name, repo=None, version=None):
+        """Returns the path of the cached chart, pulling it if required.
+
+        The archive may be evicted at any time, so use this to pass the
+        chart to helm.
+        """
+        assert version, "only versioned charts can be cached"
+        path = self._chart_path(chart_name, repo, version)
+        self._fetch(chart_name, repo, version, path)
+        return path
+
+    @contextlib.contextmanager
+    def use(self, chart_name, repo=None, version=None):
+        """Yields the path of the cached chart, pulling it if required.
+
+        The archive is not evicted until the context exits.
+        """
+        assert version, "only versioned charts can be cached"
+        path = self._chart_path(chart_name, repo, version)
+        with self._lock:
+            self._in_use[path] += 1
+        try:
+            self._fetch(chart_name, repo, version, path)
+            yield path
+        finally:
+            with self._lock:
+                self._in_use[path] -= 1
+                if not self._in_use[path]:
+                    del self._in_use[path]
+
+    def _fetch(self, chart_name, repo, version, path):
+        with self._lock:
+            pull_lock = self._pull_locks.setdefault(path, threading.Lock())
+        with pull_lock:
+            try:
+                # Record the use, for least recently used eviction
+                os.utime(path)
+                return
+            except FileNotFoundError:
+                pass
+            LOG.info(
+                "Adding chart %s version %s to cache", chart_name, version
+            )
+            self._pull(chart_name, repo, version, path)
+        with self._lock:
+            self._evict()
+
+    def prewarm(self, charts):
+        """Pulls each of the (chart_name, repo, version) into the cache."""
+        for chart_name, repo, version in charts:
+            try:
+                self.get(chart_name, repo=repo, version=version)
+            except (ChartCacheError, processutils.ProcessExecutionError) as e:
+                LOG.warning(
+                    "Failed to cache chart %s version %s: %s",
+                    chart_name,
+                    version,
+                    e,
+                )
+
+    def _pull(self, chart_name, repo, version, path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=path.parent) as tmp_dir:
+            command = [
+                "pull",
+                chart_name,
+                "--version",
+                version,
+                "--destination",
+                tmp_dir,
+            ]
+            if repo:
+                command += ["--repo", repo]
+            self._client._run(command)
+            archives = list(pathlib.Path(tmp_dir).glob("*.tgz"))
+            if len(archives) != 1:
+                raise ChartCacheError(
+                    f"Expected one chart archive for {chart_name} "
+                    f"version {version}, found {len(archives)}."
+                )
+            self._verify(archives[0], version)
+            # Rename is atomic, so other processes sharing the cache never
+            # see a partially written archive
+            os.replace(archives[0], path)
+
+    def _verify(self, archive, version):
+        try:
+            with tarfile.open(archive, "r:gz") as tar:
+                chart_yamls = [
+                    member
+                    for member in tar.getmembers()
+                    if member.name.count("/") == 1
+                    and member.name.endswith("/Chart.yaml")
+                ]
+                if not chart_yamls:
+                    raise ChartCacheError(f"{archive.name} has no Chart.yaml")
+                chart = serialization.yaml_load(
+                    tar.extractfile(chart_yamls[0])
+                )
+        except (tarfile.TarError, yaml.YAMLError) as e:
+            raise ChartCacheError(f"{archive.name} is not a valid chart: {e}")
+        if str(chart.get("version")) != version:
+            raise ChartCacheError(
+                f"{archive.name} has version {chart.get('version')}, "
+                f"expected {version}"
+            )
+
+    def _evict(self):
+        archives = [
+            (path.stat().st_mtime, path.stat().st_size, path)
+            for path in self._directory.glob("*/*.tgz")
+        ]
+        total_size = sum(size for _, size, _ in archives)
+        recently_used = time.time() - CONF.capi_helm.helm_timeout
+        # Remove the least recently used archives first
+        for mtime, size, path in sorted(archives):
+            if total_size <= self._max_size:
+                break
+            if path in self._in_use or mtime > recently_used:
+                continue
+            LOG.info("Removing chart %s from cache", path.name)
+            path.unlink(missing_ok=True)
+            total_size -= size
+
+
 class Client:
     """Client for interacting with Helm CLI."""
 
     def __init__(self):
-        self._default_timeout = "5m"
         self._executable = "helm"
         self._history_max_revisions = 10
         self._kubeconfig = CONF.capi_helm.kubeconfig_file
+        self.chart_cache = None
+        if CONF.capi_helm.helm_chart_cache_dir:
+            self.chart_cache = ChartCache(
+                self,
+                CONF.capi_helm.helm_chart_cache_dir,
+                CONF.capi_helm.helm_chart_cache_size * 1024 * 1024,
+            )
 
     def _run(self, command, **kwargs) -> bytes:
         command = [self._executable] + command
         if self._kubeconfig:
             command.extend(["--kubeconfig", self._kubeconfig])
-        stdout, stderr = utils.execute(*command, **kwargs)
-        LOG.debug(f"Ran helm {command} got out:{stdout} err:{stderr}")
+        timeout = deadline.timeout(None)
+        if timeout is not None:
+            # Stop helm if it is still running once its own --timeout, if
+            # any, should have ended it
+            processes = []
+            kwargs.update(
+                timeout=timeout + _STOP_GRACE_PERIOD,
+                on_execute=processes.append,
+            )
+        try:
+            stdout, stderr = utils.execute(*command, **kwargs)
+        except subprocess.TimeoutExpired as exc:
+            for process in processes:
+                self._stop(process)
+            raise deadline.DeadlineExceeded(
+                f"helm {command[1]} did not finish before the deadline"
+            ) from exc
+        LOG.debug("Ran helm %s got out:%s err:%s", command, stdout, stderr)
         return stdout
 
+    @staticmethod
+    def _stop(process):
+        # Ask helm to exit first, so that it can record the failure of the
+        # release rather than leaving it pending, and always reap it
+        process.terminate()
+        try:
+            process.wait(timeout=_STOP_GRACE_PERIOD)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+    @contextlib.contextmanager
+    def _use_chart(self, chart_ref, repo, version):
+        # Yields the chart_ref, repo and version to pass to helm, using the
+        # chart cache for versioned charts
+        if self.chart_cache and version:
+            with self.chart_cache.use(
+                chart_ref, repo=repo, version=version
+            ) as path:
+                yield path, None, None
+        else:
+            yield chart_ref, repo, version
+
+    def _timeout(self):
+        """Returns the helm --timeout, limited to the time remaining."""
+        seconds = deadline.timeout(CONF.capi_helm.helm_timeout)
+        if seconds % 60 == 0:
+            return f"{int(seconds) // 60}m"
+        return f"{math.ceil(seconds)}s"
+
     def install_or_upgrade(
         self,
         release_name: str,
@@ -81,9 +360,20 @@ class Client:
         namespace: str,
         repo: t.Optional[str] = None,
         version: t.Optional[str] = None,
-    ) -> t.Iterable[t.Dict[str, t.Any]]:
-        """Install or upgrade specified release using chart and values."""
+    ) -> t.Dict[str, t.Any]:
+        """Install or upgrade specified release using chart and values.
+
+        Returns the name, namespace, status and revision of the release.
+        """
         assert release_name is not None
+        with self._use_chart(chart_ref, repo, version) as chart:
+            return self._install_or_upgrade(
+                release_name, *chart, *values, namespace=namespace
+            )
+
+    def _install_or_upgrade(
+        self, release_name, chart_ref, repo, version, *values, namespace
+    ):
         command = [
             "upgrade",
             release_name,
@@ -91,10 +381,8 @@ class Client:
             "--history-max",
             self._history_max_revisions,
             "--install",
-            "--output",
-            "json",
             "--timeout",
-            self._default_timeout,
+            self._timeout(),
             # We send the values in on stdin
             "--values",
             "-",
@@ -109,8 +397,75 @@ class Client:
                 version,
             ]
 
-        process_input = json.dumps(mergeconcat({}, *values))
-        return json.loads(self._run(command, process_input=process_input))
+        process_input = serialization.json_dumps(mergeconcat({}, *values))
+        return parse_release_summary(
+            self._run(command, process_input=process_input)
+        )
+
+    def template(
+        self,
+        release_name: str,
+        chart_ref: t.Union[pathlib.Path, str],
+        *values: t.Dict[str, t.Any],
+        namespace: str,
+        repo: t.Optional[str] = None,
+        version: t.Optional[str] = None,
+    ) -> t.List[t.Dict[str, t.Any]]:
+        """Render the objects for a release using chart and values.
+
+        The rendered objects for each chart version and values are cached,
+        so repeated requests do not run helm again. The returned objects
+        are shared and must not be modified.
+        """
+        assert release_name is not None
+        cache_key = (
+            release_name,
+            namespace,
+            values_digest(chart_ref, *values, repo=repo, version=version),
+        )
+        with _template_cache_lock:
+            if cache_key in _template_cache:
+                _template_cache.move_to_end(cache_key)
+                return _template_cache[cache_key]
+
+        with self._use_chart(chart_ref, repo, version) as chart:
+            objects = self._template(
+                release_name, *chart, *values, namespace=namespace
+            )
+        with _template_cache_lock:
+            _template_cache[cache_key] = objects
+            while len(_template_cache) > _TEMPLATE_CACHE_SIZE:
+                _template_cache.popitem(last=False)
+        return objects
+
+    def _template(
+        self, release_name, chart_ref, repo, version, *values, namespace
+    ):
+        command = [
+            "template",
+            release_name,
+            chart_ref,
+            # We send the values in on stdin
+            "--values",
+            "-",
+            "--namespace",
+            namespace,
+            # Hooks are only run by helm for releases
+            "--no-hooks",
+        ]
+        if repo:
+            command += ["--repo", repo]
+        if version:
+            command += ["--version", version]
+
+        process_input = serialization.json_dumps(mergeconcat({}, *values))
+        return [
+            obj
+            for obj in serialization.yaml_load_all(
+                self._run(command, process_input=process_input)
+            )
+            if obj
+        ]
 
     def uninstall_release(
         self,
@@ -123,7 +478,7 @@ class Client:
             "uninstall",
             release_name,
             "--timeout",
-            self._default_timeout,
+            self._timeout(),
             "--namespace",
             namespace,
         ]
@@ -11,86 +11,795 @@
 # under the License.
 
 import base64
-import copy
+import codecs
+import collections
+import contextlib
+import contextvars
+import functools
 import json
 import os
 import pathlib
+import random
 import re
+import ssl
 import tempfile
-import yaml
+import threading
+import time
 
 from oslo_log import log as logging
 import requests
+from urllib3 import connectionpool
 
 from magnum_capi_helm import conf
+from magnum_capi_helm import deadline
+from magnum_capi_helm import metrics
+from magnum_capi_helm import serialization
 
 
 LOG = logging.getLogger(__name__)
 CONF = conf.CONF
 
+# Clients shared by all users in this process, keyed by kubeconfig path,
+# along with the modification time of the kubeconfig they were loaded from
+_shared_clients = {}
+# References held on each shared client
+_shared_client_refs = collections.Counter()
+# Shared clients replaced by a newer kubeconfig but still referenced
+_stale_clients = set()
+_shared_clients_lock = threading.Lock()
+
+# Read consistency modes, see read_consistency
+CONSISTENT_READ = "consistent"
+CACHED_READ = "cached"
+READ_CONSISTENCIES = (CONSISTENT_READ, CACHED_READ)
+# Read consistency of the current thread or asyncio task, see
+# read_consistency
+_consistency = contextvars.ContextVar("read_consistency", default=None)
+
+
+@contextlib.contextmanager
+def read_consistency(consistency):
+    """Use the given read consistency for reads in the current context.
+
+    The consistency applies to the current thread, or asyncio task and the
+    tasks it starts, so a scope held across an await does not leak into
+    other tasks on the event loop.
+
+    With CONSISTENT_READ, objects are always read from etcd through the
+    API server, bypassing any informer or snapshot stores. With
+    CACHED_READ, objects are read from a synced store if there is one,
+    otherwise from the API server watch cache, so may be slightly stale.
+    Outside of any scope, objects are read from a synced store if there is
+    one, otherwise from etcd. Reads can also set the consistency directly.
+    """
+    token = _consistency.set(consistency)
+    try:
+        yield
+    finally:
+        _consistency.reset(token)
+
+
+class CircuitOpen(requests.exceptions.ConnectionError):
+    """Requests fail fast while the API server is unreachable."""
+
+
+class CircuitBreaker:
+    """Stops sending requests to an API server that keeps failing.
+
+    After failure_threshold consecutive failed requests the circuit opens,
+    and requests fail immediately with CircuitOpen. Once reset_timeout
+    seconds have passed, the next request first probes the server. If the
+    probe succeeds the circuit closes, otherwise it stays open for another
+    reset_timeout. Only one probe is made at a time.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold, reset_timeout, clock=None):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._clock = clock or time.monotonic
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def check(self, probe):
+        """Raises CircuitOpen unless requests can be made.
+
+        probe is called to check the server when the circuit is due to be
+        tried again, and returns True if the server is ready.
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if (
+                self.state == self.HALF_OPEN
+                or self._clock() < self._opened_at + self.reset_timeout
+            ):
+                metrics.increment("api_circuit_rejected_requests")
+                raise CircuitOpen("Management cluster API is unavailable")
+            self.state = self.HALF_OPEN
+        try:
+            ready = probe()
+        except Exception:
+            LOG.debug("Management cluster API probe failed", exc_info=True)
+            ready = False
+        self.record(ready)
+        if not ready:
+            metrics.increment("api_circuit_rejected_requests")
+            raise CircuitOpen("Management cluster API is unavailable")
+
+    def record(self, success):
+        """Records the outcome of a request."""
+        with self._lock:
+            if success:
+                if self.state != self.CLOSED:
+                    LOG.info("Management cluster API is available again")
+                self.state = self.CLOSED
+                self._failures = 0
+                return
+            self._failures += 1
+            if (
+                self.state == self.HALF_OPEN
+                or self._failures >= self.failure_threshold
+            ):
+                if self.state == self.CLOSED:
+                    LOG.warning(
+                        "Management cluster API failed %d times, failing "
+                        "requests for %ds",
+                        self._failures,
+                        self.reset_timeout,
+                    )
+                    metrics.increment("api_circuit_opened")
+                self.state = self.OPEN
+                self._opened_at = self._clock()
+
+
+class RateLimiter:
+    """Token bucket allowing qps requests per second, after a burst.
+
+    Each request takes a token, and waits for it if the bucket is empty.
+    Tokens are reserved in order, so waiting requests are not starved.
+    """
+
+    def __init__(self, qps, burst, clock=None):
+        self.qps = qps
+        self.burst = burst
+        self._clock = clock or time.monotonic
+        self._tokens = burst
+        self._updated = self._clock()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Takes a token, returning the seconds until it can be used."""
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.qps
+            )
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.qps
+
+
+# Methods limited by the read rate limiter, all others are writes
+READ_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+# Methods that have the same effect however many times they are made.
+# PATCH is only idempotent when it is a server-side apply.
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+APPLY_PATCH_CONTENT_TYPE = "application/apply-patch+yaml"
+
+# The API server rejects a request with 429 before processing it, so any
+# request can be retried. Other statuses are only retried when idempotent.
+RETRY_ANY_STATUSES = {429}
+RETRY_IDEMPOTENT_STATUSES = {502, 503, 504}
+
+
+def is_idempotent(method, headers=None):
+    method = method.upper()
+    if method == "PATCH":
+        content_type = (headers or {}).get("Content-Type", "")
+        return content_type.startswith(APPLY_PATCH_CONTENT_TYPE)
+    return method in IDEMPOTENT_METHODS
+
+
+def retry_after(headers):
+    """Returns the seconds given by a Retry-After header, or None."""
+    try:
+        return max(float(headers.get("Retry-After")), 0)
+    except (TypeError, ValueError):
+        # The API server does not send HTTP dates, so they are ignored
+        return None
+
+
+def accept_encoding(verb):
+    """Returns the Accept-Encoding to request for a Kubernetes verb."""
+    if verb in CONF.capi_helm.api_compression_verbs:
+        return "gzip"
+    return "identity"
+
+
+def encoding_headers(verb):
+    """Returns the headers negotiating compression for a Kubernetes verb.
+
+    The session headers have the encoding for gets, so a header is only
+    needed for other verbs when they are configured differently.
+    """
+    encoding = accept_encoding(verb)
+    if encoding == accept_encoding("get"):
+        return {}
+    return {"Accept-Encoding": encoding}
+
+
+class RetryPolicy:
+    """Decides whether to retry a failed request, and when.
+
+    Retries wait for a random time up to an exponentially increasing
+    limit, or for as long as the server asks with Retry-After.
+    """
+
+    def __init__(self, max_retries, backoff, max_backoff):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    @classmethod
+    def from_config(cls):
+        return cls(
+            CONF.capi_helm.api_max_retries,
+            CONF.capi_helm.api_retry_backoff,
+            CONF.capi_helm.api_retry_max_backoff,
+        )
+
+    def delay(self, attempt, method, headers=None, response=None):
+        """Returns the seconds to wait before retrying, or None.
+
+        attempt is the number of retries already made. response is None
+        when the request failed without a response.
+        """
+        if attempt >= self.max_retries:
+            return None
+        status_code = response.status_code if response is not None else None
+        if status_code not in RETRY_ANY_STATUSES:
+            if (
+                status_code is not None
+                and status_code not in RETRY_IDEMPOTENT_STATUSES
+            ):
+                return None
+            if not is_idempotent(method, headers):
+                return None
+        delay = None
+        if response is not None:
+            delay = retry_after(response.headers)
+        if delay is not None:
+            delay = min(delay, self.max_backoff)
+        else:
+            delay = random.uniform(
+                0, min(self.max_backoff, self.backoff * 2**attempt)
+            )
+        # Give up now rather than retry after the deadline
+        left = deadline.remaining()
+        if left is not None and delay >= left:
+            return None
+        return delay
+
+
+class SingleFlight:
+    """Shares the result of a call between the threads making it at once.
+
+    The first thread to call with a key makes the call, and any others
+    calling with the same key before it returns wait for it and receive
+    the same result or exception.
+    """
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = self._Call()
+                leader = True
+            else:
+                leader = False
+        if not leader:
+            metrics.increment("api_requests_collapsed")
+            if not call.done.wait(deadline.timeout(None)):
+                raise deadline.DeadlineExceeded("Operation deadline exceeded")
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+def _load_cert_chain(context, cert_data, key_data):
+    """Loads a client certificate and key from PEM data into the context.
+
+    SSLContext can only load a certificate chain from a file. On Linux the
+    data is passed using an anonymous memory file, so it is never written
+    to disk. Elsewhere, a private temporary file is used and removed once
+    the chain is loaded.
+    """
+    data = cert_data.rstrip(b"\n") + b"\n" + key_data
+    if hasattr(os, "memfd_create"):
+        fd = os.memfd_create("kubeconfig-tls", os.MFD_CLOEXEC)
+        try:
+            with open(fd, "wb", closefd=False) as fp:
+                fp.write(data)
+            context.load_cert_chain(f"/proc/self/fd/{fd}")
+        finally:
+            os.close(fd)
+    else:
+        with tempfile.NamedTemporaryFile() as fp:
+            fp.write(data)
+            fp.flush()
+            context.load_cert_chain(fp.name)
+
+
+@functools.lru_cache(maxsize=8)
+def tls_context(ca_data=None, ca_file=None, cert_data=None, key_data=None):
+    """Returns an SSLContext for the given kubeconfig TLS credentials.
+
+    Contexts are cached, so every client using the same credentials shares
+    one context, and its loaded certificates and TLS session cache.
+    """
+    context = ssl.create_default_context(
+        cafile=ca_file, cadata=ca_data.decode() if ca_data else None
+    )
+    if cert_data and key_data:
+        _load_cert_chain(context, cert_data, key_data)
+    return context
+
+
+class _MeteredPoolMixin:
+    """Connection pool recording its utilisation in metrics.
+
+    Connections left idle for longer than idle_timeout are closed rather
+    than reused, as the server or a load balancer may already have dropped
+    them. The metrics recorded are:
+
+    * api_pool_connections_created and api_pool_connections_reused
+    * api_pool_connections_discarded, when returned to a full pool
+    * api_pool_connections_idle_closed
+    * api_pool_peak_in_use, the most connections in use at once
+    * api_pool_wait, the time spent waiting for a connection when the
+      pool is blocking
+    """
+
+    def __init__(self, *args, idle_timeout=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.idle_timeout = idle_timeout
+        self.in_use = 0
+        self._in_use_lock = threading.Lock()
+
+    def _new_conn(self):
+        metrics.increment("api_pool_connections_created")
+        return super()._new_conn()
+
+    def _get_conn(self, timeout=None):
+        if self.block and timeout is None:
+            # Never wait for a connection longer than for a new one
+            timeout = deadline.timeout(CONF.capi_helm.api_connect_timeout)
+        start = time.monotonic()
+        conn = super()._get_conn(timeout=timeout)
+        now = time.monotonic()
+        if self.block and now - start >= 0.001:
+            metrics.observe("api_pool_wait", now - start)
+        reused = getattr(conn, "sock", None) is not None
+        idle = now - getattr(conn, "released_at", now)
+        if reused and self.idle_timeout and idle > self.idle_timeout:
+            metrics.increment("api_pool_connections_idle_closed")
+            conn.close()
+        elif reused:
+            metrics.increment("api_pool_connections_reused")
+        with self._in_use_lock:
+            self.in_use += 1
+            metrics.maximum("api_pool_peak_in_use", self.in_use)
+        return conn
+
+    def _put_conn(self, conn):
+        with self._in_use_lock:
+            self.in_use -= 1
+        if conn is not None:
+            conn.released_at = time.monotonic()
+        if self.pool is not None and self.pool.full():
+            metrics.increment("api_pool_connections_discarded")
+        super()._put_conn(conn)
+
+
+class MeteredHTTPConnectionPool(
+    _MeteredPoolMixin, connectionpool.HTTPConnectionPool
+):
+    pass
+
+
+class MeteredHTTPSConnectionPool(
+    _MeteredPoolMixin, connectionpool.HTTPSConnectionPool
+):
+    pass
+
+
+class Response(requests.Response):
+    """Response decoding JSON with the serialization backend.
+
+    The bytes received, which may be compressed, and the bytes decoded
+    from them are recorded in the api_response_bytes_received and
+    api_response_bytes_decoded metrics.
+    """
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        if self._content_consumed:
+            # Served from the content already read and recorded
+            yield from super().iter_content(chunk_size, decode_unicode)
+            return
+        decoded = 0
+        try:
+            for chunk in super().iter_content(chunk_size, decode_unicode):
+                decoded += len(chunk)
+                yield chunk
+        finally:
+            metrics.increment("api_response_bytes_received", self.raw.tell())
+            metrics.increment("api_response_bytes_decoded", decoded)
+
+    def json(self, **kwargs):
+        if not kwargs and self.content:
+            try:
+                return serialization.json_loads(self.content)
+            except ValueError:
+                # Raise the usual error for requests
+                pass
+        return super().json(**kwargs)
+
+
+class PoolAdapter(requests.adapters.HTTPAdapter):
+    """Transport adapter using metered pools with an idle timeout.
+
+    Responses decode JSON with the serialization backend.
+    """
+
+    def __init__(self, idle_timeout=None, **kwargs):
+        self.idle_timeout = idle_timeout
+        super().__init__(**kwargs)
+
+    def _use_metered_pools(self, manager):
+        manager.pool_classes_by_scheme = {
+            "http": functools.partial(
+                MeteredHTTPConnectionPool, idle_timeout=self.idle_timeout
+            ),
+            "https": functools.partial(
+                MeteredHTTPSConnectionPool, idle_timeout=self.idle_timeout
+            ),
+        }
+        return manager
 
-class Client(requests.Session):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self._use_metered_pools(self.poolmanager)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        return self._use_metered_pools(
+            super().proxy_manager_for(proxy, **proxy_kwargs)
+        )
+
+    def build_response(self, req, resp):
+        response = super().build_response(req, resp)
+        response.__class__ = Response
+        return response
+
+
+class TLSAdapter(PoolAdapter):
+    """Transport adapter making all connections using an SSLContext."""
+
+    def __init__(self, ssl_context, **kwargs):
+        self.ssl_context = ssl_context
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["ssl_context"] = self.ssl_context
+        super().init_poolmanager(*args, **kwargs)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        proxy_kwargs["ssl_context"] = self.ssl_context
+        return super().proxy_manager_for(proxy, **proxy_kwargs)
+
+    def cert_verify(self, conn, url, verify, cert):
+        # Verification and client certificates are set by the context, so
+        # the connections must not load the default CA bundle into it
+        pass
+
+
+class ResourceClient:
+    """Reads and writes of the resources used by the driver.
+
+    Subclasses provide the get, patch and delete requests, discovery,
+    get_store and coalesce used by the resources.
+    """
+
+    def ensure_namespace(self, namespace):
+        Namespace(self).apply(namespace)
+
+    def apply_secret(self, secret_name, data, namespace):
+        Secret(self).apply(secret_name, data, namespace)
+
+    def delete_all_secrets_by_label(self, label, value, namespace):
+        Secret(self).delete_all_by_label(label, value, namespace)
+
+    def get_secret(self, secret_name, namespace):
+        return Secret(self).fetch(secret_name, namespace)
+
+    def get_secret_data(self, secret_name, namespace):
+        secret = self.get_secret(secret_name, namespace)
+        if secret:
+            return {
+                key: base64.b64decode(value.encode()).decode()
+                for key, value in (secret.get("data") or {}).items()
+            }
+
+    def get_secret_value(self, secret_name, namespace, key):
+        secret = self.get_secret(secret_name, namespace)
+        if secret:
+            encoded_value = secret["data"][key].encode()
+            decoded_value = base64.b64decode(encoded_value).decode()
+            return decoded_value
+
+    def get_capi_cluster(self, name, namespace):
+        return Cluster(self).fetch(name, namespace)
+
+    def get_capi_openstackcluster(self, name, namespace):
+        return OpenstackCluster(self).fetch(name, namespace)
+
+    def get_k8s_control_plane(self, name, namespace):
+        return K8sControlPlane(self).fetch(name, namespace)
+
+    def get_machine_deployment(self, name, namespace):
+        return MachineDeployment(self).fetch(name, namespace)
+
+    def get_manifests_by_label(self, labels, namespace):
+        return list(Manifests(self).fetch_all_by_label(labels, namespace))
+
+    def get_helm_releases_by_label(self, labels, namespace):
+        return list(HelmRelease(self).fetch_all_by_label(labels, namespace))
+
+    def get_helm_chart_proxies_by_label(self, labels, namespace):
+        return list(HelmChartProxy(self).fetch_all_by_label(labels, namespace))
+
+    def get_addons_by_label(self, labels, namespace):
+        addons = []
+        try:
+            addons.extend(self.get_helm_releases_by_label(labels, namespace))
+            addons.extend(self.get_manifests_by_label(labels, namespace))
+        except requests.exceptions.HTTPError as e:
+            if e.response.status_code != 404:
+                raise
+
+        try:
+            addons.extend(
+                self.get_helm_chart_proxies_by_label(labels, namespace)
+            )
+        except requests.exceptions.HTTPError as e:
+            if e.response.status_code != 404:
+                raise
+
+        return addons
+
+    def iter_addons_by_label(self, labels, namespace):
+        """Yields the addons as they are listed.
+
+        Unlike get_addons_by_label, the caller can stop at any addon
+        without the remaining addons being fetched.
+        """
+        try:
+            yield from HelmRelease(self).fetch_all_by_label(labels, namespace)
+            yield from Manifests(self).fetch_all_by_label(labels, namespace)
+        except requests.exceptions.HTTPError as e:
+            if e.response.status_code != 404:
+                raise
+
+        try:
+            yield from HelmChartProxy(self).fetch_all_by_label(
+                labels, namespace
+            )
+        except requests.exceptions.HTTPError as e:
+            if e.response.status_code != 404:
+                raise
+
+    def get_all_machines_by_label(self, labels, namespace):
+        return list(Machine(self).fetch_all_by_label(labels, namespace))
+
+    def machines_exist_by_label(self, labels, namespace):
+        return Machine(self).exists_by_label(labels, namespace)
+
+    def count_machines_by_label(self, labels, namespace):
+        return Machine(self).count_by_label(labels, namespace)
+
+    def get_resource(self, api_version, kind, namespaced=True):
+        return GenericResource(self, api_version, kind, namespaced)
+
+    def apply_object(self, obj):
+        """Applies an object of any kind to the target cluster."""
+        metadata = obj["metadata"]
+        namespace = metadata.get("namespace")
+        resource = self.get_resource(
+            obj["apiVersion"], obj["kind"], bool(namespace)
+        )
+        return resource.apply(metadata["name"], obj, namespace)
+
+
+class Client(requests.Session, ResourceClient):
     """Object for producing Kubernetes clients."""
 
     KUBECONFIG_ENV_NAME = "KUBECONFIG"
 
     def __init__(self, kubeconfig):
         super().__init__()
-        self._tempfiles = []
+        self._informers = {}
+        self._informers_lock = threading.Lock()
+        self._singleflight = SingleFlight()
+        # Counts the writes made, see coalesce
+        self._writes = 0
+        self.discovery = Discovery(self)
+        self.retry_policy = RetryPolicy.from_config()
+        self.circuit_breaker = None
+        if CONF.capi_helm.api_circuit_failure_threshold:
+            self.circuit_breaker = CircuitBreaker(
+                CONF.capi_helm.api_circuit_failure_threshold,
+                CONF.capi_helm.api_circuit_reset_timeout,
+            )
+        self._rate_limiters = {}
+        for verb in ("read", "write"):
+            qps = getattr(CONF.capi_helm, f"api_{verb}_qps")
+            if qps:
+                self._rate_limiters[verb] = RateLimiter(
+                    qps, getattr(CONF.capi_helm, f"api_{verb}_burst")
+                )
         cluster, user = self._get_cluster_and_user(kubeconfig)
 
         self.server = cluster["server"].rstrip("/")
-        ca_file = self.ensure_file_cert(cluster, "certificate-authority")
-        if ca_file:
-            self.verify = ca_file
+        self.ssl_context = None
+        ca_data = self._get_data(cluster, "certificate-authority")
+        cert_data = self._get_data(user, "client-certificate")
+        key_data = self._get_data(user, "client-key")
+        has_client_cert = bool(
+            cert_data or user.get("client-certificate")
+        ) and bool(key_data or user.get("client-key"))
+        if ca_data or cert_data or key_data:
+            # Credentials embedded in the kubeconfig are loaded into an
+            # SSLContext in memory, along with any given as files
+            if has_client_cert:
+                cert_data = cert_data or self._read(user["client-certificate"])
+                key_data = key_data or self._read(user["client-key"])
+            self.ssl_context = tls_context(
+                ca_data,
+                cluster.get("certificate-authority"),
+                cert_data if has_client_cert else None,
+                key_data if has_client_cert else None,
+            )
+        else:
+            # Files are used directly by requests
+            if "certificate-authority" in cluster:
+                self.verify = cluster["certificate-authority"]
+            if has_client_cert:
+                self.cert = (user["client-certificate"], user["client-key"])
+
+        # Size the pools for the many threads sharing the client
+        pool_options = dict(
+            pool_maxsize=CONF.capi_helm.api_pool_maxsize,
+            pool_block=CONF.capi_helm.api_pool_block,
+            idle_timeout=CONF.capi_helm.api_pool_idle_timeout or None,
+        )
+        self.mount("http://", PoolAdapter(**pool_options))
+        if self.ssl_context is not None:
+            self.mount(
+                "https://", TLSAdapter(self.ssl_context, **pool_options)
+            )
+        else:
+            self.mount("https://", PoolAdapter(**pool_options))
 
-        # convert certs into files as required by requests
-        # https://requests.readthedocs.io/en/latest/api/#requests.Session.cert
+        if not has_client_cert:
+            if not user.get("token"):
+                raise Exception(
+                    "No supported authentication method found in kubeconfig"
+                )
+            self.headers.update({"Authorization": f"Bearer {user['token']}"})
+        # Large responses are compressed by the API server if asked
+        self.headers["Accept-Encoding"] = accept_encoding("get")
 
-        client_cert = self.ensure_file_cert(user, "client-certificate")
-        client_key = self.ensure_file_cert(user, "client-key")
+    @staticmethod
+    def _get_data(obj, key):
+        """Returns the decoded "<key>-data" of a kubeconfig entry, if any."""
+        data = obj.get(f"{key}-data")
+        return base64.standard_b64decode(data) if data else None
 
-        if client_cert and client_key:
-            self.cert = (client_cert, client_key)
-        elif user.get("token"):
-            self.headers.update({"Authorization": f"Bearer {user['token']}"})
-        else:
-            raise Exception(
-                "No supported authentication method found in kubeconfig"
-            )
+    @staticmethod
+    def _read(path):
+        with open(path, "rb") as fp:
+            return fp.read()
 
-    def ensure_file_cert(self, obj, file_key):
-        """Returns the path of cert.
+    def tls_context(self):
+        """Returns an SSLContext with the TLS credentials for the server.
 
-        Returns a string containing the path to a file with the requesteddata.
-        First check if there is a file path already,
-        if the data is there, put it in a file, add path to the _tempfiles
-        list for cleanup and return the created file.
+        This is the context used for requests if the kubeconfig embeds its
+        credentials. Otherwise, one is loaded from the files it references.
         """
-        if file_key in obj:
-            return obj[file_key]
-
-        data_key = file_key + "-data"
-        if data_key in obj:
-            # NOTE(dalees): The created file may contain private key material
-            # but is owned by the current user and mode 0600.
-            # See also: tempfile.mkstemp
-            # In Python 3.12, cleanup may be improved with
-            # delete=True,delete_on_close=False
-            with tempfile.NamedTemporaryFile(delete=False) as fd:
-                fd.write(base64.standard_b64decode(obj[data_key]))
-                self._tempfiles.append(fd.name)
-            return fd.name
+        if self.ssl_context is not None:
+            return self.ssl_context
+        cert_data = key_data = None
+        if self.cert:
+            cert_data, key_data = (self._read(path) for path in self.cert)
+        return tls_context(
+            ca_file=self.verify if isinstance(self.verify, str) else None,
+            cert_data=cert_data,
+            key_data=key_data,
+        )
+
+    def get_store(self, resource):
+        """Returns the synced informer store for the resource, if any.
+
+        Informers are only started for the kinds listed in the config
+        [capi_helm]/informer_resources, or when requested using
+        get_informer. The informer for a kind is started the first time it
+        is requested, and None is returned until it has completed its
+        initial list.
+        """
+        kind = type(resource).__name__
+        with self._informers_lock:
+            informer = self._informers.get(kind)
+        if informer is None:
+            if kind not in CONF.capi_helm.informer_resources:
+                return None
+            informer = self.get_informer(type(resource))
+        if informer.store.synced:
+            return informer.store
         return None
 
-    def __del__(self):
-        # Remove any temporary certificate files this class owns.
-        for file_path in self._tempfiles:
-            try:
-                os.remove(file_path)
-            except (OSError, FileNotFoundError):
-                pass
-        self._tempfiles = []
+    def get_informer(self, resource_cls, handler=None):
+        """Returns the informer for the resource, starting it if required.
+
+        If given, the handler is called with the event type and object for
+        every change seen by the informer.
+        """
+        kind = resource_cls.__name__
+        with self._informers_lock:
+            informer = self._informers.get(kind)
+            if informer is None:
+                informer = Informer(resource_cls(self))
+                self._informers[kind] = informer
+                if handler:
+                    informer.add_handler(handler)
+                informer.start()
+            elif handler:
+                informer.add_handler(handler)
+        return informer
+
+    def stop_informers(self):
+        with self._informers_lock:
+            informers = list(self._informers.values())
+            self._informers = {}
+        for informer in informers:
+            informer.stop()
 
     def _get_cluster_and_user(self, kubeconfig):
         # get the context
@@ -126,7 +835,7 @@ class Client(requests.Session):
     @classmethod
     def _load_kubeconfig(cls, path):
         with open(path) as fd:
-            return yaml.safe_load(fd)
+            return serialization.yaml_load(fd)
 
     @classmethod
     def load(cls):
@@ -134,83 +843,562 @@ class Client(requests.Session):
         kubeconfig = cls._load_kubeconfig(path)
         return Client(kubeconfig)
 
+    @classmethod
+    def _get_kubeconfig_mtime(cls, path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    @classmethod
+    def shared(cls):
+        """Returns the process-wide client for the configured kubeconfig.
+
+        The same client, and so its pool of keep-alive connections, is
+        returned to every caller until the kubeconfig file is modified.
+        Each call takes a reference that must be given back with release().
+        A client replaced by a newer kubeconfig is closed when its last
+        reference is released.
+        """
+        path = str(cls._get_kubeconfig_path())
+        mtime = cls._get_kubeconfig_mtime(path)
+        with _shared_clients_lock:
+            loaded_mtime, client = _shared_clients.get(path, (None, None))
+            if client is None or loaded_mtime != mtime:
+                if client is not None:
+                    LOG.info("Reloading changed kubeconfig %s", path)
+                    if _shared_client_refs[client]:
+                        _stale_clients.add(client)
+                    else:
+                        client.close()
+                client = cls.load()
+                _shared_clients[path] = (mtime, client)
+            _shared_client_refs[client] += 1
+            return client
+
+    def release(self):
+        """Gives back a reference taken by Client.shared()."""
+        with _shared_clients_lock:
+            _shared_client_refs[self] -= 1
+            if _shared_client_refs[self] > 0:
+                return
+            del _shared_client_refs[self]
+            if self in _stale_clients:
+                _stale_clients.discard(self)
+                self.close()
+
+    def close(self):
+        self.stop_informers()
+        super().close()
+
+    def rate_limit_delay(self, method):
+        """Returns the seconds to wait before making a request.
+
+        The time spent waiting is recorded in the api_read_rate_limit_wait
+        and api_write_rate_limit_wait metrics. Raises DeadlineExceeded,
+        rather than waiting, if the request could not start before the
+        deadline of the current operation.
+        """
+        verb = "read" if method.upper() in READ_METHODS else "write"
+        limiter = self._rate_limiters.get(verb)
+        delay = limiter.reserve() if limiter else 0
+        if not delay:
+            return 0
+        left = deadline.remaining()
+        if left is not None and delay >= left:
+            raise deadline.DeadlineExceeded(
+                f"{method} request rate limited for {delay:.3f}s, "
+                "past the deadline"
+            )
+        metrics.observe(f"api_{verb}_rate_limit_wait", delay)
+        return delay
+
+    def probe_ready(self):
+        """Returns True if the API server reports that it is ready."""
+        connect_timeout, _ = self.request_timeout()
+        # Bypasses the rate limits, retries and circuit breaker
+        response = super().request(
+            "GET", f"{self.server}/readyz", timeout=connect_timeout
+        )
+        with response:
+            return response.status_code == 200
+
     def request(self, method, url, *args, **kwargs):
         # Make sure to add the server to any relative URLs
         if re.match(r"^http(s)://", url) is None:
             url = "{}{}".format(self.server, url)
-        response = super().request(method, url, *args, **kwargs)
-        LOG.debug(
-            'Kubernetes API request: "%s %s" %s',
+        breaker = self.circuit_breaker
+        if breaker is None:
+            return self._request(method, url, *args, **kwargs)
+        breaker.check(self.probe_ready)
+        try:
+            response = self._request(method, url, *args, **kwargs)
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+        ):
+            breaker.record(False)
+            raise
+        breaker.record(response.status_code not in RETRY_IDEMPOTENT_STATUSES)
+        return response
+
+    def _request(self, method, url, *args, **kwargs):
+        headers = kwargs.get("headers")
+        attempt = 0
+        while True:
+            delay = self.rate_limit_delay(method)
+            if delay:
+                LOG.debug("Rate limited %s request for %.3fs", method, delay)
+                time.sleep(delay)
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except requests.exceptions.SSLError:
+                raise
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+            ) as e:
+                if deadline.passed():
+                    raise deadline.DeadlineExceeded(
+                        f"{method} {url} did not finish before the deadline"
+                    ) from e
+                delay = self.retry_policy.delay(attempt, method, headers)
+                if delay is None:
+                    raise
+                reason = type(e).__name__
+            else:
+                LOG.debug(
+                    'Kubernetes API request: "%s %s" %s',
+                    method,
+                    url,
+                    response.status_code,
+                )
+                delay = self.retry_policy.delay(
+                    attempt, method, headers, response
+                )
+                if delay is None:
+                    return response
+                reason = response.status_code
+                response.close()
+            attempt += 1
+            self.retry_wait(method, url, reason, attempt, delay)
+            time.sleep(delay)
+
+    def send(self, request, **kwargs):
+        kwargs["timeout"] = self.request_timeout(kwargs.get("timeout"))
+        try:
+            return super().send(request, **kwargs)
+        finally:
+            if request.method not in READ_METHODS:
+                self._writes += 1
+
+    def coalesce(self, key, func):
+        """Calls func, sharing the result with concurrent calls for key.
+
+        Used for reads, so that threads fetching the same object at once
+        make a single request. Callers must not modify the result. A read
+        started after a write by this client never shares the result of
+        a read started before the write finished.
+        """
+        if not CONF.capi_helm.api_coalesce_reads:
+            return func()
+        return self._singleflight.do((self._writes,) + key, func)
+
+    def request_timeout(self, timeout=None):
+        """Returns the (connect, read) timeout to use for a request.
+
+        The timeouts are limited to the time remaining before the
+        deadline of the current operation, see deadline.scope.
+        """
+        if timeout is None:
+            timeout = (
+                CONF.capi_helm.api_connect_timeout,
+                CONF.capi_helm.api_read_timeout,
+            )
+        elif not isinstance(timeout, tuple):
+            timeout = (timeout, timeout)
+        return tuple(deadline.timeout(value) for value in timeout)
+
+    def retry_wait(self, method, url, reason, attempt, delay):
+        """Records a retry, in the api_request_retry_wait metric."""
+        LOG.warning(
+            'Retrying Kubernetes API request "%s %s" after %s in %.2fs '
+            "(retry %d)",
             method,
             url,
-            response.status_code,
+            reason,
+            delay,
+            attempt,
         )
-        return response
+        metrics.observe("api_request_retry_wait", delay)
+
+
+class ListDecoder:
+    """Incrementally decodes a Kubernetes list from chunks of JSON.
+
+    Iterating yields each item of the list as soon as it has been
+    received, so the whole list is never held in memory. The other fields
+    of the list, e.g. the metadata, are available from fields once the
+    items have been consumed.
+    """
+
+    _whitespace = re.compile(r"[ \t\n\r]*")
+    _delimiters = frozenset(" \t\n\r,:]}")
+
+    def __init__(self, chunks):
+        self.fields = {}
+        self._chunks = iter(chunks)
+        self._decoder = json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+
+    def _read(self):
+        """Reads the next chunk, returning False at the end of the data."""
+        if self._eof:
+            return False
+        try:
+            text = self._text_decoder.decode(next(self._chunks))
+        except StopIteration:
+            self._eof = True
+            text = self._text_decoder.decode(b"", final=True)
+        # Drop the data that has already been decoded
+        pos, self._pos = self._pos, 0
+        self._buffer = self._buffer[pos:] + text
+        return True
+
+    def _peek(self):
+        while True:
+            self._pos = self._whitespace.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._read():
+                raise ValueError("Unexpected end of list")
+
+    def _consume(self, allowed):
+        char = self._peek()
+        if char not in allowed:
+            raise ValueError(f"Unexpected {char!r} in list")
+        self._pos += 1
+        return char
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                # The value may not have been received in full yet
+                if self._read():
+                    continue
+                raise
+            # A number may continue in the next chunk, in which case it is
+            # not yet followed by a delimiter
+            if (
+                end == len(self._buffer)
+                or self._buffer[end] not in self._delimiters
+            ) and self._read():
+                continue
+            self._pos = end
+            return value
+
+    def _items(self):
+        if self._peek() == "n":
+            # null
+            self._value()
+            return
+        self._consume("[")
+        if self._peek() == "]":
+            self._pos += 1
+            return
+        while True:
+            yield self._value()
+            if self._consume(",]") == "]":
+                return
+
+    def __iter__(self):
+        self._consume("{")
+        if self._peek() == "}":
+            return
+        while True:
+            key = self._value()
+            self._consume(":")
+            if key == "items":
+                yield from self._items()
+            else:
+                self.fields[key] = self._value()
+            if self._consume(",}") == "}":
+                return
+
+
+# Size of the chunks read from streamed list responses
+LIST_CHUNK_SIZE = 64 * 1024
+
+
+def list_page_params(params):
+    """Returns the parameters for the first and the continued list pages.
+
+    The continue token is to be added to the parameters for continued
+    pages, which are read at the resourceVersion of the first page.
+    """
+    params = dict(params)
+    if CONF.capi_helm.list_page_size and "limit" not in params:
+        params["limit"] = CONF.capi_helm.list_page_size
+    continue_params = {
+        k: v
+        for k, v in params.items()
+        if k not in {"resourceVersion", "resourceVersionMatch"}
+    }
+    return params, continue_params
+
+
+def iter_list(client, path, params, fields=None, **kwargs):
+    """Yields the items of a list, following continue tokens.
+
+    Pages of up to [capi_helm]/list_page_size items are requested, and the
+    items are decoded as they are received. Stopping iteration early
+    closes the response and skips any remaining pages. If given, fields
+    is updated with the other fields of the last page, e.g. its metadata.
+    """
+    params, continue_params = list_page_params(params)
+    fields = {} if fields is None else fields
+    encoding = encoding_headers("list")
+    if encoding:
+        kwargs["headers"] = {**kwargs.get("headers", {}), **encoding}
+    page_params = params
+    while True:
+        response = client.get(path, params=page_params, stream=True, **kwargs)
+        try:
+            response.raise_for_status()
+            decoder = ListDecoder(response.iter_content(LIST_CHUNK_SIZE))
+            yield from decoder
+        finally:
+            response.close()
+        fields.clear()
+        fields.update(decoder.fields)
+        continue_token = fields.get("metadata", {}).get("continue")
+        if not continue_token:
+            break
+        page_params = {**continue_params, "continue": continue_token}
 
-    def ensure_namespace(self, namespace):
-        Namespace(self).apply(namespace)
 
-    def apply_secret(self, secret_name, data, namespace):
-        Secret(self).apply(secret_name, data, namespace)
+@functools.lru_cache(maxsize=1)
+def _parse_api_resources(api_resources):
+    return json.loads(api_resources)
 
-    def delete_all_secrets_by_label(self, label, value, namespace):
-        Secret(self).delete_all_by_label(label, value, namespace)
 
-    def get_secret(self, secret_name, namespace):
-        return Secret(self).fetch(secret_name, namespace)
+def api_resource_overrides(kind):
+    """Returns the [capi_helm]/api_resources overrides for a kind."""
+    return _parse_api_resources(CONF.capi_helm.api_resources).get(kind, {})
 
-    def get_secret_value(self, secret_name, namespace, key):
-        secret = self.get_secret(secret_name, namespace)
-        if secret:
-            encoded_value = secret["data"][key].encode()
-            decoded_value = base64.b64decode(encoded_value).decode()
-            return decoded_value
 
-    def get_capi_cluster(self, name, namespace):
-        return Cluster(self).fetch(name, namespace)
+_VERSION_RE = re.compile(r"^v(\d+)(?:(alpha|beta)(\d+))?$")
 
-    def get_capi_openstackcluster(self, name, namespace):
-        return OpenstackCluster(self).fetch(name, namespace)
 
-    def get_k8s_control_plane(self, name, namespace):
-        return K8sControlPlane(self).fetch(name, namespace)
+def version_priority(version):
+    """Sort key giving the Kubernetes priority of an API version.
 
-    def get_machine_deployment(self, name, namespace):
-        return MachineDeployment(self).fetch(name, namespace)
+    GA versions are newer than beta versions, which are newer than alpha
+    versions, then higher numbers are newer, e.g. v1 > v1beta2 > v1alpha1.
+    """
+    match = _VERSION_RE.match(version)
+    if not match:
+        return (0, 0, 0)
+    major, level, minor = match.groups()
+    return (
+        {None: 3, "beta": 2, "alpha": 1}[level],
+        int(major),
+        int(minor or 0),
+    )
 
-    def get_manifests_by_label(self, labels, namespace):
-        return list(Manifests(self).fetch_all_by_label(labels, namespace))
 
-    def get_helm_releases_by_label(self, labels, namespace):
-        return list(HelmRelease(self).fetch_all_by_label(labels, namespace))
+class Discovery:
+    """Cache of the API group versions served by the target cluster.
 
-    def get_helm_chart_proxies_by_label(self, labels, namespace):
-        return list(HelmChartProxy(self).fetch_all_by_label(labels, namespace))
+    The groups are discovered from /apis, using aggregated discovery if
+    the server supports it so that a single request is needed. They are
+    cached for [capi_helm]/api_discovery_ttl, after which they are
+    discovered again on next use.
+    """
 
-    def get_addons_by_label(self, labels, namespace):
-        addons = []
-        try:
-            addons.extend(self.get_helm_releases_by_label(labels, namespace))
-            addons.extend(self.get_manifests_by_label(labels, namespace))
-        except requests.exceptions.HTTPError as e:
-            if e.response.status_code != 404:
-                raise
+    # Resolved for kinds that are not served, e.g. as the CRD is missing
+    ABSENT = object()
 
-        try:
-            addons.extend(
-                self.get_helm_chart_proxies_by_label(labels, namespace)
-            )
-        except requests.exceptions.HTTPError as e:
-            if e.response.status_code != 404:
-                raise
+    AGGREGATED_ACCEPT = (
+        "application/json;g=apidiscovery.k8s.io;v=v2;as=APIGroupDiscoveryList,"
+        "application/json;g=apidiscovery.k8s.io;v=v2beta1;"
+        "as=APIGroupDiscoveryList,"
+        "application/json"
+    )
 
-        return addons
+    def __init__(self, client):
+        self.client = client
+        self._lock = threading.Lock()
+        self._expires = 0
+        # Versions of each group, newest first
+        self._groups = None
+        # Plural names served by each group version, fetched on demand
+        # unless given by aggregated discovery
+        self._resources = {}
+        # Group and plural names found missing since the last discovery
+        self._absent = set()
+
+    def _discover(self):
+        response = self.client.get(
+            "/apis", headers={"Accept": self.AGGREGATED_ACCEPT}
+        )
+        response.raise_for_status()
+        data = response.json()
+        groups = {}
+        resources = {}
+        if data.get("kind") == "APIGroupDiscoveryList":
+            for item in data.get("items") or []:
+                group = item["metadata"]["name"]
+                for version in item.get("versions") or []:
+                    groups.setdefault(group, []).append(version["version"])
+                    resources[f"{group}/{version['version']}"] = {
+                        resource["resource"]: (
+                            (resource.get("responseKind") or {}).get("kind"),
+                            resource.get("scope") != "Cluster",
+                        )
+                        for resource in version.get("resources") or []
+                    }
+        else:
+            for item in data.get("groups") or []:
+                groups[item["name"]] = [
+                    version["version"] for version in item["versions"]
+                ]
+        for versions in groups.values():
+            versions.sort(key=version_priority, reverse=True)
+        metrics.increment("api_discovery")
+        self._groups = groups
+        self._resources = resources
+        self._absent = set()
+
+    def _served(self, group_version):
+        # The kind and whether it is namespaced for each plural name
+        if group_version not in self._resources:
+            prefix = "/apis" if "/" in group_version else "/api"
+            response = self.client.get(f"{prefix}/{group_version}")
+            if response.status_code == 404:
+                plurals = {}
+            else:
+                response.raise_for_status()
+                plurals = {
+                    resource["name"]: (
+                        resource.get("kind"),
+                        resource.get("namespaced", True),
+                    )
+                    for resource in response.json().get("resources") or []
+                }
+            self._resources[group_version] = plurals
+        return self._resources[group_version]
+
+    def _refresh(self):
+        # Returns False if discovery is disabled or failed, must be called
+        # with the lock held
+        ttl = CONF.capi_helm.api_discovery_ttl
+        if not ttl:
+            return False
+        now = time.monotonic()
+        if now >= self._expires:
+            # Until the next discovery, even if this one fails
+            self._expires = now + ttl
+            self._groups = None
+            self._discover()
+        return self._groups is not None
+
+    def resolve(self, api_version, plural_name):
+        """Returns the served version of a resource.
+
+        The given api_version is returned if it serves the resource, as the
+        driver parses objects using its schema. Otherwise the newest version
+        of the group serving the resource is returned, or ABSENT if there is
+        none. None is returned if discovery is disabled or failed, in which
+        case the given version should be used.
+        """
+        with self._lock:
+            try:
+                if not self._refresh():
+                    return None
+                group, _, preferred = api_version.rpartition("/")
+                if (group, plural_name) in self._absent:
+                    return self.ABSENT
+                versions = self._groups.get(group, [])
+                if preferred in versions:
+                    versions = [preferred] + versions
+                for version in versions:
+                    if plural_name in self._served(f"{group}/{version}"):
+                        return f"{group}/{version}"
+            except (
+                requests.exceptions.RequestException,
+                ValueError,
+                KeyError,
+            ):
+                LOG.warning(
+                    "API discovery failed, using the default API versions",
+                    exc_info=True,
+                )
+                return None
+            return self.ABSENT
+
+    def _find_kind(self, api_version, kind):
+        # The plural name of a kind and whether it is namespaced, or None
+        with self._lock:
+            try:
+                if not self._refresh():
+                    return None
+                for plural_name, (served_kind, namespaced) in self._served(
+                    api_version
+                ).items():
+                    # Subresources, e.g. deployments/status, share the kind
+                    if served_kind == kind and "/" not in plural_name:
+                        return plural_name, namespaced
+            except (
+                requests.exceptions.RequestException,
+                ValueError,
+                KeyError,
+            ):
+                LOG.warning("API discovery failed", exc_info=True)
+            return None
 
-    def get_all_machines_by_label(self, labels, namespace):
-        return list(Machine(self).fetch_all_by_label(labels, namespace))
+    def is_namespaced(self, api_version, kind):
+        """Returns whether objects of a kind are namespaced.
+
+        None is returned if the kind is not served, or if discovery is
+        disabled or failed.
+        """
+        found = self._find_kind(api_version, kind)
+        return found[1] if found else None
+
+    def plural_name(self, api_version, kind):
+        """Returns the plural name of a kind.
+
+        None is returned if the kind is not served, or if discovery is
+        disabled or failed.
+        """
+        found = self._find_kind(api_version, kind)
+        return found[0] if found else None
+
+    def mark_absent(self, group, plural_name):
+        """Remember that a resource is not served until next discovery."""
+        with self._lock:
+            self._absent.add((group, plural_name))
 
 
 class Resource:
+    # Requests only the metadata of listed objects, falling back to the
+    # full objects if the server does not support partial metadata
+    METADATA_LIST_ACCEPT = (
+        "application/json;as=PartialObjectMetadataList;v=v1;g=meta.k8s.io,"
+        "application/json"
+    )
+
+    # Whether the served api_version is discovered, see Discovery, with
+    # api_version preferred when it is served
+    discovered = False
+
     def __init__(self, client):
         self.client = client
         assert hasattr(self, "api_version")
@@ -219,7 +1407,34 @@ class Resource:
             self, "plural_name", self.kind.lower() + "s"
         )
         self.namespaced = getattr(self, "namespaced", True)
-        self.api_resources = json.loads(CONF.capi_helm.api_resources)
+        # True if the resource is known not to be served
+        self.absent = False
+        if self.discovered:
+            self._resolve_api_version()
+
+    def _resolve_api_version(self):
+        overrides = api_resource_overrides(type(self).__name__)
+        self.plural_name = overrides.get("plural_name", self.plural_name)
+        if "api_version" in overrides:
+            self.api_version = overrides["api_version"]
+            return
+        discovery = getattr(self.client, "discovery", None)
+        if discovery is None:
+            return
+        api_version = discovery.resolve(self.api_version, self.plural_name)
+        if api_version is Discovery.ABSENT:
+            self.absent = True
+        elif api_version:
+            self.api_version = api_version
+
+    def _is_absent(self, consistency):
+        # Consistent reads always ask, e.g. in case the CRD was installed
+        # since the last discovery
+        if self.absent and consistency != CONSISTENT_READ:
+            # Not served, so there is no need to ask
+            metrics.increment("absent_resource_requests_saved")
+            return True
+        return False
 
     def prepare_path(self, name=None, namespace=None):
         # Begin with either /api or /apis depending whether the api version
@@ -234,58 +1449,180 @@ class Resource:
             f"{self.plural_name}{path_name}"
         )
 
-    def fetch(self, name, namespace=None):
+    def _read_consistency(self, consistency):
+        if consistency is None:
+            consistency = _consistency.get()
+        assert consistency is None or consistency in READ_CONSISTENCIES
+        return consistency
+
+    def _get_store(self, consistency):
+        if consistency == CONSISTENT_READ:
+            return None
+        return self.client.get_store(self)
+
+    def fetch(self, name, namespace=None, consistency=None):
         """Fetches specified object from the target Kubernetes cluster.
 
-        If the object is not found, None is returned.
+        If the object is not found, None is returned. See read_consistency
+        for the consistency modes, which default to that of the thread.
         """
         assert self.namespaced == bool(namespace)
         assert name is not None
-        response = self.client.get(self.prepare_path(name, namespace))
-        if 200 <= response.status_code < 300:
-            return response.json()
-        elif response.status_code == 404:
+        consistency = self._read_consistency(consistency)
+        if self._is_absent(consistency):
             return None
-        else:
-            response.raise_for_status()
-
-    def fetch_all_by_label(self, labels, namespace=None):
+        store = self._get_store(consistency)
+        if store is not None:
+            return store.get(name, namespace)
+        path = self.prepare_path(name, namespace)
+        kwargs = {}
+        if consistency == CACHED_READ:
+            # Served from the watch cache of the API server
+            kwargs["params"] = {"resourceVersion": "0"}
+
+        def get():
+            response = self.client.get(path, **kwargs)
+            if 200 <= response.status_code < 300:
+                return response.json()
+            elif response.status_code == 404:
+                return None
+            else:
+                response.raise_for_status()
+
+        return self.client.coalesce((path, consistency), get)
+
+    def fetch_all_by_label(self, labels, namespace=None, consistency=None):
         """Fetches objects matching the labels from the target cluster."""
         assert self.namespaced == bool(namespace)
-        label_selector = ",".join(f"{k}={v}" for k, v in labels.items())
-        continue_token = ""
-        while True:
-            params = {"labelSelector": label_selector}
-            if continue_token:
-                params["continue"] = continue_token
-            response = self.client.get(
-                self.prepare_path(namespace=namespace), params=params
+        consistency = self._read_consistency(consistency)
+        if self._is_absent(consistency):
+            return
+        store = self._get_store(consistency)
+        if store is not None:
+            yield from store.list_by_label(labels, namespace)
+            return
+        yield from self._list(labels, namespace, consistency)
+
+    def _list_params(self, labels, consistency=None, limit=None):
+        params = {
+            "labelSelector": ",".join(f"{k}={v}" for k, v in labels.items())
+        }
+        if consistency == CACHED_READ:
+            # Served from the watch cache of the API server
+            params["resourceVersion"] = "0"
+            params["resourceVersionMatch"] = "NotOlderThan"
+        if limit:
+            params["limit"] = limit
+        return params
+
+    def _list_failed(self, error):
+        # Listing only fails with not found if the resource is not served,
+        # so avoid asking again until the next discovery
+        discovery = getattr(self.client, "discovery", None)
+        if error.response.status_code == 404 and discovery is not None:
+            discovery.mark_absent(
+                self.api_version.split("/")[0], self.plural_name
             )
-            response.raise_for_status()
-            response_data = response.json()
-            yield from response_data["items"]
-            continue_token = response_data["metadata"]["continue"]
-            if not continue_token:
-                break
 
-    def apply(self, name, data=None, namespace=None):
-        """Applies the given object to the target Kubernetes cluster."""
+    def _list(
+        self,
+        labels,
+        namespace,
+        consistency=None,
+        limit=None,
+        metadata_only=False,
+    ):
+        kwargs = {}
+        if metadata_only:
+            kwargs["headers"] = {"Accept": self.METADATA_LIST_ACCEPT}
+        try:
+            yield from iter_list(
+                self.client,
+                self.prepare_path(namespace=namespace),
+                self._list_params(labels, consistency, limit),
+                **kwargs,
+            )
+        except requests.exceptions.HTTPError as e:
+            self._list_failed(e)
+            raise
+
+    def exists_by_label(self, labels, namespace=None, consistency=None):
+        """Returns True if any objects match the labels.
+
+        Only the metadata of the first matching object is requested.
+        """
+        assert self.namespaced == bool(namespace)
+        consistency = self._read_consistency(consistency)
+        if self._is_absent(consistency):
+            return False
+        store = self._get_store(consistency)
+        if store is not None:
+            objects = store.list_by_label(labels, namespace)
+            return next(objects, None) is not None
+        # Pages can be empty when filtering by label, so stop at the first
+        # object rather than after the first page
+        objects = self._list(
+            labels, namespace, consistency, limit=1, metadata_only=True
+        )
+        return next(objects, None) is not None
+
+    def count_by_label(self, labels, namespace=None, consistency=None):
+        """Returns the number of objects that match the labels.
+
+        Only the metadata of the matching objects is requested.
+        """
         assert self.namespaced == bool(namespace)
-        body_data = copy.deepcopy(data) if data else {}
+        consistency = self._read_consistency(consistency)
+        if self._is_absent(consistency):
+            return 0
+        store = self._get_store(consistency)
+        if store is not None:
+            return sum(1 for _ in store.list_by_label(labels, namespace))
+        return sum(
+            1
+            for _ in self._list(
+                labels, namespace, consistency, metadata_only=True
+            )
+        )
+
+    # Parameters for a server side apply
+    APPLY_PARAMS = {"fieldManager": "magnum", "force": "true"}
+    APPLY_HEADERS = {"Content-Type": APPLY_PATCH_CONTENT_TYPE}
+
+    def _apply_body(self, name, data, namespace):
+        # Only the top level and metadata are changed, so the data given
+        # is shared rather than copied in full
+        body_data = dict(data) if data else {}
         body_data["apiVersion"] = self.api_version
         body_data["kind"] = self.kind
-        body_data.setdefault("metadata", {})["name"] = name
+        metadata = body_data["metadata"] = dict(body_data.get("metadata", {}))
+        metadata["name"] = name
         if namespace:
-            body_data["metadata"]["namespace"] = namespace
+            metadata["namespace"] = namespace
+        return body_data
+
+    def apply(self, name, data=None, namespace=None):
+        """Applies the given object to the target Kubernetes cluster."""
+        assert self.namespaced == bool(namespace)
         response = self.client.patch(
             self.prepare_path(name, namespace),
-            json=body_data,
-            headers={"Content-Type": "application/apply-patch+yaml"},
-            params={"fieldManager": "magnum", "force": "true"},
+            json=self._apply_body(name, data, namespace),
+            headers=dict(self.APPLY_HEADERS),
+            params=dict(self.APPLY_PARAMS),
         )
         response.raise_for_status()
         return response.json()
 
+    def delete(self, name, namespace=None):
+        """Deletes the specified object from the target cluster.
+
+        Objects that do not exist are ignored.
+        """
+        assert self.namespaced == bool(namespace)
+        response = self.client.delete(self.prepare_path(name, namespace))
+        if response.status_code != 404:
+            response.raise_for_status()
+
     def delete_all_by_label(self, label, value, namespace=None):
         """Deletes all objects with the specified label from cluster."""
         assert self.namespaced == bool(namespace)
@@ -296,6 +1633,280 @@ class Resource:
         response.raise_for_status()
 
 
+class Store:
+    """Thread-safe in-memory copy of the objects of a single kind.
+
+    The store records the resourceVersion of the list or watch event it
+    was last updated from, so its contents are always a consistent view
+    of the collection as of that resourceVersion.
+
+    Objects are indexed by namespace and by the values of the labels in
+    INDEXED_LABELS, so that selecting the objects belonging to one
+    cluster does not scan the whole collection.
+
+    Objects returned from the store are shared and must not be modified.
+    """
+
+    INDEXED_LABELS = (
+        "capi.stackhpc.com/cluster",
+        "addons.stackhpc.com/cluster",
+        "cluster.x-k8s.io/cluster-name",
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._objects = {}
+        self._index = collections.defaultdict(set)
+        self.resource_version = None
+        self.synced = False
+
+    @staticmethod
+    def _key(obj):
+        metadata = obj["metadata"]
+        return metadata.get("namespace"), metadata["name"]
+
+    def _index_keys(self, key, obj):
+        labels = obj["metadata"].get("labels") or {}
+        yield key[0], None, None
+        for label in self.INDEXED_LABELS:
+            if label in labels:
+                yield key[0], label, labels[label]
+
+    def _add(self, obj):
+        key = self._key(obj)
+        self._remove(key)
+        self._objects[key] = obj
+        for index_key in self._index_keys(key, obj):
+            self._index[index_key].add(key)
+
+    def _remove(self, key):
+        obj = self._objects.pop(key, None)
+        if obj is None:
+            return
+        for index_key in self._index_keys(key, obj):
+            self._index[index_key].discard(key)
+            if not self._index[index_key]:
+                del self._index[index_key]
+
+    def replace(self, items, resource_version):
+        """Replaces the objects in the store.
+
+        Returns the objects that were removed.
+        """
+        with self._lock:
+            previous = self._objects
+            self._objects = {}
+            self._index = collections.defaultdict(set)
+            for obj in items:
+                self._add(obj)
+            self.resource_version = resource_version
+            self.synced = True
+            return [
+                obj
+                for key, obj in previous.items()
+                if key not in self._objects
+            ]
+
+    def update(self, obj):
+        with self._lock:
+            self._add(obj)
+            self.resource_version = obj["metadata"].get("resourceVersion")
+
+    def delete(self, obj):
+        with self._lock:
+            self._remove(self._key(obj))
+            self.resource_version = obj["metadata"].get("resourceVersion")
+
+    def get(self, name, namespace=None):
+        with self._lock:
+            return self._objects.get((namespace, name))
+
+    def list_by_label(self, labels, namespace=None):
+        with self._lock:
+            if namespace is None:
+                candidates = list(self._objects.values())
+            else:
+                index_key = (namespace, None, None)
+                for label in self.INDEXED_LABELS:
+                    if label in labels:
+                        index_key = (namespace, label, labels[label])
+                        break
+                candidates = [
+                    self._objects[key]
+                    for key in self._index.get(index_key, ())
+                ]
+        for obj in candidates:
+            obj_labels = obj["metadata"].get("labels") or {}
+            if all(obj_labels.get(k) == v for k, v in labels.items()):
+                yield obj
+
+
+class ResourceVersionExpired(Exception):
+    """Raised when a watch resourceVersion is too old to resume from."""
+
+
+class Informer:
+    """Keeps a Store in sync with the target cluster using list and watch.
+
+    The informer lists all objects of the resource across all namespaces,
+    then watches for changes from the resourceVersion of that list. If the
+    watch resourceVersion expires, the objects are listed again.
+
+    Handlers are called with the event type and object after the store has
+    been updated. A list is reported as an ADDED event for every object
+    listed, and a DELETED event for every object no longer present.
+    """
+
+    # Seconds to wait before retrying after a failed list or watch
+    retry_interval = 5
+
+    def __init__(self, resource):
+        self.resource = resource
+        self.store = Store()
+        self._handlers = []
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def add_handler(self, handler):
+        self._handlers.append(handler)
+
+    def _notify(self, event_type, obj):
+        for handler in self._handlers:
+            try:
+                handler(event_type, obj)
+            except Exception:
+                LOG.exception(
+                    "Handler for %s event failed", type(self.resource).__name__
+                )
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run,
+            name=f"informer-{type(self.resource).__name__}",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                if not self.store.synced:
+                    self._list()
+                self._watch()
+            except ResourceVersionExpired:
+                LOG.debug(
+                    "Watch for %s expired, relisting",
+                    type(self.resource).__name__,
+                )
+                self.store.synced = False
+            except Exception:
+                LOG.warning(
+                    "Informer for %s failed, retrying",
+                    type(self.resource).__name__,
+                    exc_info=True,
+                )
+                # Serve direct reads until the store has been relisted
+                self.store.synced = False
+                time.sleep(self.retry_interval)
+
+    def _list(self):
+        fields = {}
+        items = list(
+            iter_list(
+                self.resource.client,
+                self.resource.prepare_path(),
+                {},
+                fields,
+            )
+        )
+        removed = self.store.replace(
+            items, fields.get("metadata", {}).get("resourceVersion")
+        )
+        for obj in items:
+            self._notify("ADDED", obj)
+        for obj in removed:
+            self._notify("DELETED", obj)
+
+    def _watch(self):
+        response = self.resource.client.get(
+            self.resource.prepare_path(),
+            params={
+                "watch": "1",
+                "resourceVersion": self.store.resource_version,
+                "allowWatchBookmarks": "true",
+                "timeoutSeconds": CONF.capi_helm.informer_watch_timeout,
+            },
+            headers=encoding_headers("watch"),
+            stream=True,
+            # The server may send nothing until the watch times out
+            timeout=(
+                CONF.capi_helm.api_connect_timeout,
+                CONF.capi_helm.informer_watch_timeout
+                + CONF.capi_helm.api_read_timeout,
+            ),
+        )
+        with response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if self._stopped.is_set():
+                    return
+                if line:
+                    self._handle_event(serialization.json_loads(line))
+
+    def _handle_event(self, event):
+        event_type = event["type"]
+        obj = event["object"]
+        if event_type in {"ADDED", "MODIFIED"}:
+            self.store.update(obj)
+            self._notify(event_type, obj)
+        elif event_type == "DELETED":
+            self.store.delete(obj)
+            self._notify(event_type, obj)
+        elif event_type == "BOOKMARK":
+            self.store.resource_version = obj["metadata"]["resourceVersion"]
+        elif event_type == "ERROR":
+            if obj.get("code") == 410:
+                raise ResourceVersionExpired(obj.get("message"))
+            raise Exception(f"Watch error: {obj.get('message')}")
+
+
+def plural_name_for_kind(kind):
+    """Returns the plural name of a kind, using the usual conventions."""
+    name = kind.lower()
+    if name.endswith("s"):
+        return name + "es"
+    if name.endswith("y") and name[-2:-1] not in "aeiou":
+        return name[:-1] + "ies"
+    return name + "s"
+
+
+class GenericResource(Resource):
+    """Resource for objects of any kind, e.g. when applying manifests.
+
+    The plural name is found using API discovery, and only guessed from
+    the kind if discovery is disabled or the kind is not served.
+    """
+
+    # Kinds that do not follow the usual plural conventions
+    PLURAL_NAMES = {
+        "Manifests": "manifests",
+        "Endpoints": "endpoints",
+    }
+
+    def __init__(self, client, api_version, kind, namespaced=True):
+        self.api_version = api_version
+        self.kind = kind
+        discovery = getattr(client, "discovery", None)
+        self.plural_name = (
+            discovery is not None and discovery.plural_name(api_version, kind)
+        ) or self.PLURAL_NAMES.get(kind, plural_name_for_kind(kind))
+        self.namespaced = namespaced
+        super().__init__(client)
+
+
 class Namespace(Resource):
     api_version = "v1"
     namespaced = False
@@ -306,71 +1917,111 @@ class Secret(Resource):
 
 
 class Cluster(Resource):
-    api_version = (
-        json.loads(CONF.capi_helm.api_resources)
-        .get("Cluster", {})
-        .get("api_version", "cluster.x-k8s.io/v1beta1")
-    )
+    discovered = True
+    api_version = "cluster.x-k8s.io/v1beta1"
 
 
 class OpenstackCluster(Resource):
-    api_version = (
-        json.loads(CONF.capi_helm.api_resources)
-        .get("OpenstackCluster", {})
-        .get("api_version", "infrastructure.cluster.x-k8s.io/v1beta1")
-    )
+    discovered = True
+    api_version = "infrastructure.cluster.x-k8s.io/v1beta1"
 
 
 class MachineDeployment(Resource):
-    api_version = (
-        json.loads(CONF.capi_helm.api_resources)
-        .get("MachineDeployment", {})
-        .get("api_version", "cluster.x-k8s.io/v1beta1")
-    )
+    discovered = True
+    api_version = "cluster.x-k8s.io/v1beta1"
 
 
 class K8sControlPlane(Resource):
-    api_version = (
-        json.loads(CONF.capi_helm.api_resources)
-        .get("K8sControlPlane", {})
-        .get("api_version", "controlplane.cluster.x-k8s.io/v1beta1")
-    )
-    plural_name = (
-        json.loads(CONF.capi_helm.api_resources)
-        .get("K8sControlPlane", {})
-        .get("plural_name", "kubeadmcontrolplanes")
-    )
+    discovered = True
+    api_version = "controlplane.cluster.x-k8s.io/v1beta1"
+    plural_name = "kubeadmcontrolplanes"
 
 
 class Machine(Resource):
-    api_version = (
-        json.loads(CONF.capi_helm.api_resources)
-        .get("Machine", {})
-        .get("api_version", "cluster.x-k8s.io/v1beta1")
-    )
+    discovered = True
+    api_version = "cluster.x-k8s.io/v1beta1"
 
 
 class Manifests(Resource):
-    api_version = (
-        json.loads(CONF.capi_helm.api_resources)
-        .get("Manifests", {})
-        .get("api_version", "addons.stackhpc.com/v1alpha1")
-    )
+    discovered = True
+    api_version = "addons.stackhpc.com/v1alpha1"
     plural_name = "manifests"
 
 
 class HelmRelease(Resource):
-    api_version = (
-        json.loads(CONF.capi_helm.api_resources)
-        .get("HelmRelease", {})
-        .get("api_version", "addons.stackhpc.com/v1alpha1")
-    )
+    discovered = True
+    api_version = "addons.stackhpc.com/v1alpha1"
 
 
 class HelmChartProxy(Resource):
-    api_version = (
-        json.loads(CONF.capi_helm.api_resources)
-        .get("HelmChartProxy", {})
-        .get("api_version", "addons.cluster.x-k8s.io/v1alpha1")
-    )
+    discovered = True
+    api_version = "addons.cluster.x-k8s.io/v1alpha1"
     plural_name = "helmchartproxies"
+
+
+class Snapshot(ResourceClient):
+    """Point-in-time copy of the Cluster API resources in some namespaces.
+
+    Each resource kind is listed once per namespace, and reads of those
+    kinds through the usual Client methods are then served from memory.
+    Any other request is passed through to the wrapped client. If the
+    objects of each kind have already been listed, e.g. by the async
+    client, they can be given as items instead.
+    """
+
+    # Machines are not included, as the driver only reads them to decide
+    # whether node groups are deleted, which must not use stale data
+    RESOURCES = (
+        Cluster,
+        K8sControlPlane,
+        MachineDeployment,
+        HelmRelease,
+        Manifests,
+        HelmChartProxy,
+    )
+
+    def __init__(self, client, namespaces, resources=None, items=None):
+        self._client = client
+        self._stores = {}
+        self.discovery = client.discovery
+        if items is None:
+            items = {
+                resource_cls: self._list_all(client, resource_cls, namespaces)
+                for resource_cls in resources or self.RESOURCES
+            }
+        for resource_cls, objs in items.items():
+            store = Store()
+            store.replace(objs, None)
+            self._stores[resource_cls.__name__] = store
+
+    @staticmethod
+    def _list_all(client, resource_cls, namespaces):
+        resource = resource_cls(client)
+        items = []
+        for namespace in namespaces:
+            try:
+                items.extend(resource.fetch_all_by_label({}, namespace))
+            except requests.exceptions.HTTPError as e:
+                # The CRD is not installed, e.g. HelmChartProxy
+                if e.response.status_code != 404:
+                    raise
+        return items
+
+    def get(self, url, **kwargs):
+        return self._client.get(url, **kwargs)
+
+    def patch(self, url, data=None, **kwargs):
+        return self._client.patch(url, data, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self._client.delete(url, **kwargs)
+
+    def coalesce(self, key, func):
+        return self._client.coalesce(key, func)
+
+    def get_store(self, resource):
+        return self._stores.get(type(resource).__name__)
+
+    def close(self):
+        """Releases the objects, leaving the wrapped client open."""
+        self._stores = {}
@@ -0,0 +1,57 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# In-process counters for driver operations.
+#
+# Counters are process-wide and cumulative. Durations are recorded as a
+# pair of counters, "<name>_count" and "<name>_seconds", from which an
+# average can be derived.
+
+import collections
+import threading
+
+_lock = threading.Lock()
+_counters = collections.Counter()
+
+
+def increment(name, value=1):
+    with _lock:
+        _counters[name] += value
+
+
+def observe(name, seconds):
+    with _lock:
+        _counters[f"{name}_count"] += 1
+        _counters[f"{name}_seconds"] += seconds
+
+
+def maximum(name, value):
+    """Records value if it is the highest seen for name."""
+    with _lock:
+        if value > _counters[name]:
+            _counters[name] = value
+
+
+def get(name):
+    with _lock:
+        return _counters[name]
+
+
+def snapshot():
+    """Returns a copy of all the counters."""
+    with _lock:
+        return dict(_counters)
+
+
+def reset():
+    with _lock:
+        _counters.clear()
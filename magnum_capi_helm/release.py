@@ -0,0 +1,219 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import pathlib
+import typing as t
+
+from oslo_log import log as logging
+
+from magnum_capi_helm import conf
+from magnum_capi_helm import deadline
+from magnum_capi_helm import driver_utils
+
+LOG = logging.getLogger(__name__)
+CONF = conf.CONF
+
+# Label added to every object applied for a release, used for pruning
+RELEASE_LABEL = "magnum.openstack.org/release"
+# Annotations helm gives hooks, and objects it keeps when they are removed
+HOOK_ANNOTATION = "helm.sh/hook"
+RESOURCE_POLICY_ANNOTATION = "helm.sh/resource-policy"
+
+
+class ApplyClient:
+    """Deploys charts without helm releases.
+
+    The chart is rendered with helm template, and the resulting objects
+    are applied to the management cluster using server-side apply. Objects
+    from previous versions of the release that are no longer rendered are
+    pruned, using the release label.
+
+    Chart hooks are not rendered, as there is no release for them to run
+    against, and objects with the helm keep resource policy are not
+    pruned, as with helm.
+
+    The kinds of object applied for each release are recorded in an
+    inventory secret, given the labels passed, so that objects of kinds no
+    longer rendered are still pruned, and so that the release can be
+    uninstalled. Releases without an inventory were installed by helm,
+    before the deploy mode was changed, so are uninstalled with helm.
+
+    The interface matches the parts of helm.Client used by the driver.
+    """
+
+    def __init__(self, helm_client, k8s_client, labels=None):
+        self._helm_client = helm_client
+        self._k8s_client = k8s_client
+        self._labels = labels or {}
+
+    def _inventory_name(self, release_name):
+        return driver_utils.sanitized_name(release_name, "inventory")
+
+    def _get_inventory(self, release_name, namespace):
+        # Returns None if there is no inventory for the release
+        kinds = self._k8s_client.get_secret_value(
+            self._inventory_name(release_name), namespace, "kinds"
+        )
+        if kinds is None:
+            return None
+        return {tuple(kind) for kind in json.loads(kinds)}
+
+    def _set_inventory(self, release_name, namespace, kinds):
+        self._k8s_client.apply_secret(
+            self._inventory_name(release_name),
+            {
+                "metadata": {"labels": self._labels},
+                "stringData": {"kinds": json.dumps(sorted(kinds))},
+            },
+            namespace,
+        )
+
+    def _namespaced(self, api_version, kind):
+        # Kinds that discovery does not know are assumed to be namespaced,
+        # as all those in the cluster charts are
+        discovery = getattr(self._k8s_client, "discovery", None)
+        if discovery is None:
+            return True
+        return discovery.is_namespaced(api_version, kind) is not False
+
+    def _get_resource(self, api_version, kind):
+        return self._k8s_client.get_resource(
+            api_version, kind, self._namespaced(api_version, kind)
+        )
+
+    def install_or_upgrade(
+        self,
+        release_name: str,
+        chart_ref: t.Union[pathlib.Path, str],
+        *values: t.Dict[str, t.Any],
+        namespace: str,
+        repo: t.Optional[str] = None,
+        version: t.Optional[str] = None,
+    ) -> t.List[t.Dict[str, t.Any]]:
+        """Render the chart and apply the objects for the release."""
+        objects = []
+        for obj in self._helm_client.template(
+            release_name,
+            chart_ref,
+            *values,
+            namespace=namespace,
+            repo=repo,
+            version=version,
+        ):
+            # The rendered objects are shared with the template cache, so
+            # copy only the parts that are changed
+            obj = dict(obj)
+            metadata = obj["metadata"] = dict(obj.get("metadata") or {})
+            if self._namespaced(obj["apiVersion"], obj["kind"]):
+                metadata.setdefault("namespace", namespace)
+            else:
+                metadata.pop("namespace", None)
+            labels = metadata["labels"] = dict(metadata.get("labels") or {})
+            labels[RELEASE_LABEL] = release_name
+            objects.append(obj)
+
+        kinds = {(obj["apiVersion"], obj["kind"]) for obj in objects}
+        previous_kinds = self._get_inventory(release_name, namespace) or set()
+        # Record the new kinds before applying, so that an interrupted
+        # apply can still be pruned or uninstalled
+        self._set_inventory(release_name, namespace, kinds | previous_kinds)
+
+        with driver_utils.get_executor(
+            CONF.capi_helm.apply_concurrency
+        ) as executor:
+            # Propagate the first error, once all the applies are complete
+            for future in [
+                executor.submit(
+                    deadline.propagate(self._k8s_client.apply_object), obj
+                )
+                for obj in objects
+            ]:
+                future.result()
+
+        self._prune(release_name, namespace, objects, kinds | previous_kinds)
+        if previous_kinds - kinds:
+            self._set_inventory(release_name, namespace, kinds)
+        return objects
+
+    def _prune(self, release_name, namespace, objects, kinds):
+        applied = {
+            (obj["apiVersion"], obj["kind"], obj["metadata"]["name"])
+            for obj in objects
+        }
+        for api_version, kind in sorted(kinds):
+            resource = self._get_resource(api_version, kind)
+            obj_namespace = namespace if resource.namespaced else None
+            for obj in resource.fetch_all_by_label(
+                {RELEASE_LABEL: release_name}, obj_namespace
+            ):
+                metadata = obj["metadata"]
+                name = metadata["name"]
+                if (api_version, kind, name) in applied:
+                    continue
+                annotations = metadata.get("annotations") or {}
+                if annotations.get(RESOURCE_POLICY_ANNOTATION) == "keep":
+                    continue
+                LOG.info(
+                    "Pruning %s %s/%s from release %s",
+                    kind,
+                    namespace,
+                    name,
+                    release_name,
+                )
+                resource.delete(name, obj_namespace)
+
+    def uninstall_release(self, release_name: str, namespace: str):
+        """Delete all the objects applied for the release."""
+        kinds = self._get_inventory(release_name, namespace)
+        if kinds is None:
+            LOG.info(
+                "No inventory for release %s, uninstalling with helm",
+                release_name,
+            )
+            self._helm_client.uninstall_release(
+                release_name, namespace=namespace
+            )
+            return
+        for api_version, kind in sorted(kinds):
+            resource = self._get_resource(api_version, kind)
+            resource.delete_all_by_label(
+                RELEASE_LABEL,
+                release_name,
+                namespace if resource.namespaced else None,
+            )
+        self._k8s_client.get_resource("v1", "Secret").delete(
+            self._inventory_name(release_name), namespace
+        )
+
+
+class HelmClient:
+    """Deploys charts as helm releases.
+
+    Releases are installed and upgraded with helm, and uninstalled as by
+    ApplyClient, so that releases applied before the deploy mode was
+    changed to helm are still deleted.
+
+    The interface matches the parts of helm.Client used by the driver.
+    """
+
+    def __init__(self, helm_client, k8s_client, labels=None):
+        self._helm_client = helm_client
+        self._apply_client = ApplyClient(helm_client, k8s_client, labels)
+
+    def install_or_upgrade(self, *args, **kwargs):
+        """Install or upgrade the release with helm."""
+        return self._helm_client.install_or_upgrade(*args, **kwargs)
+
+    def uninstall_release(self, release_name: str, namespace: str):
+        """Uninstall the release, however it was deployed."""
+        self._apply_client.uninstall_release(release_name, namespace)
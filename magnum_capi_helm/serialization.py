@@ -0,0 +1,74 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# JSON and YAML encoding for the Kubernetes and Helm clients.
+#
+# orjson is used for JSON when it is installed, and the LibYAML bindings
+# for YAML when PyYAML was built with them. Otherwise, and for any data
+# orjson rejects, e.g. integers wider than 64 bits when encoding, the
+# standard library and pure Python PyYAML are used. orjson decodes such
+# integers as floats, but the Kubernetes API limits integers to 64 bits.
+
+import json
+
+import yaml
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+SafeDumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+_ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS if orjson is not None else 0
+
+
+def json_loads(data):
+    """Decodes JSON from str or bytes."""
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # Fall through for the error, or data orjson does not accept
+            pass
+    return json.loads(data)
+
+
+def json_dumpb(data):
+    """Encodes data as compact JSON bytes."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(data, option=_ORJSON_OPTIONS)
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(data, separators=(",", ":")).encode()
+
+
+def json_dumps(data):
+    """Encodes data as a compact JSON string."""
+    return json_dumpb(data).decode()
+
+
+def yaml_load(stream):
+    """Decodes a YAML document from a string or file, as yaml.safe_load."""
+    return yaml.load(stream, Loader=SafeLoader)
+
+
+def yaml_load_all(stream):
+    """Decodes each YAML document, as yaml.safe_load_all."""
+    return yaml.load_all(stream, Loader=SafeLoader)
+
+
+def yaml_dump(data):
+    """Encodes data as a YAML string, as yaml.safe_dump."""
+    return yaml.dump(data, Dumper=SafeDumper)
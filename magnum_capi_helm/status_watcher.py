@@ -0,0 +1,247 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# Event driven cluster status updates, see [capi_helm]/status_watch_enabled.
+
+import threading
+import time
+
+from magnum.common import context as magnum_context
+from magnum.common import exception
+from magnum import objects
+from magnum.objects import fields
+from magnum.service import periodic
+from oslo_log import log as logging
+from oslo_service import loopingcall
+
+from magnum_capi_helm import conf
+from magnum_capi_helm import db_snapshot
+from magnum_capi_helm import kubernetes
+from magnum_capi_helm import metrics
+
+LOG = logging.getLogger(__name__)
+CONF = conf.CONF
+
+CLUSTER_UUID_LABEL = "magnum.openstack.org/cluster-uuid"
+# Labels holding the helm release name, i.e. the cluster stack_id
+RELEASE_NAME_LABELS = (
+    "capi.stackhpc.com/cluster",
+    "addons.stackhpc.com/cluster",
+    "cluster.x-k8s.io/cluster-name",
+)
+
+WATCHED_RESOURCES = (
+    kubernetes.Cluster,
+    kubernetes.OpenstackCluster,
+    kubernetes.K8sControlPlane,
+    kubernetes.MachineDeployment,
+    kubernetes.HelmRelease,
+    kubernetes.Manifests,
+)
+
+# The same statuses as the periodic status and health polls in Magnum
+STATUS_POLL_STATES = {
+    fields.ClusterStatus.CREATE_IN_PROGRESS,
+    fields.ClusterStatus.UPDATE_IN_PROGRESS,
+    fields.ClusterStatus.DELETE_IN_PROGRESS,
+    fields.ClusterStatus.ROLLBACK_IN_PROGRESS,
+}
+HEALTH_POLL_STATES = STATUS_POLL_STATES | {
+    fields.ClusterStatus.CREATE_FAILED,
+    fields.ClusterStatus.CREATE_COMPLETE,
+    fields.ClusterStatus.UPDATE_COMPLETE,
+    fields.ClusterStatus.UPDATE_FAILED,
+    fields.ClusterStatus.DELETE_FAILED,
+}
+
+_watcher = None
+_watcher_lock = threading.Lock()
+
+
+def get_watcher():
+    """Returns the status watcher, starting it if required.
+
+    Returns None unless [capi_helm]/status_watch_enabled is set.
+    """
+    global _watcher
+    if not CONF.capi_helm.status_watch_enabled:
+        return None
+    with _watcher_lock:
+        if _watcher is None:
+            _watcher = StatusWatcher(kubernetes.Client.shared())
+            _watcher.start()
+        return _watcher
+
+
+def in_progress(cluster):
+    """Returns True if the cluster or any of its node groups is changing.
+
+    Not every change in progress is seen by the watched objects, e.g. the
+    Machines of a node group being deleted, or an upgrade that was skipped
+    as nothing changed, so these are always polled.
+    """
+    return cluster.status.endswith("_IN_PROGRESS") or any(
+        nodegroup.status.endswith("_IN_PROGRESS")
+        for nodegroup in db_snapshot.get(cluster).nodegroups
+    )
+
+
+def cluster_key(obj):
+    """Returns a key identifying the Magnum cluster an object belongs to.
+
+    The key is either ("uuid", <cluster uuid>) or ("stack_id", <release
+    name>), or None when the object does not belong to a cluster.
+    """
+    metadata = obj.get("metadata", {})
+    labels = metadata.get("labels") or {}
+    if labels.get(CLUSTER_UUID_LABEL):
+        return ("uuid", labels[CLUSTER_UUID_LABEL])
+    for label in RELEASE_NAME_LABELS:
+        if labels.get(label):
+            return ("stack_id", labels[label])
+    # The Cluster API cluster is named after the release
+    if obj.get("kind") == "Cluster" and metadata.get("name"):
+        return ("stack_id", metadata["name"])
+    return None
+
+
+class StatusWatcher:
+    """Updates the status of clusters whose Cluster API objects change.
+
+    Informers watch the Cluster API objects in all namespaces. Changes to
+    objects in the namespace_prefix namespaces are mapped back to the
+    Magnum cluster, and the same status and health updates as the periodic
+    polls are run for just those clusters, from a single worker thread.
+    While the informers are synced, the periodic polls of a cluster are
+    skipped for status_poll_interval after the cluster was last checked,
+    unless the cluster or one of its node groups is in progress.
+    """
+
+    # Seconds to wait for further events before handling a change, so that
+    # the events for a change to many objects are handled together
+    batch_delay = 1
+
+    def __init__(self, k8s_client):
+        self._client = k8s_client
+        self._informers = []
+        self._pending = set()
+        self._condition = threading.Condition()
+        self._last_checked = {}
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._informers = [
+            self._client.get_informer(resource_cls, handler=self._on_event)
+            for resource_cls in WATCHED_RESOURCES
+        ]
+        self._thread = threading.Thread(
+            target=self._run, name="capi-status-watcher", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        with self._condition:
+            self._condition.notify()
+
+    @property
+    def synced(self):
+        return bool(self._informers) and all(
+            informer.store.synced for informer in self._informers
+        )
+
+    def _on_event(self, event_type, obj):
+        namespace = obj.get("metadata", {}).get("namespace") or ""
+        if not namespace.startswith(f"{CONF.capi_helm.namespace_prefix}-"):
+            return
+        key = cluster_key(obj)
+        if key:
+            with self._condition:
+                self._pending.add(key)
+                self._condition.notify()
+
+    def should_poll(self, cluster, check):
+        """Returns False if a periodic poll of the cluster can be skipped.
+
+        The check is either "status" or "health".
+        """
+        if threading.current_thread() is self._thread:
+            return True
+        now = time.monotonic()
+        last_checked = self._last_checked.get((check, cluster.uuid))
+        if (
+            self.synced
+            and last_checked is not None
+            and not in_progress(cluster)
+            and now - last_checked < CONF.capi_helm.status_poll_interval
+        ):
+            metrics.increment(f"{check}_poll_skipped")
+            return False
+        self._last_checked[(check, cluster.uuid)] = now
+        return True
+
+    def _run(self):
+        while not self._stopped.is_set():
+            with self._condition:
+                while not self._pending and not self._stopped.is_set():
+                    self._condition.wait()
+            # Collect the other events for the same change
+            self._stopped.wait(self.batch_delay)
+            with self._condition:
+                pending, self._pending = self._pending, set()
+            for key in sorted(pending):
+                try:
+                    self._handle(key)
+                except Exception:
+                    LOG.exception("Failed to handle change to cluster %s", key)
+
+    def _find_clusters(self, context, key):
+        key_type, value = key
+        if key_type == "uuid":
+            try:
+                return [objects.Cluster.get_by_uuid(context, value)]
+            except exception.ClusterNotFound:
+                return []
+        return objects.Cluster.list(context, filters={"stack_id": value})
+
+    def _handle(self, key):
+        context = magnum_context.make_admin_context(all_tenants=True)
+        magnum_context.set_ctx(context)
+        try:
+            for cluster in self._find_clusters(context, key):
+                self._update(context, cluster)
+        finally:
+            magnum_context.set_ctx(None)
+
+    def _update(self, context, cluster):
+        now = time.monotonic()
+        if cluster.status in STATUS_POLL_STATES:
+            LOG.debug("Updating status for changed cluster %s", cluster.uuid)
+            self._last_checked[("status", cluster.uuid)] = now
+            metrics.increment("status_watch_update")
+            try:
+                periodic.ClusterUpdateJob(context, cluster).update_status()
+            except loopingcall.LoopingCallDone:
+                pass
+            if cluster.status == fields.ClusterStatus.DELETE_COMPLETE:
+                self._last_checked.pop(("status", cluster.uuid), None)
+                self._last_checked.pop(("health", cluster.uuid), None)
+                return
+        if cluster.status in HEALTH_POLL_STATES:
+            self._last_checked[("health", cluster.uuid)] = now
+            try:
+                periodic.ClusterHealthUpdateJob(
+                    context, cluster
+                ).update_health_status()
+            except loopingcall.LoopingCallDone:
+                pass
@@ -15,8 +15,63 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import io
+import json
+from unittest import mock
+
+from oslo_config import fixture as config_fixture
 from oslotest import base
+import requests
+
+from magnum_capi_helm import conf
+
+
+def k8s_object(name, namespace=None, kind=None, api_version=None, labels=None):
+    """Returns a Kubernetes object with only the given fields set."""
+    obj = {"metadata": {"name": name}}
+    if namespace is not None:
+        obj["metadata"]["namespace"] = namespace
+    if labels is not None:
+        obj["metadata"]["labels"] = labels
+    if kind is not None:
+        obj["kind"] = kind
+    if api_version is not None:
+        obj["apiVersion"] = api_version
+    return obj
+
+
+def list_content(data, chunk_size=16):
+    """Returns a list response body as the chunks of a streamed response."""
+    stream = io.BytesIO(json.dumps(data).encode())
+    return list(iter(lambda: stream.read(chunk_size), b""))
+
+
+def response(data=None, status_code=200, headers=None):
+    """Returns a mock requests response with the given JSON body."""
+    response = mock.MagicMock()
+    response.status_code = status_code
+    response.headers = headers or {}
+    response.json.return_value = data
+    response.iter_content.return_value = list_content(data)
+    if status_code >= 400:
+        response.raise_for_status.side_effect = requests.HTTPError(
+            response=response
+        )
+    return response
+
+
+def list_response(items, continue_token=""):
+    """Returns a mock response with one page of a list of objects."""
+    return response({"metadata": {"continue": continue_token}, "items": items})
 
 
 class TestCase(base.BaseTestCase):
     """Test case base class for all unit tests."""
+
+    def setUp(self):
+        super(TestCase, self).setUp()
+        self.cfg_fixture = self.useFixture(config_fixture.Config(conf.CONF))
+
+    def config(self, **kw):
+        """Override config options for a test."""
+        self.cfg_fixture.config(**kw)
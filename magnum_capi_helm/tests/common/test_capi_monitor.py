@@ -10,7 +10,9 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import asyncio
 import copy
+import threading
 
 from unittest import mock
 
@@ -18,6 +20,7 @@ from magnum.objects import fields as m_fields
 from magnum.tests.unit.db import base
 from magnum.tests.unit.objects import utils as obj_utils
 from magnum_capi_helm.common import capi_monitor
+from magnum_capi_helm import kubernetes
 
 
 class TestCAPIMonitor(base.DbTestCase):
@@ -101,6 +104,16 @@ class TestCAPIMonitor(base.DbTestCase):
             },
         )
 
+    def test_management_cluster_unavailable(self):
+        self.mock_k8s.get_capi_openstackcluster.side_effect = (
+            kubernetes.CircuitOpen()
+        )
+
+        self.monitor.poll_health_status()
+
+        # The health status is left as it is
+        self.assertNotIn("health_status", self.monitor.data)
+
     def test_cluster_unhealthy(self):
         cluster_state = {
             "status": {
@@ -281,3 +294,52 @@ class TestCAPIMonitor(base.DbTestCase):
                 "nodegroup": "test-worker resource not found.",
             },
         )
+
+    def test_async_poll(self):
+        async_client = mock.Mock()
+        for method in (
+            "get_capi_cluster",
+            "get_capi_openstackcluster",
+            "get_k8s_control_plane",
+            "get_machine_deployment",
+        ):
+            setattr(
+                async_client,
+                method,
+                mock.AsyncMock(
+                    return_value=getattr(self.mock_k8s, method).return_value
+                ),
+            )
+        async_client.get_machine_deployment.return_value = None
+        threads_used = []
+        worker_nodegroups = self.monitor._worker_nodegroups
+
+        def load_nodegroups():
+            threads_used.append(threading.current_thread())
+            return worker_nodegroups()
+
+        with mock.patch.object(
+            self.monitor, "_worker_nodegroups", side_effect=load_nodegroups
+        ):
+            asyncio.run(self.monitor.poll_health_status_async(async_client))
+
+        self.assertEqual(
+            self.monitor.data["health_status"],
+            m_fields.ClusterHealthStatus.UNHEALTHY,
+        )
+        self.assertEqual(
+            self.monitor.data["health_status_reason"],
+            {
+                "cluster": "Ready",
+                "controlplane": "Ready",
+                "infrastructure": "Ready",
+                "nodegroup": "test-worker resource not found.",
+            },
+        )
+        async_client.get_k8s_control_plane.assert_awaited_once_with(
+            "cluster-example-a-111111111111-control-plane",
+            "magnum-fakeproject",
+        )
+        self.mock_k8s.get_capi_cluster.assert_not_called()
+        # Loaded off the event loop, as the database calls block
+        self.assertIsNot(threading.main_thread(), threads_used[0])
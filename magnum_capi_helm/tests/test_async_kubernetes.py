@@ -0,0 +1,451 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import asyncio
+import gzip
+import json
+from unittest import mock
+import urllib.parse
+
+import requests
+
+from magnum_capi_helm import async_kubernetes
+from magnum_capi_helm import kubernetes
+from magnum_capi_helm import metrics
+from magnum_capi_helm.tests import base
+
+
+class FakeServer:
+    """Minimal HTTP/1.1 server answering requests with a handler.
+
+    The handler returns a status and data to send as JSON, or a list of
+    raw parts of the response to write, with a number meaning a pause of
+    that many seconds and None closing the connection.
+    """
+
+    def __init__(self, handler, chunked=False, keep_alive=True):
+        self.handler = handler
+        self.chunked = chunked
+        self.keep_alive = keep_alive
+        self.requests = []
+        self.connections = 0
+
+    async def __aenter__(self):
+        self._server = await asyncio.start_server(self._serve, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode().split(" ")
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode()
+                    if line == "\r\n":
+                        break
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                body = json.loads(await reader.readexactly(length) or "null")
+                url = urllib.parse.urlsplit(target)
+                params = dict(urllib.parse.parse_qsl(url.query))
+                self.requests.append((method, url.path, params, headers, body))
+                response = self.handler(method, url.path, params, body)
+                if isinstance(response, list):
+                    if not await self._write_raw(writer, response):
+                        break
+                    continue
+                status, data = response
+                content = json.dumps(data).encode()
+                head = f"HTTP/1.1 {status} Reason\r\n"
+                if "gzip" in headers.get("accept-encoding", ""):
+                    content = gzip.compress(content)
+                    head += "Content-Encoding: gzip\r\n"
+                if self.chunked:
+                    head += "Transfer-Encoding: chunked\r\n\r\n"
+                    middle = len(content) // 2
+                    content = b"".join(
+                        b"%x\r\n%s\r\n" % (len(part), part)
+                        for part in (content[:middle], content[middle:], b"")
+                    )
+                else:
+                    head += f"Content-Length: {len(content)}\r\n\r\n"
+                writer.write(head.encode() + content)
+                await writer.drain()
+                if not self.keep_alive:
+                    # Closed without saying so, as for an idle timeout
+                    break
+        finally:
+            writer.close()
+
+    async def _write_raw(self, writer, parts):
+        for part in parts:
+            if part is None:
+                return False
+            if isinstance(part, bytes):
+                writer.write(part)
+                await writer.drain()
+            else:
+                await asyncio.sleep(part)
+        return True
+
+    def client(self, server=None):
+        server = server or f"http://127.0.0.1:{self.port}"
+        client = kubernetes.Client(
+            {
+                "apiVersion": "v1",
+                "kind": "Config",
+                "current-context": "default",
+                "clusters": [
+                    {
+                        "name": "default",
+                        "cluster": {"server": server},
+                    }
+                ],
+                "contexts": [
+                    {
+                        "name": "default",
+                        "context": {"cluster": "default", "user": "default"},
+                    }
+                ],
+                "users": [{"name": "default", "user": {"token": "token"}}],
+            }
+        )
+        return async_kubernetes.AsyncClient(client, max_connections=2)
+
+
+class TestAsyncClient(base.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.config(api_discovery_ttl=0, group="capi_helm")
+
+    def _run(self, handler, func, **kwargs):
+        async def run():
+            async with FakeServer(handler, **kwargs) as server:
+                async with server.client() as client:
+                    result = await func(client)
+                return server, result
+
+        return asyncio.run(run())
+
+    def test_fetch(self):
+        cluster = base.k8s_object("c1", "ns1")
+
+        def handler(method, path, params, body):
+            if path.endswith("/clusters/c1"):
+                return 200, cluster
+            return 404, {}
+
+        async def fetch(client):
+            return await asyncio.gather(
+                *(
+                    client.get_capi_cluster(name, "ns1")
+                    for name in ("c1", "c2", "c1", "c1", "c1")
+                )
+            )
+
+        server, clusters = self._run(handler, fetch)
+
+        self.assertEqual([cluster, None, cluster, cluster, cluster], clusters)
+        self.assertEqual(5, len(server.requests))
+        # Requests share the pool of keep-alive connections
+        self.assertLessEqual(server.connections, 2)
+        # Made concurrently, so in any order
+        self.assertEqual(
+            [
+                (
+                    "GET",
+                    "/apis/cluster.x-k8s.io/v1beta1/namespaces/ns1/"
+                    f"clusters/{name}",
+                )
+                for name in ("c1", "c1", "c1", "c1", "c2")
+            ],
+            sorted(request[:2] for request in server.requests),
+        )
+        self.assertEqual(
+            "Bearer token", server.requests[0][3]["authorization"]
+        )
+
+    def test_closed_connection_retried(self):
+        async def fetch(client):
+            return [
+                await client.get_capi_cluster("c1", "ns1") for _ in range(3)
+            ]
+
+        server, clusters = self._run(
+            lambda *args: (200, base.k8s_object("c1", "ns1")),
+            fetch,
+            keep_alive=False,
+        )
+
+        self.assertEqual([base.k8s_object("c1", "ns1")] * 3, clusters)
+        self.assertEqual(3, server.connections)
+
+    @mock.patch.object(asyncio, "sleep")
+    def test_fetch_retried(self, mock_sleep):
+        statuses = [503, 429, 200]
+
+        def handler(method, path, params, body):
+            return statuses.pop(0), base.k8s_object("c1", "ns1")
+
+        async def fetch(client):
+            return await client.get_capi_cluster("c1", "ns1")
+
+        server, cluster = self._run(handler, fetch)
+
+        self.assertEqual(base.k8s_object("c1", "ns1"), cluster)
+        self.assertEqual(3, len(server.requests))
+        self.assertEqual(2, mock_sleep.call_count)
+
+    def test_fetch_compressed(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        obj = {**base.k8s_object("c1", "ns1"), "data": {"a": "b" * 1000}}
+
+        async def fetch(client):
+            resource = client.resource(kubernetes.Secret)
+            return [
+                item async for item in resource.fetch_all_by_label({}, "ns1")
+            ]
+
+        server, objs = self._run(
+            lambda *args: (200, {"metadata": {}, "items": [obj]}), fetch
+        )
+
+        self.assertEqual([obj], objs)
+        self.assertEqual("gzip", server.requests[0][3]["accept-encoding"])
+        self.assertLess(
+            metrics.get("api_response_bytes_received"),
+            metrics.get("api_response_bytes_decoded") / 10,
+        )
+
+    def test_fetch_not_compressed(self):
+        self.config(api_compression_verbs=["get"], group="capi_helm")
+
+        async def fetch(client):
+            resource = client.resource(kubernetes.Secret)
+            return [
+                item async for item in resource.fetch_all_by_label({}, "ns1")
+            ]
+
+        server, objs = self._run(
+            lambda *args: (
+                200,
+                {"metadata": {}, "items": [base.k8s_object("s1", "ns1")]},
+            ),
+            fetch,
+        )
+
+        self.assertEqual([base.k8s_object("s1", "ns1")], objs)
+        self.assertEqual("identity", server.requests[0][3]["accept-encoding"])
+
+    def test_fetch_cached_read(self):
+        async def fetch(client):
+            with kubernetes.read_consistency(kubernetes.CACHED_READ):
+                return await client.get_machine_deployment("md", "ns1")
+
+        server, md = self._run(
+            lambda *args: (200, base.k8s_object("md", "ns1")), fetch
+        )
+
+        self.assertEqual(base.k8s_object("md", "ns1"), md)
+        self.assertEqual({"resourceVersion": "0"}, server.requests[0][2])
+
+    def test_fetch_error(self):
+        async def fetch(client):
+            return await client.get_capi_cluster("c1", "ns1")
+
+        self.assertRaises(
+            requests.HTTPError, self._run, lambda *args: (500, {}), fetch
+        )
+
+    def test_fetch_all_by_label(self):
+        def handler(method, path, params, body):
+            if "continue" in params:
+                return 200, {
+                    "metadata": {},
+                    "items": [base.k8s_object("m2", "ns1")],
+                }
+            return 200, {
+                "metadata": {"continue": "token1"},
+                "items": [base.k8s_object("m1", "ns1")],
+            }
+
+        async def fetch_all(client):
+            resource = client.resource(kubernetes.Machine)
+            return [
+                obj
+                async for obj in resource.fetch_all_by_label(
+                    {"foo": "bar"}, "ns1"
+                )
+            ]
+
+        server, machines = self._run(handler, fetch_all, chunked=True)
+
+        self.assertEqual(
+            [base.k8s_object("m1", "ns1"), base.k8s_object("m2", "ns1")],
+            machines,
+        )
+        self.assertEqual(
+            [
+                {"labelSelector": "foo=bar", "limit": "500"},
+                {
+                    "labelSelector": "foo=bar",
+                    "limit": "500",
+                    "continue": "token1",
+                },
+            ],
+            [request[2] for request in server.requests],
+        )
+
+    def test_apply_and_delete(self):
+        async def apply_and_delete(client):
+            resource = client.resource(kubernetes.Secret)
+            applied = await resource.apply(
+                "s1", {"data": {"a": "b"}}, namespace="ns1"
+            )
+            await resource.delete("s1", "ns1")
+            await resource.delete_all_by_label("foo", "bar", "ns1")
+            return applied
+
+        server, applied = self._run(
+            lambda method, path, params, body: (200, body or {}),
+            apply_and_delete,
+        )
+
+        body = {
+            "data": {"a": "b"},
+            "apiVersion": "v1",
+            "kind": "Secret",
+            "metadata": {"name": "s1", "namespace": "ns1"},
+        }
+        self.assertEqual(body, applied)
+        method, path, params, headers, sent = server.requests[0]
+        self.assertEqual("PATCH", method)
+        self.assertEqual("/api/v1/namespaces/ns1/secrets/s1", path)
+        self.assertEqual({"fieldManager": "magnum", "force": "true"}, params)
+        self.assertEqual(
+            "application/apply-patch+yaml", headers["content-type"]
+        )
+        self.assertEqual(
+            [
+                ("DELETE", "/api/v1/namespaces/ns1/secrets/s1", {}),
+                (
+                    "DELETE",
+                    "/api/v1/namespaces/ns1/secrets",
+                    {"labelSelector": "foo=bar"},
+                ),
+            ],
+            [request[:3] for request in server.requests[1:]],
+        )
+
+    def test_snapshot(self):
+        def handler(method, path, params, body):
+            if "helmchartproxies" in path:
+                return 404, {}
+            namespace = path.split("/namespaces/")[1].split("/")[0]
+            return 200, {
+                "metadata": {},
+                "items": [base.k8s_object("c1", namespace)],
+            }
+
+        async def snapshot(client):
+            return await client.snapshot(["ns1", "ns2"])
+
+        server, snapshot = self._run(handler, snapshot)
+
+        self.assertEqual(12, len(server.requests))
+        self.assertEqual(
+            base.k8s_object("c1", "ns2"),
+            snapshot.get_capi_cluster("c1", "ns2"),
+        )
+        self.assertEqual(
+            2,
+            len(snapshot.get_addons_by_label({}, "ns1")),
+        )
+
+    def _fetch_raw(self, parts, count=1, **kwargs):
+        async def fetch(client):
+            resource = client.resource(kubernetes.Secret)
+            return [await resource.fetch("s1", "ns1") for _ in range(count)]
+
+        return self._run(lambda *args: list(parts), fetch, **kwargs)
+
+    def test_keep_alive(self):
+        body = json.dumps(base.k8s_object("s1", "ns1")).encode()
+        server, secrets = self._fetch_raw(
+            [
+                b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % len(body),
+                body,
+            ],
+            count=3,
+        )
+
+        self.assertEqual([base.k8s_object("s1", "ns1")] * 3, secrets)
+        self.assertEqual(1, server.connections)
+
+    @mock.patch.object(
+        kubernetes.Client, "request_timeout", return_value=(1, 0.5)
+    )
+    def test_read_timeout_per_read(self, mock_timeout):
+        self.config(api_max_retries=0, group="capi_helm")
+        body = json.dumps(base.k8s_object("s1", "ns1")).encode()
+        head = b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % len(body)
+        # Longer than the timeouts in total, but each read is in time
+        parts = [head]
+        for byte in body[:20]:
+            parts.extend([0.1, bytes([byte])])
+        server, secrets = self._fetch_raw(parts + [body[20:]])
+
+        self.assertEqual([base.k8s_object("s1", "ns1")], secrets)
+
+        self.assertRaises(
+            asyncio.TimeoutError,
+            self._fetch_raw,
+            [head, body[:5], 1, body[5:]],
+        )
+
+    def test_proxy(self):
+        async def fetch(server):
+            client = server.client(server="http://k8s.example.com")
+            client.sync_client.proxies = {
+                "http": f"http://127.0.0.1:{server.port}"
+            }
+            async with async_kubernetes.AsyncClient(client.sync_client) as c:
+                return await c.get_capi_cluster("c1", "ns1")
+
+        async def run():
+            async with FakeServer(
+                lambda *args: (200, base.k8s_object("c1", "ns1"))
+            ) as server:
+                return server, await fetch(server)
+
+        server, cluster = asyncio.run(run())
+
+        self.assertEqual(base.k8s_object("c1", "ns1"), cluster)
+        # Sent to the proxy, for the server
+        self.assertEqual("k8s.example.com", server.requests[0][3]["host"])
+
+    def test_requires_aiohttp(self):
+        with mock.patch.object(async_kubernetes, "aiohttp", None):
+            self.assertRaises(
+                RuntimeError, async_kubernetes.AsyncClient, mock.Mock()
+            )
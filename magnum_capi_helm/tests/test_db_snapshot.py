@@ -0,0 +1,123 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import asyncio
+from unittest import mock
+
+from magnum_capi_helm import db_snapshot
+from magnum_capi_helm import metrics
+from magnum_capi_helm.tests import base
+
+
+class FakeCluster:
+    def __init__(self, nodegroups):
+        self._nodegroups = nodegroups
+        self.queries = 0
+
+    @property
+    def nodegroups(self):
+        self.queries += 1
+        return list(self._nodegroups)
+
+
+def _nodegroup(name, role="worker", is_default=False, node_count=1):
+    return mock.Mock(
+        spec=["name", "role", "is_default", "node_count", "save", "destroy"],
+        role=role,
+        is_default=is_default,
+        node_count=node_count,
+    )
+
+
+class TestDBSnapshot(base.TestCase):
+    def setUp(self):
+        super(TestDBSnapshot, self).setUp()
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        self.master = _nodegroup("master", "master", True, 3)
+        self.worker = _nodegroup("worker", "worker", True, 2)
+        self.extra = _nodegroup("extra", "worker", False, 5)
+        self.cluster = FakeCluster([self.master, self.worker, self.extra])
+
+    def test_scope(self):
+        with db_snapshot.scope(self.cluster) as snapshot:
+            self.assertIs(snapshot, db_snapshot.get(self.cluster))
+            with db_snapshot.scope(self.cluster) as nested:
+                self.assertIs(snapshot, nested)
+
+            self.assertEqual(3, len(snapshot.nodegroups))
+            self.assertIs(self.worker, snapshot.default_ng_worker)
+            self.assertEqual(3, snapshot.master_count)
+            self.assertEqual(
+                [self.master, self.worker, self.extra],
+                db_snapshot.get(self.cluster).nodegroups,
+            )
+
+        self.assertEqual(1, self.cluster.queries)
+        self.assertEqual(3, metrics.get("db_queries_saved"))
+
+        # Outside of the scope, the node groups are loaded each time
+        self.assertIsNot(snapshot, db_snapshot.get(self.cluster))
+        db_snapshot.get(self.cluster).nodegroups
+        self.assertEqual(2, self.cluster.queries)
+
+    def test_scope_other_cluster(self):
+        other = FakeCluster([])
+        with db_snapshot.scope(self.cluster) as snapshot:
+            self.assertIsNot(snapshot, db_snapshot.get(other))
+
+    def test_scope_per_task(self):
+        other = FakeCluster([])
+
+        async def use(cluster, entered, other_entered):
+            with db_snapshot.scope(cluster) as snapshot:
+                entered.set()
+                await other_entered.wait()
+                # The scope of the other task is not seen
+                return [
+                    db_snapshot.get(c) is snapshot
+                    for c in (self.cluster, other)
+                ]
+
+        async def main():
+            first, second = asyncio.Event(), asyncio.Event()
+            return await asyncio.gather(
+                use(self.cluster, first, second),
+                use(other, second, first),
+            )
+
+        self.assertEqual([[True, False], [False, True]], asyncio.run(main()))
+
+    def test_save(self):
+        with db_snapshot.scope(self.cluster) as snapshot:
+            snapshot.nodegroups
+
+            # Held node groups are already up to date
+            snapshot.save(self.worker)
+            snapshot.nodegroups
+            self.assertEqual(1, self.cluster.queries)
+
+            # New node groups cause the snapshot to be reloaded
+            new = _nodegroup("new")
+            self.cluster._nodegroups.append(new)
+            snapshot.save(new)
+            self.assertIn(new, snapshot.nodegroups)
+            self.assertEqual(2, self.cluster.queries)
+
+            self.cluster._nodegroups.remove(new)
+            snapshot.destroy(new)
+            self.assertNotIn(new, snapshot.nodegroups)
+            self.assertEqual(3, self.cluster.queries)
+
+        self.worker.save.assert_called_once_with()
+        new.save.assert_called_once_with()
+        new.destroy.assert_called_once_with()
@@ -0,0 +1,85 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import asyncio
+from concurrent import futures
+import time
+from unittest import mock
+
+from magnum_capi_helm import deadline
+from magnum_capi_helm.tests import base
+
+
+class TestDeadline(base.TestCase):
+    @mock.patch.object(time, "monotonic")
+    def test_scope(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        self.assertIsNone(deadline.remaining())
+        self.assertEqual(5, deadline.timeout(5))
+
+        with deadline.scope(30):
+            self.assertEqual(30, deadline.remaining())
+            # Nested scopes can shorten, but not extend, the deadline
+            with deadline.scope(60):
+                self.assertEqual(30, deadline.remaining())
+            with deadline.scope(10):
+                self.assertEqual(10, deadline.remaining())
+            with deadline.scope(0):
+                self.assertEqual(30, deadline.remaining())
+
+            mock_monotonic.return_value = 120
+            self.assertEqual(5, deadline.timeout(5))
+            self.assertEqual(10, deadline.timeout(60))
+            self.assertEqual(10, deadline.timeout(None))
+            self.assertFalse(deadline.passed())
+
+            mock_monotonic.return_value = 130
+            self.assertTrue(deadline.passed())
+            self.assertRaises(deadline.DeadlineExceeded, deadline.timeout, 5)
+
+        self.assertIsNone(deadline.remaining())
+        self.assertFalse(deadline.passed())
+
+    def test_propagate(self):
+        with futures.ThreadPoolExecutor(1) as executor:
+            with deadline.scope(30):
+                remaining = executor.submit(
+                    deadline.propagate(deadline.remaining)
+                ).result()
+                unbound = executor.submit(deadline.remaining).result()
+
+        self.assertTrue(0 < remaining <= 30)
+        self.assertIsNone(unbound)
+
+    def test_propagate_concurrent(self):
+        with deadline.scope(30):
+            func = deadline.propagate(deadline.remaining)
+        with futures.ThreadPoolExecutor(4) as executor:
+            # The same wrapper can run in several threads at once
+            remaining = list(executor.map(lambda _: func(), range(8)))
+
+        self.assertTrue(all(0 < left <= 30 for left in remaining))
+        self.assertIsNone(deadline.remaining())
+
+    def test_scope_per_task(self):
+        async def task(seconds):
+            with deadline.scope(seconds):
+                await asyncio.sleep(0)
+                return deadline.remaining()
+
+        async def main():
+            return await asyncio.gather(task(10), task(60))
+
+        # Each task has its own deadline, even on the same thread
+        short, long = asyncio.run(main())
+        self.assertTrue(0 < short <= 10)
+        self.assertTrue(10 < long <= 60)
@@ -9,23 +9,31 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import asyncio
+import threading
 from unittest import mock
 from uuid import uuid4
 
 from magnum.common import exception
 from magnum.common import neutron
+from magnum import objects
 from magnum.objects import fields
 from magnum.tests.unit.db import base
 from magnum.tests.unit.objects import utils as obj_utils
 
+from magnum_capi_helm import async_kubernetes
 from magnum_capi_helm.common import app_creds
 from magnum_capi_helm.common import ca_certificates
 from magnum_capi_helm.common import capi_monitor
 from magnum_capi_helm import conf
+from magnum_capi_helm import deadline
 from magnum_capi_helm import driver
 from magnum_capi_helm import driver_utils
 from magnum_capi_helm import helm
 from magnum_capi_helm import kubernetes
+from magnum_capi_helm import metrics
+from magnum_capi_helm import release
+from magnum_capi_helm import status_watcher
 
 CONF = conf.CONF
 
@@ -33,6 +41,9 @@ CONF = conf.CONF
 class ClusterAPIDriverTest(base.DbTestCase):
     def setUp(self):
         super(ClusterAPIDriverTest, self).setUp()
+        # Don't share mocked kubernetes clients between tests
+        self.addCleanup(kubernetes._shared_clients.clear)
+        self.addCleanup(kubernetes._shared_client_refs.clear)
         self.driver = driver.Driver()
         self.cluster_obj = obj_utils.create_test_cluster(
             self.context,
@@ -47,6 +58,107 @@ class ClusterAPIDriverTest(base.DbTestCase):
                 ng.flavor_id = "flavor_medium"
                 ng.save()
 
+    @mock.patch.object(kubernetes.Client, "shared")
+    def test_k8s_client_released(self, mock_shared):
+        k8s_client = self.driver._k8s_client
+
+        self.assertIs(mock_shared.return_value, k8s_client)
+        self.assertIs(k8s_client, self.driver._k8s_client)
+        mock_shared.assert_called_once_with()
+
+        del self.driver
+        k8s_client.release.assert_called_once_with()
+
+    @mock.patch.object(status_watcher, "get_watcher")
+    @mock.patch.object(driver.Driver, "_get_capi_cluster")
+    def test_update_cluster_status_watched(
+        self, mock_get_capi_cluster, mock_get_watcher
+    ):
+        mock_watcher = mock_get_watcher.return_value
+        mock_watcher.should_poll.return_value = False
+
+        self.driver.update_cluster_status(self.context, self.cluster_obj)
+
+        mock_watcher.should_poll.assert_called_once_with(
+            self.cluster_obj, "status"
+        )
+        mock_get_capi_cluster.assert_not_called()
+
+    @mock.patch.object(kubernetes, "Snapshot")
+    @mock.patch.object(driver.Driver, "update_cluster_status")
+    @mock.patch.object(kubernetes.Client, "load")
+    def test_update_clusters_status(
+        self, mock_load, mock_update_status, mock_snapshot
+    ):
+        other_cluster = obj_utils.create_test_cluster(
+            self.context,
+            uuid=str(uuid4()),
+            name="other",
+            project_id="otherproject",
+            stack_id="other-222222222222",
+        )
+        clients_used = []
+
+        def update_status(context, cluster):
+            clients_used.append(self.driver._k8s_client)
+            if cluster is self.cluster_obj:
+                raise Exception("failed")
+
+        mock_update_status.side_effect = update_status
+
+        self.driver.update_clusters_status(
+            self.context, [self.cluster_obj, other_cluster]
+        )
+
+        mock_snapshot.assert_called_once_with(
+            mock_load.return_value,
+            ["magnum-fakeproject", "magnum-otherproject"],
+        )
+        # A failure for one cluster does not stop the others
+        mock_update_status.assert_has_calls(
+            [
+                mock.call(self.context, self.cluster_obj),
+                mock.call(self.context, other_cluster),
+            ]
+        )
+        self.assertEqual([mock_snapshot.return_value] * 2, clients_used)
+        # The snapshot is only used for the batch
+        self.assertIs(mock_load.return_value, self.driver._k8s_client)
+
+    @mock.patch.object(async_kubernetes, "AsyncClient")
+    @mock.patch.object(driver.Driver, "update_cluster_status")
+    @mock.patch.object(kubernetes.Client, "load")
+    def test_update_clusters_status_async(
+        self, mock_load, mock_update_status, mock_async_client
+    ):
+        client = mock_async_client.return_value.__aenter__.return_value
+        client.snapshot = mock.AsyncMock()
+        clients_used = []
+        threads_used = []
+
+        def update_status(context, cluster):
+            clients_used.append(self.driver._k8s_client)
+            threads_used.append(threading.current_thread())
+
+        mock_update_status.side_effect = update_status
+
+        asyncio.run(
+            self.driver.update_clusters_status_async(
+                self.context, [self.cluster_obj]
+            )
+        )
+
+        mock_async_client.assert_called_once_with(mock_load.return_value)
+        client.snapshot.assert_awaited_once_with(["magnum-fakeproject"])
+        mock_update_status.assert_called_once_with(
+            self.context, self.cluster_obj
+        )
+        self.assertEqual([client.snapshot.return_value], clients_used)
+        # Updated off the event loop, as the database calls block
+        self.assertIsNot(threading.main_thread(), threads_used[0])
+        # The connections are closed before the status is updated
+        mock_async_client.return_value.__aexit__.assert_awaited_once()
+
     def test_provides(self):
         self.assertEqual(
             [
@@ -131,6 +243,76 @@ class ClusterAPIDriverTest(base.DbTestCase):
         mock_update.assert_not_called()
         mock_delete.assert_called_once_with(self.context, self.cluster_obj)
 
+    @mock.patch.object(driver.Driver, "_update_status_updating")
+    @mock.patch.object(driver.Driver, "_update_all_nodegroups_status")
+    @mock.patch.object(driver.Driver, "_get_capi_cluster")
+    def test_update_cluster_status_circuit_open(
+        self, mock_capi, mock_ng, mock_update
+    ):
+        mock_capi.side_effect = kubernetes.CircuitOpen()
+        self.cluster_obj.status = fields.ClusterStatus.CREATE_IN_PROGRESS
+
+        self.driver.update_cluster_status(self.context, self.cluster_obj)
+
+        mock_ng.assert_not_called()
+        mock_update.assert_not_called()
+        self.assertEqual(
+            fields.ClusterStatus.CREATE_IN_PROGRESS, self.cluster_obj.status
+        )
+
+    @mock.patch.object(driver.Driver, "_update_status_deleting")
+    @mock.patch.object(driver.Driver, "_update_all_nodegroups_status")
+    @mock.patch.object(driver.Driver, "_get_capi_cluster")
+    def test_update_cluster_status_deadline(
+        self, mock_capi, mock_ng, mock_delete
+    ):
+        self.config(status_update_timeout=30, group="capi_helm")
+        remaining = []
+
+        def get_capi_cluster(cluster):
+            remaining.append(deadline.remaining())
+            raise deadline.DeadlineExceeded("timed out")
+
+        mock_capi.side_effect = get_capi_cluster
+        self.cluster_obj.status = fields.ClusterStatus.DELETE_IN_PROGRESS
+
+        self.driver.update_cluster_status(self.context, self.cluster_obj)
+
+        self.assertTrue(0 < remaining[0] <= 30)
+        mock_ng.assert_not_called()
+        mock_delete.assert_not_called()
+        self.assertEqual(
+            fields.ClusterStatus.DELETE_IN_PROGRESS, self.cluster_obj.status
+        )
+        self.assertIsNone(deadline.remaining())
+
+    @mock.patch.object(driver.Driver, "_update_status_deleting")
+    @mock.patch.object(driver.Driver, "_update_all_nodegroups_status")
+    @mock.patch.object(driver.Driver, "_get_capi_cluster")
+    def test_update_cluster_status_deleted_consistent_read(
+        self, mock_capi, mock_ng, mock_delete
+    ):
+        # The watch cache is behind, so the cluster still exists
+        consistencies = []
+
+        def get_capi_cluster(cluster):
+            consistency = kubernetes._consistency.get()
+            consistencies.append(consistency)
+            if consistency == kubernetes.CONSISTENT_READ:
+                return {"spec": {}}
+
+        mock_capi.side_effect = get_capi_cluster
+        self.cluster_obj.status = fields.ClusterStatus.DELETE_IN_PROGRESS
+
+        self.driver.update_cluster_status(self.context, self.cluster_obj)
+
+        self.assertEqual(
+            [kubernetes.CACHED_READ, kubernetes.CONSISTENT_READ],
+            consistencies,
+        )
+        mock_delete.assert_not_called()
+        self.assertIsNone(kubernetes._consistency.get())
+
     @mock.patch.object(driver.Driver, "_update_status_deleting")
     @mock.patch.object(driver.Driver, "_update_status_updating")
     @mock.patch.object(driver.Driver, "_update_all_nodegroups_status")
@@ -301,7 +483,7 @@ class ClusterAPIDriverTest(base.DbTestCase):
         nodegroup.name = "workers"
         nodegroup.status = fields.ClusterStatus.CREATE_IN_PROGRESS
         mock_client.get_machine_deployment.return_value = None
-        mock_client.get_all_machines_by_label.return_value = None
+        mock_client.machines_exist_by_label.return_value = False
 
         self.driver._update_worker_nodegroup_status(
             self.cluster_obj, nodegroup
@@ -313,7 +495,7 @@ class ClusterAPIDriverTest(base.DbTestCase):
         mock_update.assert_called_once_with(
             self.cluster_obj, nodegroup, driver.NodeGroupState.NOT_PRESENT
         )
-        mock_client.get_all_machines_by_label.assert_not_called()
+        mock_client.machines_exist_by_label.assert_not_called()
         nodegroup.destroy.assert_not_called()
         nodegroup.save.assert_not_called()
 
@@ -327,9 +509,8 @@ class ClusterAPIDriverTest(base.DbTestCase):
         nodegroup = mock.MagicMock()
         nodegroup.name = "workers"
         nodegroup.status = fields.ClusterStatus.DELETE_IN_PROGRESS
-        machine = {"status": {}}
         mock_client.get_machine_deployment.return_value = None
-        mock_client.get_all_machines_by_label.return_value = machine
+        mock_client.machines_exist_by_label.return_value = True
 
         self.driver._update_worker_nodegroup_status(
             self.cluster_obj, nodegroup
@@ -338,7 +519,7 @@ class ClusterAPIDriverTest(base.DbTestCase):
         mock_client.get_machine_deployment.assert_called_once_with(
             "cluster-example-a-111111111111-workers", "magnum-fakeproject"
         )
-        mock_client.get_all_machines_by_label.assert_called_once_with(
+        mock_client.machines_exist_by_label.assert_called_once_with(
             {
                 "capi.stackhpc.com/cluster": "cluster-example-a-111111111111",
                 "capi.stackhpc.com/component": "worker",
@@ -361,7 +542,7 @@ class ClusterAPIDriverTest(base.DbTestCase):
         nodegroup.status = fields.ClusterStatus.DELETE_IN_PROGRESS
         nodegroup.is_default = False
         mock_client.get_machine_deployment.return_value = None
-        mock_client.get_all_machines_by_label.return_value = None
+        mock_client.machines_exist_by_label.return_value = False
 
         self.driver._update_worker_nodegroup_status(
             self.cluster_obj, nodegroup
@@ -370,7 +551,7 @@ class ClusterAPIDriverTest(base.DbTestCase):
         mock_client.get_machine_deployment.assert_called_once_with(
             "cluster-example-a-111111111111-workers", "magnum-fakeproject"
         )
-        mock_client.get_all_machines_by_label.assert_called_once_with(
+        mock_client.machines_exist_by_label.assert_called_once_with(
             {
                 "capi.stackhpc.com/cluster": "cluster-example-a-111111111111",
                 "capi.stackhpc.com/component": "worker",
@@ -557,7 +738,7 @@ class ClusterAPIDriverTest(base.DbTestCase):
     def test_nodegroup_machines_exist(self, mock_load):
         mock_client = mock.MagicMock(spec=kubernetes.Client)
         mock_load.return_value = mock_client
-        mock_client.get_all_machines_by_label.return_value = ["item1"]
+        mock_client.machines_exist_by_label.return_value = True
         nodegroup = obj_utils.create_test_nodegroup(self.context)
 
         result = self.driver._nodegroup_machines_exist(
@@ -565,7 +746,7 @@ class ClusterAPIDriverTest(base.DbTestCase):
         )
 
         self.assertTrue(result)
-        mock_client.get_all_machines_by_label.assert_called_once_with(
+        mock_client.machines_exist_by_label.assert_called_once_with(
             {
                 "capi.stackhpc.com/cluster": "cluster-example-a-111111111111",
                 "capi.stackhpc.com/component": "worker",
@@ -622,7 +803,7 @@ class ClusterAPIDriverTest(base.DbTestCase):
     @mock.patch.object(kubernetes.Client, "load")
     def test_update_status_updating_condition_false(self, mock_load):
         mock_client = mock.MagicMock(spec=kubernetes.Client)
-        mock_client.get_addons_by_label.return_value = []
+        mock_client.iter_addons_by_label.return_value = iter([])
         mock_load.return_value = mock_client
 
         self.cluster_obj.status = fields.ClusterStatus.CREATE_IN_PROGRESS
@@ -645,7 +826,7 @@ class ClusterAPIDriverTest(base.DbTestCase):
     @mock.patch.object(kubernetes.Client, "load")
     def test_update_status_updating_ready_created(self, mock_load):
         mock_client = mock.MagicMock(spec=kubernetes.Client)
-        mock_client.get_addons_by_label.return_value = []
+        mock_client.iter_addons_by_label.return_value = iter([])
         mock_load.return_value = mock_client
 
         self.cluster_obj.status = fields.ClusterStatus.CREATE_IN_PROGRESS
@@ -668,16 +849,18 @@ class ClusterAPIDriverTest(base.DbTestCase):
     @mock.patch.object(kubernetes.Client, "load")
     def test_update_status_updating_addons_unknown(self, mock_load):
         mock_client = mock.MagicMock(spec=kubernetes.Client)
-        mock_client.get_addons_by_label.return_value = [
-            {
-                "metadata": {"name": "cni"},
-                "status": {},
-            },
-            {
-                "metadata": {"name": "monitoring"},
-                "status": {},
-            },
-        ]
+        mock_client.iter_addons_by_label.return_value = iter(
+            [
+                {
+                    "metadata": {"name": "cni"},
+                    "status": {},
+                },
+                {
+                    "metadata": {"name": "monitoring"},
+                    "status": {},
+                },
+            ]
+        )
         mock_load.return_value = mock_client
 
         self.cluster_obj.status = fields.ClusterStatus.CREATE_IN_PROGRESS
@@ -700,16 +883,18 @@ class ClusterAPIDriverTest(base.DbTestCase):
     @mock.patch.object(kubernetes.Client, "load")
     def test_update_status_updating_addons_installing(self, mock_load):
         mock_client = mock.MagicMock(spec=kubernetes.Client)
-        mock_client.get_addons_by_label.return_value = [
-            {
-                "metadata": {"name": "cni"},
-                "status": {"phase": "Deployed"},
-            },
-            {
-                "metadata": {"name": "monitoring"},
-                "status": {"phase": "Installing"},
-            },
-        ]
+        mock_client.iter_addons_by_label.return_value = iter(
+            [
+                {
+                    "metadata": {"name": "cni"},
+                    "status": {"phase": "Deployed"},
+                },
+                {
+                    "metadata": {"name": "monitoring"},
+                    "status": {"phase": "Installing"},
+                },
+            ]
+        )
         mock_load.return_value = mock_client
 
         self.cluster_obj.status = fields.ClusterStatus.CREATE_IN_PROGRESS
@@ -732,16 +917,18 @@ class ClusterAPIDriverTest(base.DbTestCase):
     @mock.patch.object(kubernetes.Client, "load")
     def test_update_status_updating_addons_deployed(self, mock_load):
         mock_client = mock.MagicMock(spec=kubernetes.Client)
-        mock_client.get_addons_by_label.return_value = [
-            {
-                "metadata": {"name": "cni"},
-                "status": {"phase": "Deployed"},
-            },
-            {
-                "metadata": {"name": "monitoring"},
-                "status": {"phase": "Deployed"},
-            },
-        ]
+        mock_client.iter_addons_by_label.return_value = iter(
+            [
+                {
+                    "metadata": {"name": "cni"},
+                    "status": {"phase": "Deployed"},
+                },
+                {
+                    "metadata": {"name": "monitoring"},
+                    "status": {"phase": "Deployed"},
+                },
+            ]
+        )
         mock_load.return_value = mock_client
 
         self.cluster_obj.status = fields.ClusterStatus.CREATE_IN_PROGRESS
@@ -764,16 +951,18 @@ class ClusterAPIDriverTest(base.DbTestCase):
     @mock.patch.object(kubernetes.Client, "load")
     def test_update_status_updating_addons_failed(self, mock_load):
         mock_client = mock.MagicMock(spec=kubernetes.Client)
-        mock_client.get_addons_by_label.return_value = [
-            {
-                "metadata": {"name": "cni"},
-                "status": {"phase": "Deployed"},
-            },
-            {
-                "metadata": {"name": "monitoring"},
-                "status": {"phase": "Failed"},
-            },
-        ]
+        mock_client.iter_addons_by_label.return_value = iter(
+            [
+                {
+                    "metadata": {"name": "cni"},
+                    "status": {"phase": "Deployed"},
+                },
+                {
+                    "metadata": {"name": "monitoring"},
+                    "status": {"phase": "Failed"},
+                },
+            ]
+        )
         mock_load.return_value = mock_client
 
         self.cluster_obj.status = fields.ClusterStatus.CREATE_IN_PROGRESS
@@ -796,7 +985,7 @@ class ClusterAPIDriverTest(base.DbTestCase):
     @mock.patch.object(kubernetes.Client, "load")
     def test_update_status_updating_ready_updated(self, mock_load):
         mock_client = mock.MagicMock(spec=kubernetes.Client)
-        mock_client.get_addons_by_label.return_value = []
+        mock_client.iter_addons_by_label.return_value = iter([])
         mock_load.return_value = mock_client
 
         self.cluster_obj.status = fields.ClusterStatus.UPDATE_IN_PROGRESS
@@ -1001,6 +1190,57 @@ class ClusterAPIDriverTest(base.DbTestCase):
             "default",
         )
 
+    def test_cluster_labels(self):
+        self.cluster_obj.cluster_template.labels = dict(
+            monitoring_enabled="true",
+            boot_volume_size="42",
+            min_node_count="lots",
+            octavia_provider="ovn;",
+            api_master_lb_allowed_cidrs="10.0.0.0/8, 192.168.0.0/16 ,",
+        )
+        self.cluster_obj.labels = dict(kube_dashboard_enabled="no")
+
+        labels = driver.ClusterLabels(self.cluster_obj)
+
+        self.assertTrue(labels.get_bool("monitoring_enabled", False))
+        self.assertFalse(labels.get_bool("kube_dashboard_enabled", True))
+        self.assertTrue(labels.get_bool("auto_healing_enabled", True))
+        self.assertEqual(42, labels.get_int("boot_volume_size", 1))
+        self.assertEqual(3, labels.get_int("min_node_count", 3))
+        self.assertEqual("ovn", labels.get("octavia_provider", "amphora"))
+        self.assertEqual("a b", labels.get("octavia_lb_algorithm", "a b!"))
+        self.assertEqual(
+            ["10.0.0.0/8", "192.168.0.0/16"],
+            labels.get_csv("api_master_lb_allowed_cidrs", ""),
+        )
+        self.assertEqual(
+            ["1.2.3.4/32"],
+            labels.get_csv("extra_network_names", "1.2.3.4/32"),
+        )
+        self.assertRaises(ValueError, labels.get, "not_a_real_label", "")
+        self.assertRaises(
+            ValueError, labels.get_bool, "not_a_real_label", True
+        )
+
+    @mock.patch.object(helm, "mergeconcat", wraps=helm.mergeconcat)
+    def test_cluster_labels_resolved_once(self, mock_mergeconcat):
+        self.cluster_obj.labels = dict(monitoring_enabled="true")
+        labels = driver.ClusterLabels(self.cluster_obj)
+        mock_mergeconcat.reset_mock()
+
+        with self.driver._use_cluster_labels(labels):
+            self.assertTrue(
+                self.driver._get_monitoring_enabled(self.cluster_obj)
+            )
+            self.assertTrue(
+                self.driver._get_autoheal_enabled(self.cluster_obj)
+            )
+        mock_mergeconcat.assert_not_called()
+
+        # Outside of an operation, the labels are resolved for each lookup
+        self.driver._get_monitoring_enabled(self.cluster_obj)
+        mock_mergeconcat.assert_called_once()
+
     def test_sanitized_name_no_suffix(self):
         self.assertEqual(
             "123-456fab", driver_utils.sanitized_name("123-456Fab")
@@ -1396,6 +1636,48 @@ class ClusterAPIDriverTest(base.DbTestCase):
             self.driver, self.context, self.cluster_obj
         )
 
+    @mock.patch.object(
+        driver_utils, "get_executor", wraps=driver_utils.get_executor
+    )
+    @mock.patch.object(driver.Driver, "_storageclass_definitions")
+    @mock.patch.object(neutron, "get_network", autospec=True)
+    @mock.patch.object(driver.Driver, "_get_image_details", autospec=True)
+    @mock.patch.object(helm.Client, "install_or_upgrade", autospec=True)
+    def test_update_helm_release_lookup_error(
+        self,
+        mock_install,
+        mock_image,
+        mock_get_net,
+        mock_storageclasses,
+        mock_get_executor,
+    ):
+        mock_image.return_value = ("imageid1", "1.27.4", "ubuntu")
+        mock_get_net.return_value = "netid"
+        mock_storageclasses.side_effect = exception.MagnumException(
+            message="bad volume type"
+        )
+
+        self.assertRaisesRegex(
+            exception.MagnumException,
+            "bad volume type",
+            self.driver._update_helm_release,
+            self.context,
+            self.cluster_obj,
+        )
+
+        # All the lookups still ran, but helm was not called
+        mock_image.assert_called_once_with(
+            self.driver,
+            self.context,
+            self.cluster_obj.cluster_template.image_id,
+        )
+        mock_storageclasses.assert_called_once_with(
+            self.context, self.cluster_obj
+        )
+        mock_install.assert_not_called()
+        # With a worker for each lookup
+        mock_get_executor.assert_called_once_with(5)
+
     @mock.patch.object(driver.Driver, "_get_allowed_cidrs")
     @mock.patch.object(
         driver.Driver, "_get_k8s_keystone_auth_enabled", return_value=False
@@ -2275,10 +2557,21 @@ class ClusterAPIDriverTest(base.DbTestCase):
         volume_type = default_storage_class["name"]
         self.assertEqual("type1", volume_type)
 
+    @mock.patch.object(kubernetes.Client, "load")
     @mock.patch.object(helm.Client, "uninstall_release")
-    def test_delete_cluster(self, mock_uninstall):
+    def test_delete_cluster(self, mock_uninstall, mock_load):
+        # Installed by helm, so there is no inventory
+        mock_load.return_value.get_secret_value.return_value = None
+        remaining = []
+        mock_uninstall.side_effect = lambda *args, **kwargs: remaining.append(
+            deadline.remaining()
+        )
+
         self.driver.delete_cluster(self.context, self.cluster_obj)
 
+        # Run within the operation deadline
+        self.assertTrue(0 < remaining[0] <= 600)
+
         mock_uninstall.assert_called_once_with(
             "cluster-example-a-111111111111", namespace="magnum-fakeproject"
         )
@@ -2286,7 +2579,9 @@ class ClusterAPIDriverTest(base.DbTestCase):
     @mock.patch.object(driver.Driver, "_update_helm_release")
     def test_update_cluster(self, mock_update):
         self.driver.update_cluster(self.context, self.cluster_obj)
-        mock_update.assert_called_once_with(self.context, self.cluster_obj)
+        mock_update.assert_called_once_with(
+            self.context, self.cluster_obj, force=True
+        )
 
     @mock.patch.object(driver.Driver, "_update_helm_release")
     def test_resize_cluster(self, mock_update):
@@ -2330,7 +2625,9 @@ class ClusterAPIDriverTest(base.DbTestCase):
         )
 
         # TODO(johngarbutt) improve the testing
-        mock_update.assert_called_once_with(self.context, self.cluster_obj)
+        mock_update.assert_called_once_with(
+            self.context, self.cluster_obj, force=True
+        )
         self.assertEqual("UPDATE_IN_PROGRESS", self.cluster_obj.status)
 
     @mock.patch.object(driver.Driver, "_validate_allowed_flavor")
@@ -2369,6 +2666,40 @@ class ClusterAPIDriverTest(base.DbTestCase):
         node_group.save.assert_called_once_with()
         self.assertEqual("UPDATE_IN_PROGRESS", node_group.status)
 
+    @mock.patch.object(driver, "ClusterLabels", wraps=driver.ClusterLabels)
+    @mock.patch.object(driver.Driver, "_validate_allowed_flavor")
+    @mock.patch.object(driver.Driver, "_get_allowed_cidrs")
+    @mock.patch.object(
+        driver.Driver, "_storageclass_definitions", return_value=mock.ANY
+    )
+    @mock.patch.object(
+        driver.Driver, "_get_image_details", return_value=3 * [mock.ANY]
+    )
+    @mock.patch.object(kubernetes.Client, "load")
+    @mock.patch.object(helm.Client, "install_or_upgrade")
+    def test_update_nodegroup_cluster_labels_resolved_once(
+        self,
+        mock_helm_update,
+        mock_load,
+        mock_image_details,
+        mock_storageclasses,
+        mock_get_cidrs,
+        mock_validate_allowed_flavor,
+        mock_cluster_labels,
+    ):
+        self.cluster_obj.labels = dict(auto_scaling_enabled="true")
+        node_group = next(
+            ng for ng in self.cluster_obj.nodegroups if ng.role == "worker"
+        )
+
+        self.driver.update_nodegroup(
+            self.context, self.cluster_obj, node_group
+        )
+
+        # Shared by the node count checks and the Helm values
+        mock_helm_update.assert_called_once()
+        mock_cluster_labels.assert_called_once_with(self.cluster_obj)
+
     @mock.patch.object(driver.Driver, "_get_allowed_cidrs")
     @mock.patch.object(
         driver.Driver, "_storageclass_definitions", return_value=mock.ANY
@@ -2376,10 +2707,12 @@ class ClusterAPIDriverTest(base.DbTestCase):
     @mock.patch.object(
         driver.Driver, "_get_image_details", return_value=3 * [mock.ANY]
     )
+    @mock.patch.object(kubernetes.Client, "load")
     @mock.patch.object(helm.Client, "install_or_upgrade")
     def test_delete_nodegroup(
         self,
         mock_helm_update,
+        mock_load,
         mock_image_details,
         mock_storageclasses,
         mock_get_cidrs,
@@ -2401,6 +2734,241 @@ class ClusterAPIDriverTest(base.DbTestCase):
         remaining_nodegroups = [ng["name"] for ng in helm_values["nodeGroups"]]
         self.assertNotIn(ng_to_delete.name, remaining_nodegroups)
 
+    @mock.patch.object(driver.Driver, "_get_allowed_cidrs")
+    @mock.patch.object(
+        driver.Driver, "_storageclass_definitions", return_value={}
+    )
+    @mock.patch.object(
+        driver.Driver,
+        "_get_image_details",
+        return_value=("imageid1", "1.27.4", "ubuntu"),
+    )
+    @mock.patch.object(kubernetes.Client, "load")
+    @mock.patch.object(helm.Client, "install_or_upgrade")
+    def test_update_helm_release_loads_nodegroups_once(
+        self,
+        mock_install,
+        mock_load,
+        mock_image_details,
+        mock_storageclasses,
+        mock_get_cidrs,
+    ):
+        mock_load.return_value.get_secret_value.return_value = None
+        self.cluster_obj.labels = dict(auto_scaling_enabled="true")
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+        with mock.patch.object(
+            objects.NodeGroup, "list", wraps=objects.NodeGroup.list
+        ) as mock_list:
+            self.driver._update_helm_release(self.context, self.cluster_obj)
+
+        mock_list.assert_called_once_with(self.context, self.cluster_obj.uuid)
+        self.assertEqual(1, len(mock_install.call_args[0][2]["nodeGroups"]))
+        self.assertLess(0, metrics.get("db_queries_saved"))
+
+    @mock.patch.object(driver.Driver, "_get_allowed_cidrs")
+    @mock.patch.object(
+        driver.Driver, "_storageclass_definitions", return_value={}
+    )
+    @mock.patch.object(
+        driver.Driver,
+        "_get_image_details",
+        return_value=("imageid1", "1.27.4", "ubuntu"),
+    )
+    @mock.patch.object(kubernetes.Client, "load")
+    @mock.patch.object(helm.Client, "install_or_upgrade")
+    def test_update_helm_release_values_digest(
+        self,
+        mock_install,
+        mock_load,
+        mock_image_details,
+        mock_storageclasses,
+        mock_get_cidrs,
+    ):
+        self.config(skip_unchanged_helm_upgrades=True, group="capi_helm")
+        mock_client = mock_load.return_value
+        mock_client.get_secret_data.return_value = None
+
+        def secret(digest, status):
+            return mock.call(
+                "cluster-example-a-111111111111-values-digest",
+                {
+                    "metadata": {
+                        "labels": self.driver._k8s_resource_labels(
+                            self.cluster_obj
+                        )
+                    },
+                    "stringData": {"digest": digest, "status": status},
+                },
+                "magnum-fakeproject",
+            )
+
+        self.driver._update_helm_release(self.context, self.cluster_obj)
+
+        mock_install.assert_called_once()
+        mock_client.get_secret_data.assert_called_once_with(
+            "cluster-example-a-111111111111-values-digest",
+            "magnum-fakeproject",
+        )
+        digest = helm.values_digest(
+            "openstack-cluster",
+            mock_install.call_args[0][2],
+            repo=CONF.capi_helm.helm_chart_repo,
+            version=CONF.capi_helm.default_helm_chart_version,
+            deploy_mode="helm",
+        )
+        # Marked pending until the upgrade completes
+        self.assertEqual(
+            [
+                secret(digest, "pending-upgrade"),
+                secret(digest, "deployed"),
+            ],
+            mock_client.apply_secret.call_args_list,
+        )
+
+        # The same values again should skip the upgrade
+        mock_install.reset_mock()
+        mock_client.apply_secret.reset_mock()
+        mock_client.get_secret_data.return_value = {
+            "digest": digest,
+            "status": "deployed",
+        }
+        skipped = metrics.get("helm_upgrade_skipped")
+
+        self.driver._update_helm_release(self.context, self.cluster_obj)
+
+        mock_install.assert_not_called()
+        mock_client.apply_secret.assert_not_called()
+        self.assertEqual(skipped + 1, metrics.get("helm_upgrade_skipped"))
+
+        # Unless the upgrade is forced, by an explicit cluster update
+        self.driver.update_cluster(self.context, self.cluster_obj)
+        mock_install.assert_called_once()
+        self.assertEqual(
+            [secret(digest, "pending-upgrade"), secret(digest, "deployed")],
+            mock_client.apply_secret.call_args_list,
+        )
+
+        # Or the last upgrade did not complete
+        mock_install.reset_mock()
+        mock_client.get_secret_data.return_value = {
+            "digest": digest,
+            "status": "pending-upgrade",
+        }
+        self.driver._update_helm_release(self.context, self.cluster_obj)
+        mock_install.assert_called_once()
+
+        # Or the deploy mode changed
+        mock_install.reset_mock()
+        mock_client.get_secret_data.return_value = {
+            "digest": digest,
+            "status": "deployed",
+        }
+        self.config(deploy_mode="apply", group="capi_helm")
+        with mock.patch.object(
+            release.ApplyClient, "install_or_upgrade"
+        ) as mock_apply:
+            self.driver._update_helm_release(self.context, self.cluster_obj)
+        mock_apply.assert_called_once()
+        self.config(deploy_mode="helm", group="capi_helm")
+
+        # Or skipping is disabled
+        mock_install.reset_mock()
+        mock_client.apply_secret.reset_mock()
+        self.config(skip_unchanged_helm_upgrades=False, group="capi_helm")
+        self.driver._update_helm_release(self.context, self.cluster_obj)
+        mock_install.assert_called_once()
+        self.assertEqual(
+            [secret(digest, "deployed")],
+            mock_client.apply_secret.call_args_list,
+        )
+
+    @mock.patch.object(driver.threading, "Thread")
+    def test_chart_cache_prewarm_started(self, mock_thread):
+        self.addCleanup(setattr, driver, "_chart_cache_prewarm_started", False)
+        driver.Driver()
+        mock_thread.assert_not_called()
+
+        self.config(helm_chart_cache_dir="/cache", group="capi_helm")
+        first = driver.Driver()
+        driver.Driver()
+
+        # Once per process
+        mock_thread.assert_called_once_with(
+            target=first._prewarm_chart_cache_background,
+            name="capi-chart-cache-prewarm",
+            daemon=True,
+        )
+        mock_thread.return_value.start.assert_called_once_with()
+
+    @mock.patch.object(driver.Driver, "prewarm_chart_cache")
+    def test_prewarm_chart_cache_background(self, mock_prewarm):
+        mock_prewarm.side_effect = Exception("failed")
+
+        # Failures are logged, rather than ending the thread with an error
+        self.driver._prewarm_chart_cache_background()
+
+        context = mock_prewarm.call_args[0][0]
+        self.assertTrue(context.is_admin)
+        self.assertTrue(context.all_tenants)
+
+    @mock.patch.object(driver.Driver, "_start_chart_cache_prewarm")
+    @mock.patch.object(helm.ChartCache, "prewarm")
+    def test_prewarm_chart_cache(self, mock_prewarm, mock_start):
+        self.config(helm_chart_cache_dir="/cache", group="capi_helm")
+        self.driver = driver.Driver()
+        for idx, (labels, hidden) in enumerate(
+            [
+                ({"capi_helm_chart_version": "0.9.0"}, False),
+                ({"capi_helm_chart_version": "0.8.0"}, True),
+                ({}, False),
+            ]
+        ):
+            obj_utils.create_test_cluster_template(
+                self.context,
+                id=100 + idx,
+                uuid=str(uuid4()),
+                name=f"template{idx}",
+                labels=labels,
+                hidden=hidden,
+            )
+
+        self.driver.prewarm_chart_cache(self.context)
+
+        mock_prewarm.assert_called_once()
+        self.assertEqual(
+            [
+                (
+                    "openstack-cluster",
+                    CONF.capi_helm.helm_chart_repo,
+                    "0.9.0",
+                ),
+                (
+                    "openstack-cluster",
+                    CONF.capi_helm.helm_chart_repo,
+                    CONF.capi_helm.default_helm_chart_version,
+                ),
+            ],
+            sorted(mock_prewarm.call_args[0][0], reverse=True),
+        )
+
+    @mock.patch.object(kubernetes.Client, "load")
+    def test_release_client(self, mock_load):
+        self.assertIsInstance(
+            self.driver._get_release_client(self.cluster_obj),
+            release.HelmClient,
+        )
+
+        self.config(deploy_mode="apply", group="capi_helm")
+        release_client = self.driver._get_release_client(self.cluster_obj)
+
+        self.assertIsInstance(release_client, release.ApplyClient)
+        self.assertEqual(
+            self.cluster_obj.uuid,
+            release_client._labels["magnum.openstack.org/cluster-uuid"],
+        )
+
     def test_create_federation(self):
         self.assertRaises(
             NotImplementedError,
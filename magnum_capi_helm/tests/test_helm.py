@@ -10,14 +10,40 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import io
+import os
+import pathlib
+import random
+import subprocess
+import tarfile
+import threading
 from unittest import mock
 
+import fixtures
 from magnum.common import utils
 from oslo_concurrency import processutils
 
+from magnum_capi_helm import deadline
 from magnum_capi_helm import helm
 from magnum_capi_helm.tests import base
 
+SUMMARY = """Release "myfirstcluster" has been upgraded. Happy Helming!
+NAME: myfirstcluster
+LAST DEPLOYED: Mon Jun  3 12:00:00 2024
+NAMESPACE: mynamespace
+STATUS: deployed
+REVISION: 3
+TEST SUITE: None
+NOTES:
+STATUS: not a field
+"""
+RELEASE = {
+    "name": "myfirstcluster",
+    "namespace": "mynamespace",
+    "status": "deployed",
+    "revision": 3,
+}
+
 
 class TestHelmClient(base.TestCase):
     def test_mergeconcat_dicts(self):
@@ -38,9 +64,38 @@ class TestHelmClient(base.TestCase):
         expected = ["foo", "bar", "bar", "baz"]
         self.assertEqual(expected, result)
 
+    def test_values_digest(self):
+        digest = helm.values_digest(
+            "mychart", dict(a=1, b=dict(c=2)), repo="r", version="1"
+        )
+
+        # Key order and how the values are split up does not matter
+        self.assertEqual(
+            digest,
+            helm.values_digest(
+                "mychart",
+                dict(b=dict(c=2)),
+                dict(a=1),
+                repo="r",
+                version="1",
+            ),
+        )
+        self.assertNotEqual(
+            digest,
+            helm.values_digest(
+                "mychart", dict(a=1, b=dict(c=2)), repo="r", version="2"
+            ),
+        )
+        self.assertNotEqual(
+            digest,
+            helm.values_digest(
+                "mychart", dict(a=2, b=dict(c=2)), repo="r", version="1"
+            ),
+        )
+
     @mock.patch.object(utils, "execute")
     def test_install_or_upgrade(self, mock_execute):
-        mock_execute.return_value = '[{"foo": "bar"}]', ""
+        mock_execute.return_value = SUMMARY, ""
 
         client = helm.Client()
         result = client.install_or_upgrade(
@@ -52,7 +107,7 @@ class TestHelmClient(base.TestCase):
             namespace="mynamespace",
         )
 
-        self.assertEqual([{"foo": "bar"}], result)
+        self.assertEqual(RELEASE, result)
         mock_execute.assert_called_once_with(
             "helm",
             "upgrade",
@@ -61,8 +116,6 @@ class TestHelmClient(base.TestCase):
             "--history-max",
             10,
             "--install",
-            "--output",
-            "json",
             "--timeout",
             "5m",
             "--values",
@@ -73,12 +126,12 @@ class TestHelmClient(base.TestCase):
             "http://myrepo",
             "--version",
             "v1.42",
-            process_input='{"foo": "bar", "b": 42}',
+            process_input='{"foo":"bar","b":42}',
         )
 
     @mock.patch.object(utils, "execute")
     def test_install_or_upgrade_oci(self, mock_execute):
-        mock_execute.return_value = '[{"foo": "bar"}]', ""
+        mock_execute.return_value = SUMMARY, ""
 
         client = helm.Client()
         result = client.install_or_upgrade(
@@ -89,7 +142,7 @@ class TestHelmClient(base.TestCase):
             namespace="mynamespace",
         )
 
-        self.assertEqual([{"foo": "bar"}], result)
+        self.assertEqual(RELEASE, result)
         mock_execute.assert_called_once_with(
             "helm",
             "upgrade",
@@ -98,8 +151,6 @@ class TestHelmClient(base.TestCase):
             "--history-max",
             10,
             "--install",
-            "--output",
-            "json",
             "--timeout",
             "5m",
             "--values",
@@ -108,7 +159,142 @@ class TestHelmClient(base.TestCase):
             "mynamespace",
             "--version",
             "v1.42",
-            process_input='{"foo": "bar", "b": 42}',
+            process_input='{"foo":"bar","b":42}',
+        )
+
+    @mock.patch.object(utils, "execute")
+    def test_template(self, mock_execute):
+        self.addCleanup(helm._template_cache.clear)
+        mock_execute.return_value = (
+            "---\nkind: Cluster\nmetadata:\n  name: c1\n"
+            "---\n# empty\n"
+            "---\nkind: Secret\nmetadata:\n  name: s1\n",
+            "",
+        )
+
+        client = helm.Client()
+        result = client.template(
+            "myfirstcluster",
+            "mychart",
+            dict(foo="bar"),
+            repo="http://myrepo",
+            version="v1.42",
+            namespace="mynamespace",
+        )
+
+        self.assertEqual(
+            [
+                {"kind": "Cluster", "metadata": {"name": "c1"}},
+                {"kind": "Secret", "metadata": {"name": "s1"}},
+            ],
+            result,
+        )
+        mock_execute.assert_called_once_with(
+            "helm",
+            "template",
+            "myfirstcluster",
+            "mychart",
+            "--values",
+            "-",
+            "--namespace",
+            "mynamespace",
+            "--no-hooks",
+            "--repo",
+            "http://myrepo",
+            "--version",
+            "v1.42",
+            process_input='{"foo":"bar"}',
+        )
+
+        # The same values are rendered from the cache
+        cached = client.template(
+            "myfirstcluster",
+            "mychart",
+            dict(foo="bar"),
+            repo="http://myrepo",
+            version="v1.42",
+            namespace="mynamespace",
+        )
+        self.assertIs(result, cached)
+        mock_execute.assert_called_once()
+
+        client.template(
+            "myfirstcluster",
+            "mychart",
+            dict(foo="baz"),
+            repo="http://myrepo",
+            version="v1.42",
+            namespace="mynamespace",
+        )
+        self.assertEqual(2, mock_execute.call_count)
+
+    @mock.patch.object(utils, "execute")
+    def test_uninstall_release_deadline(self, mock_execute):
+        mock_execute.return_value = "", ""
+
+        with deadline.scope(90.5):
+            helm.Client().uninstall_release(
+                "myfirstcluster", namespace="mynamespace"
+            )
+
+        args, kwargs = mock_execute.call_args
+        # Limited to the time remaining, rather than the default 5m
+        self.assertIn(args[args.index("--timeout") + 1], ("90s", "91s"))
+        # helm is given time to exit after its own timeout
+        self.assertGreater(kwargs["timeout"], 90)
+        self.assertLessEqual(kwargs["timeout"], 90.5 + helm._STOP_GRACE_PERIOD)
+
+    @mock.patch.object(utils, "execute")
+    def test_deadline_exceeded(self, mock_execute):
+        process = mock.Mock()
+
+        def execute(*args, **kwargs):
+            kwargs["on_execute"](process)
+            raise subprocess.TimeoutExpired(args, kwargs["timeout"])
+
+        mock_execute.side_effect = execute
+
+        with deadline.scope(60):
+            self.assertRaises(
+                deadline.DeadlineExceeded,
+                helm.Client().uninstall_release,
+                "myfirstcluster",
+                namespace="mynamespace",
+            )
+
+        # Asked to exit, then reaped
+        process.terminate.assert_called_once_with()
+        process.wait.assert_called_once_with(timeout=helm._STOP_GRACE_PERIOD)
+        process.kill.assert_not_called()
+
+    @mock.patch.object(utils, "execute")
+    def test_deadline_exceeded_kill(self, mock_execute):
+        process = mock.Mock()
+        process.wait.side_effect = [
+            subprocess.TimeoutExpired("helm", helm._STOP_GRACE_PERIOD),
+            0,
+        ]
+
+        def execute(*args, **kwargs):
+            kwargs["on_execute"](process)
+            raise subprocess.TimeoutExpired(args, kwargs["timeout"])
+
+        mock_execute.side_effect = execute
+
+        with deadline.scope(60):
+            self.assertRaises(
+                deadline.DeadlineExceeded,
+                helm.Client().uninstall_release,
+                "myfirstcluster",
+                namespace="mynamespace",
+            )
+
+        # Killed once it does not exit, then reaped
+        process.terminate.assert_called_once_with()
+        process.kill.assert_called_once_with()
+        self.assertEqual(
+            [mock.call(timeout=helm._STOP_GRACE_PERIOD), mock.call()],
+            process.wait.call_args_list,
         )
 
     @mock.patch.object(helm.CONF, "capi_helm")
@@ -116,6 +302,7 @@ class TestHelmClient(base.TestCase):
     def test_uninstall_release_works(self, mock_execute, mock_conf):
         mock_execute.return_value = "", ""
         mock_conf.kubeconfig_file = "/etc/magnum/kubeconfig"
+        mock_conf.helm_timeout = 300
 
         client = helm.Client()
         result = client.uninstall_release(
@@ -161,3 +348,202 @@ class TestHelmClient(base.TestCase):
             "myfirstcluster",
             namespace="mynamespace",
         )
+
+
+class TestChartCache(base.TestCase):
+    def setUp(self):
+        super(TestChartCache, self).setUp()
+        self.cache_dir = self.useFixture(fixtures.TempDir()).path
+        self.config(helm_chart_cache_dir=self.cache_dir, group="capi_helm")
+        self.client = helm.Client()
+        self.cache = self.client.chart_cache
+
+    def _fake_pull(self, version=None, size=100):
+        def pull(*command, **kwargs):
+            chart_version = version or command[command.index("--version") + 1]
+            destination = command[command.index("--destination") + 1]
+            chart_yaml = f"name: mychart\nversion: {chart_version}\n".encode()
+            with tarfile.open(
+                os.path.join(destination, f"mychart-{chart_version}.tgz"),
+                "w:gz",
+            ) as tar:
+                for name, data in [
+                    ("mychart/Chart.yaml", chart_yaml),
+                    ("mychart/padding", random.Random(0).randbytes(size)),
+                ]:
+                    info = tarfile.TarInfo(name)
+                    info.size = len(data)
+                    tar.addfile(info, io.BytesIO(data))
+            return "", ""
+
+        return pull
+
+    @mock.patch.object(utils, "execute")
+    def test_get_pulls_once(self, mock_execute):
+        mock_execute.side_effect = self._fake_pull()
+
+        path1 = self.cache.get("mychart", repo="http://myrepo", version="1.0")
+        path2 = self.cache.get("mychart", repo="http://myrepo", version="1.0")
+
+        self.assertEqual(path1, path2)
+        self.assertTrue(path1.exists())
+        self.assertEqual("mychart-1.0.tgz", path1.name)
+        mock_execute.assert_called_once_with(
+            "helm",
+            "pull",
+            "mychart",
+            "--version",
+            "1.0",
+            "--destination",
+            mock.ANY,
+            "--repo",
+            "http://myrepo",
+        )
+
+    @mock.patch.object(utils, "execute")
+    def test_get_wrong_version(self, mock_execute):
+        mock_execute.side_effect = self._fake_pull(version="2.0")
+
+        self.assertRaises(
+            helm.ChartCacheError,
+            self.cache.get,
+            "mychart",
+            repo="http://myrepo",
+            version="1.0",
+        )
+        self.assertEqual([], list(pathlib.Path(self.cache_dir).glob("*/*")))
+
+    @mock.patch.object(utils, "execute")
+    def test_evicts_least_recently_used(self, mock_execute):
+        mock_execute.side_effect = self._fake_pull(size=4096)
+        path1 = self.cache.get("mychart", repo="r", version="1.0")
+        path2 = self.cache.get("mychart", repo="r", version="2.0")
+        os.utime(path1, (1, 1))
+        os.utime(path2, (2, 2))
+        # Room for two charts only
+        self.cache._max_size = path1.stat().st_size * 2 + 1
+
+        path3 = self.cache.get("mychart", repo="r", version="3.0")
+
+        self.assertFalse(path1.exists())
+        self.assertTrue(path2.exists())
+        self.assertTrue(path3.exists())
+
+    @mock.patch.object(utils, "execute")
+    def test_evict_keeps_charts_in_use(self, mock_execute):
+        mock_execute.side_effect = self._fake_pull(size=4096)
+        path1 = self.cache.get("mychart", repo="r", version="1.0")
+        path2 = self.cache.get("mychart", repo="r", version="2.0")
+        os.utime(path2, (2, 2))
+        self.cache._max_size = path1.stat().st_size * 2 + 1
+
+        with self.cache.use("mychart", repo="r", version="1.0") as path:
+            # e.g. passed to a running helm upgrade
+            os.utime(path1, (1, 1))
+            path3 = self.cache.get("mychart", repo="r", version="3.0")
+            self.assertTrue(path.exists())
+
+        self.assertEqual(path1, path)
+        self.assertFalse(path2.exists())
+        self.assertTrue(path3.exists())
+        self.assertEqual({}, dict(self.cache._in_use))
+
+    @mock.patch.object(utils, "execute")
+    def test_evict_keeps_recently_used(self, mock_execute):
+        # Possibly in use by another process sharing the cache
+        mock_execute.side_effect = self._fake_pull(size=4096)
+        path1 = self.cache.get("mychart", repo="r", version="1.0")
+        self.cache._max_size = 1
+
+        path2 = self.cache.get("mychart", repo="r", version="2.0")
+
+        self.assertTrue(path1.exists())
+        self.assertTrue(path2.exists())
+
+    @mock.patch.object(utils, "execute")
+    def test_pull_does_not_block_other_charts(self, mock_execute):
+        pull = self._fake_pull()
+        pulling = threading.Event()
+        finish = threading.Event()
+
+        def execute(*command, **kwargs):
+            if "1.0" in command:
+                pulling.set()
+                finish.wait(10)
+            return pull(*command, **kwargs)
+
+        mock_execute.side_effect = execute
+        thread = threading.Thread(
+            target=self.cache.get,
+            args=("mychart",),
+            kwargs={"repo": "r", "version": "1.0"},
+        )
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(finish.set)
+        pulling.wait(10)
+
+        path = self.cache.get("mychart", repo="r", version="2.0")
+
+        self.assertTrue(path.exists())
+        self.assertTrue(thread.is_alive())
+
+    @mock.patch.object(utils, "execute")
+    def test_prewarm_ignores_failures(self, mock_execute):
+        pull = self._fake_pull()
+
+        def execute(*command, **kwargs):
+            if "1.0" in command:
+                raise processutils.ProcessExecutionError(stderr="not found")
+            return pull(*command, **kwargs)
+
+        mock_execute.side_effect = execute
+
+        self.cache.prewarm([("mychart", "r", "1.0"), ("mychart", "r", "2.0")])
+
+        self.assertEqual(2, mock_execute.call_count)
+        self.assertEqual(
+            ["mychart-2.0.tgz"],
+            [p.name for p in pathlib.Path(self.cache_dir).glob("*/*.tgz")],
+        )
+
+    @mock.patch.object(utils, "execute")
+    def test_install_or_upgrade_cached(self, mock_execute):
+        pull = self._fake_pull()
+
+        def execute(*command, **kwargs):
+            if command[1] == "pull":
+                return pull(*command, **kwargs)
+            return "", ""
+
+        mock_execute.side_effect = execute
+
+        self.client.install_or_upgrade(
+            "myfirstcluster",
+            "mychart",
+            dict(foo="bar"),
+            repo="http://myrepo",
+            version="1.0",
+            namespace="mynamespace",
+        )
+
+        chart_path = self.cache.get(
+            "mychart", repo="http://myrepo", version="1.0"
+        )
+        self.assertEqual(2, mock_execute.call_count)
+        mock_execute.assert_called_with(
+            "helm",
+            "upgrade",
+            "myfirstcluster",
+            chart_path,
+            "--history-max",
+            10,
+            "--install",
+            "--timeout",
+            "5m",
+            "--values",
+            "-",
+            "--namespace",
+            "mynamespace",
+            process_input='{"foo":"bar"}',
+        )
@@ -10,19 +10,37 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import asyncio
 import base64
+import copy
+import datetime
+import gzip
+import http.server
+import json
 import os
 import pathlib
+import random
+import ssl
 import tempfile
+import threading
+import time
 from unittest import mock
 import yaml
 
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import serialization
+from cryptography import x509
 import requests
 
+from magnum_capi_helm import deadline
 from magnum_capi_helm import kubernetes
+from magnum_capi_helm import metrics
 from magnum_capi_helm.tests import base
 
 TEST_SERVER = "https://test:6443"
+
+
 TEST_KUBECONFIG_YAML = f"""\
 apiVersion: v1
 clusters:
@@ -46,7 +64,51 @@ users:
 TEST_KUBECONFIG = yaml.safe_load(TEST_KUBECONFIG_YAML)
 
 
+def _certificate():
+    """Returns a self-signed certificate and its key, as PEM."""
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(x509.NameOID.COMMON_NAME, "test")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), True)
+        .sign(key, hashes.SHA256())
+    )
+    return (
+        cert.public_bytes(serialization.Encoding.PEM),
+        key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        ),
+    )
+
+
+def _tls_kubeconfig(cert, key):
+    kubeconfig = yaml.safe_load(TEST_KUBECONFIG_YAML)
+    cluster = kubeconfig["clusters"][0]["cluster"]
+    user = kubeconfig["users"][0]["user"]
+    del cluster["certificate-authority"]
+    del user["client-certificate"]
+    del user["client-key"]
+    cluster["certificate-authority-data"] = base64.b64encode(cert).decode()
+    user["client-certificate-data"] = base64.b64encode(cert).decode()
+    user["client-key-data"] = base64.b64encode(key).decode()
+    return kubeconfig
+
+
 class TestKubernetesClient(base.TestCase):
+    def setUp(self):
+        super().setUp()
+        # Discovery is tested separately, see TestDiscovery
+        self.config(api_discovery_ttl=0, group="capi_helm")
+
     def assert_request_called_once_with(self, mock_request, *args, **kwargs):
         # requests >= 2.34 makes Session.get() pass params=None explicitly
         # to Session.request(); older versions omit it. Drop the implicit
@@ -60,35 +122,6 @@ class TestKubernetesClient(base.TestCase):
         self.assertEqual(args, actual_args)
         self.assertEqual(kwargs, actual_kwargs)
 
-    # Basic lookup, non "-data" key
-    def test_file_or_data(self):
-        client = kubernetes.Client(TEST_KUBECONFIG)
-        data = client.ensure_file_cert(dict(key="mydata"), "key")
-        self.assertEqual("mydata", data)
-
-    # Lookup with a "-data" key, requiring temporary file
-    @mock.patch.object(tempfile, "NamedTemporaryFile")
-    def test_file_or_data_create_temp(self, mock_temp):
-        client = kubernetes.Client(TEST_KUBECONFIG)
-        data = client.ensure_file_cert(
-            {"key-data": base64.b64encode(b"mydata").decode("utf-8")}, "key"
-        )
-        mock_temp.assert_has_calls(
-            [
-                mock.call(delete=False),
-                mock.call().__enter__(),
-                mock.call().__enter__().write(b"mydata"),
-                mock.call().__exit__(None, None, None),
-            ]
-        )
-        self.assertEqual(mock_temp().__enter__().name, data)
-
-    # Lookup with no key, expecting no error, and no data returned.
-    def test_file_or_data_missing(self):
-        client = kubernetes.Client(TEST_KUBECONFIG)
-        data = client.ensure_file_cert(dict(), "key")
-        self.assertIsNone(data)
-
     def test_client_constructor(self):
         client = kubernetes.Client(TEST_KUBECONFIG)
 
@@ -97,33 +130,76 @@ class TestKubernetesClient(base.TestCase):
         self.assertEqual(("certfile", "keyfile"), client.cert)
 
     @mock.patch.object(tempfile, "NamedTemporaryFile")
-    @mock.patch.object(os, "remove")
-    def test_client_certificate_finalizer(self, mock_remove, mock_temp):
-        kubeconfig = yaml.safe_load(TEST_KUBECONFIG_YAML)
+    def test_client_tls_data(self, mock_temp):
+        cert, key = _certificate()
+        kubeconfig = _tls_kubeconfig(cert, key)
 
-        # Set -data in base64 to create tmp files.
-        del kubeconfig["users"][0]["user"]["client-certificate"]
-        kubeconfig["users"][0]["user"]["client-certificate-data"] = (
-            base64.b64encode(b"client cert data").decode("utf-8")
+        client = kubernetes.Client(kubeconfig)
+        other = kubernetes.Client(_tls_kubeconfig(cert, key))
+
+        # Loaded in memory, with no temporary files
+        mock_temp.assert_not_called()
+        self.assertIsInstance(client.ssl_context, ssl.SSLContext)
+        self.assertEqual(1, len(client.ssl_context.get_ca_certs()))
+        self.assertIs(True, client.verify)
+        self.assertIsNone(client.cert)
+        # One context is shared by clients with the same credentials
+        self.assertIs(client.ssl_context, other.ssl_context)
+        adapter = client.get_adapter(TEST_SERVER)
+        self.assertIsInstance(adapter, kubernetes.TLSAdapter)
+        self.assertIs(
+            client.ssl_context,
+            adapter.poolmanager.connection_pool_kw["ssl_context"],
         )
 
+    def test_tls_context(self):
+        cert, key = _certificate()
+        client = kubernetes.Client(_tls_kubeconfig(cert, key))
+
+        self.assertIs(client.ssl_context, client.tls_context())
+
+    def test_tls_context_files(self):
+        cert, key = _certificate()
+        paths = []
+        for data in (cert, key):
+            with tempfile.NamedTemporaryFile(delete=False) as fp:
+                fp.write(data)
+            self.addCleanup(os.remove, fp.name)
+            paths.append(fp.name)
+        kubeconfig = yaml.safe_load(TEST_KUBECONFIG_YAML)
+        kubeconfig["clusters"][0]["cluster"]["certificate-authority"] = paths[
+            0
+        ]
+        kubeconfig["users"][0]["user"]["client-certificate"] = paths[0]
+        kubeconfig["users"][0]["user"]["client-key"] = paths[1]
         client = kubernetes.Client(kubeconfig)
 
-        # Ensure a temporary file was created
-        mock_temp.assert_has_calls(
-            [
-                mock.call(delete=False),
-                mock.call().__enter__(),
-                mock.call().__enter__().write(b"client cert data"),
-                mock.call().__exit__(None, None, None),
-            ]
-        )
+        context = client.tls_context()
+
+        self.assertIsNone(client.ssl_context)
+        self.assertEqual(1, len(context.get_ca_certs()))
+        self.assertIs(context, client.tls_context())
+
+    def test_client_tls_data_no_memfd(self):
+        cert, key = _certificate()
+        real_named_temporary_file = tempfile.NamedTemporaryFile
+        temp_files = []
+
+        def named_temporary_file(*args, **kwargs):
+            temp_file = real_named_temporary_file(*args, **kwargs)
+            temp_files.append(temp_file.name)
+            return temp_file
 
-        # Call finalizer method directly
-        client.__del__()
+        with mock.patch.dict(os.__dict__), mock.patch.object(
+            tempfile, "NamedTemporaryFile", named_temporary_file
+        ):
+            del os.memfd_create
+            client = kubernetes.Client(_tls_kubeconfig(cert, key))
 
-        # Exactly one temp file should be cleaned up
-        mock_remove.assert_called_once()
+        self.assertIsInstance(client.ssl_context, ssl.SSLContext)
+        # The key is only on disk while it is loaded
+        self.assertEqual(1, len(temp_files))
+        self.assertFalse(os.path.exists(temp_files[0]))
 
     def test_get_kubeconfig_path_default(self):
         self.assertEqual(
@@ -163,6 +239,49 @@ class TestKubernetesClient(base.TestCase):
         self.assertEqual(TEST_SERVER, client.server)
         mock_open.assert_called_once_with("mypath")
 
+    @mock.patch.object(kubernetes.Client, "_get_kubeconfig_mtime")
+    @mock.patch.object(kubernetes.Client, "_load_kubeconfig")
+    def test_client_shared(self, mock_load, mock_mtime):
+        self.config(kubeconfig_file="sharedpath", group="capi_helm")
+        self.addCleanup(kubernetes._shared_clients.clear)
+        self.addCleanup(kubernetes._shared_client_refs.clear)
+        mock_load.return_value = TEST_KUBECONFIG
+        mock_mtime.return_value = 1
+
+        client1 = kubernetes.Client.shared()
+        client2 = kubernetes.Client.shared()
+
+        self.assertIs(client1, client2)
+        self.assertEqual(2, kubernetes._shared_client_refs[client1])
+        mock_load.assert_called_once_with("sharedpath")
+
+        client1.release()
+        client2.release()
+        self.assertNotIn(client1, kubernetes._shared_client_refs)
+        self.assertIs(client1, kubernetes.Client.shared())
+
+    @mock.patch.object(kubernetes.Client, "close")
+    @mock.patch.object(kubernetes.Client, "_get_kubeconfig_mtime")
+    @mock.patch.object(kubernetes.Client, "_load_kubeconfig")
+    def test_client_shared_reload(self, mock_load, mock_mtime, mock_close):
+        self.config(kubeconfig_file="sharedpath", group="capi_helm")
+        self.addCleanup(kubernetes._shared_clients.clear)
+        self.addCleanup(kubernetes._shared_client_refs.clear)
+        mock_load.return_value = TEST_KUBECONFIG
+        mock_mtime.return_value = 1
+        client1 = kubernetes.Client.shared()
+
+        # The kubeconfig has changed on disk
+        mock_mtime.return_value = 2
+        client2 = kubernetes.Client.shared()
+
+        self.assertIsNot(client1, client2)
+        self.assertIn(client1, kubernetes._stale_clients)
+        mock_close.assert_not_called()
+
+        client1.release()
+        mock_close.assert_called_once_with()
+
     @mock.patch.object(requests.Session, "request")
     def test_ensure_namespace(self, mock_request):
         client = kubernetes.Client(TEST_KUBECONFIG)
@@ -208,6 +327,8 @@ class TestKubernetesClient(base.TestCase):
             headers={"Content-Type": "application/apply-patch+yaml"},
             params={"fieldManager": "magnum", "force": "true"},
         )
+        # The given data is not modified
+        self.assertEqual({"labels": {"baz": "asdf"}}, test_data["metadata"])
 
     @mock.patch.object(requests.Session, "request")
     def test_delete_all_secrets_by_label(self, mock_request):
@@ -272,6 +393,26 @@ class TestKubernetesClient(base.TestCase):
             allow_redirects=True,
         )
 
+    @mock.patch.object(requests.Session, "request")
+    def test_get_secret_data(self, mock_request):
+        client = kubernetes.Client(TEST_KUBECONFIG)
+        mock_response = mock.MagicMock()
+        mock_response.status_code = 200
+        mock_request.return_value = mock_response
+        mock_response.json.return_value = {
+            "data": {
+                "a": base64.b64encode(b"1").decode(),
+                "b": base64.b64encode(b"2").decode(),
+            }
+        }
+
+        self.assertEqual(
+            {"a": "1", "b": "2"}, client.get_secret_data("secret1", "ns1")
+        )
+
+        mock_response.status_code = 404
+        self.assertIsNone(client.get_secret_data("secret1", "ns1"))
+
     @mock.patch.object(requests.Session, "request")
     def test_get_capi_cluster_found(self, mock_request):
         client = kubernetes.Client(TEST_KUBECONFIG)
@@ -370,12 +511,14 @@ class TestKubernetesClient(base.TestCase):
 
         mock_response = mock.Mock()
         mock_response.status_code = 200
-        mock_response.json.return_value = {
-            "metadata": {
-                "continue": "",
-            },
-            "items": items,
-        }
+        mock_response.iter_content.return_value = base.list_content(
+            {
+                "metadata": {
+                    "continue": "",
+                },
+                "items": items,
+            }
+        )
         mock_request.return_value = mock_response
 
         client = kubernetes.Client(TEST_KUBECONFIG)
@@ -387,7 +530,8 @@ class TestKubernetesClient(base.TestCase):
                 "https://test:6443/apis/addons.stackhpc.com/"
                 "v1alpha1/namespaces/ns1/manifests"
             ),
-            params={"labelSelector": "label=cluster1"},
+            params={"labelSelector": "label=cluster1", "limit": 500},
+            stream=True,
             allow_redirects=True,
         )
         self.assertEqual(items, manifests)
@@ -404,12 +548,14 @@ class TestKubernetesClient(base.TestCase):
 
         mock_response = mock.Mock()
         mock_response.status_code = 200
-        mock_response.json.return_value = {
-            "metadata": {
-                "continue": "",
-            },
-            "items": items,
-        }
+        mock_response.iter_content.return_value = base.list_content(
+            {
+                "metadata": {
+                    "continue": "",
+                },
+                "items": items,
+            }
+        )
         mock_request.return_value = mock_response
 
         client = kubernetes.Client(TEST_KUBECONFIG)
@@ -423,7 +569,8 @@ class TestKubernetesClient(base.TestCase):
                 "https://test:6443/apis/addons.stackhpc.com/"
                 "v1alpha1/namespaces/ns1/helmreleases"
             ),
-            params={"labelSelector": "label=cluster1"},
+            params={"labelSelector": "label=cluster1", "limit": 500},
+            stream=True,
             allow_redirects=True,
         )
         self.assertEqual(items, helm_releases)
@@ -440,20 +587,24 @@ class TestKubernetesClient(base.TestCase):
 
         mock_response_page1 = mock.Mock()
         mock_response_page1.raise_for_status.return_value = None
-        mock_response_page1.json.return_value = {
-            "metadata": {
-                "continue": "continuetoken",
-            },
-            "items": items[:5],
-        }
+        mock_response_page1.iter_content.return_value = base.list_content(
+            {
+                "metadata": {
+                    "continue": "continuetoken",
+                },
+                "items": items[:5],
+            }
+        )
         mock_response_page2 = mock.Mock()
         mock_response_page2.raise_for_status.return_value = None
-        mock_response_page2.json.return_value = {
-            "metadata": {
-                "continue": "",
-            },
-            "items": items[5:],
-        }
+        mock_response_page2.iter_content.return_value = base.list_content(
+            {
+                "metadata": {
+                    "continue": "",
+                },
+                "items": items[5:],
+            }
+        )
         mock_request.side_effect = [
             mock_response_page1,
             mock_response_page2,
@@ -473,7 +624,8 @@ class TestKubernetesClient(base.TestCase):
                         "https://test:6443/apis/addons.stackhpc.com/"
                         "v1alpha1/namespaces/ns1/helmreleases"
                     ),
-                    params={"labelSelector": "label=cluster1"},
+                    params={"labelSelector": "label=cluster1", "limit": 500},
+                    stream=True,
                     allow_redirects=True,
                 ),
                 mock.call(
@@ -484,14 +636,68 @@ class TestKubernetesClient(base.TestCase):
                     ),
                     params={
                         "labelSelector": "label=cluster1",
+                        "limit": 500,
                         "continue": "continuetoken",
                     },
+                    stream=True,
                     allow_redirects=True,
                 ),
             ]
         )
         self.assertEqual(items, helm_releases)
 
+    def test_plural_name_for_kind(self):
+        for kind, plural in [
+            ("Cluster", "clusters"),
+            ("KubeadmControlPlane", "kubeadmcontrolplanes"),
+            ("Ingress", "ingresses"),
+            ("NetworkPolicy", "networkpolicies"),
+            ("Gateway", "gateways"),
+        ]:
+            self.assertEqual(plural, kubernetes.plural_name_for_kind(kind))
+        self.assertEqual(
+            "manifests",
+            kubernetes.GenericResource(
+                None, "addons.stackhpc.com/v1alpha1", "Manifests"
+            ).plural_name,
+        )
+
+    @mock.patch.object(requests.Session, "request")
+    def test_apply_object(self, mock_request):
+        client = kubernetes.Client(TEST_KUBECONFIG)
+        obj = {
+            "apiVersion": "controlplane.cluster.x-k8s.io/v1beta1",
+            "kind": "KubeadmControlPlane",
+            "metadata": {"name": "kcp", "namespace": "ns1"},
+            "spec": {"replicas": 3},
+        }
+
+        client.apply_object(obj)
+
+        mock_request.assert_called_once_with(
+            "PATCH",
+            "https://test:6443/apis/controlplane.cluster.x-k8s.io/v1beta1"
+            "/namespaces/ns1/kubeadmcontrolplanes/kcp",
+            data=None,
+            json=obj,
+            headers={"Content-Type": "application/apply-patch+yaml"},
+            params={"fieldManager": "magnum", "force": "true"},
+        )
+
+    @mock.patch.object(requests.Session, "request")
+    def test_delete_not_found(self, mock_request):
+        client = kubernetes.Client(TEST_KUBECONFIG)
+        mock_response = mock.MagicMock()
+        mock_response.status_code = 404
+        mock_request.return_value = mock_response
+
+        client.get_resource("v1", "Secret").delete("secret1", "ns1")
+
+        mock_request.assert_called_once_with(
+            "DELETE", "https://test:6443/api/v1/namespaces/ns1/secrets/secret1"
+        )
+        mock_response.raise_for_status.assert_not_called()
+
     @mock.patch.object(kubernetes.Client, "get_helm_chart_proxies_by_label")
     @mock.patch.object(kubernetes.Client, "get_helm_releases_by_label")
     @mock.patch.object(kubernetes.Client, "get_manifests_by_label")
@@ -547,12 +753,14 @@ class TestKubernetesClient(base.TestCase):
 
         mock_response = mock.Mock()
         mock_response.status_code = 200
-        mock_response.json.return_value = {
-            "metadata": {
-                "continue": "",
-            },
-            "items": items,
-        }
+        mock_response.iter_content.return_value = base.list_content(
+            {
+                "metadata": {
+                    "continue": "",
+                },
+                "items": items,
+            }
+        )
         mock_request.return_value = mock_response
 
         client = kubernetes.Client(TEST_KUBECONFIG)
@@ -569,8 +777,1502 @@ class TestKubernetesClient(base.TestCase):
             params={
                 "labelSelector": (
                     "capi.stackhpc.com/cluster=cluster_name,foo=bar"
-                )
+                ),
+                "limit": 500,
             },
+            stream=True,
             allow_redirects=True,
         )
         self.assertEqual(items, machines)
+
+    @mock.patch.object(requests.Session, "request")
+    def test_machines_exist_by_label(self, mock_request):
+        # Filtering by label can return empty pages
+        mock_request.side_effect = [
+            base.list_response([], "token1"),
+            base.list_response([{"metadata": {"name": "m1"}}], "token2"),
+        ]
+
+        client = kubernetes.Client(TEST_KUBECONFIG)
+        exists = client.machines_exist_by_label({"foo": "bar"}, "ns1")
+
+        self.assertTrue(exists)
+        path = (
+            "https://test:6443/apis/cluster.x-k8s.io/"
+            "v1beta1/namespaces/ns1/machines"
+        )
+        headers = {"Accept": kubernetes.Resource.METADATA_LIST_ACCEPT}
+        self.assertEqual(
+            [
+                mock.call(
+                    "GET",
+                    path,
+                    params={"labelSelector": "foo=bar", "limit": 1},
+                    stream=True,
+                    headers=headers,
+                    allow_redirects=True,
+                ),
+                mock.call(
+                    "GET",
+                    path,
+                    params={
+                        "labelSelector": "foo=bar",
+                        "limit": 1,
+                        "continue": "token1",
+                    },
+                    stream=True,
+                    headers=headers,
+                    allow_redirects=True,
+                ),
+            ],
+            mock_request.call_args_list,
+        )
+        self.assertIn(
+            "as=PartialObjectMetadataList", headers["Accept"].split(",")[0]
+        )
+
+    @mock.patch.object(requests.Session, "request")
+    def test_machines_exist_by_label_none(self, mock_request):
+        mock_request.return_value = base.list_response([])
+
+        client = kubernetes.Client(TEST_KUBECONFIG)
+
+        self.assertFalse(client.machines_exist_by_label({"foo": "bar"}, "ns1"))
+        mock_request.assert_called_once()
+
+    @mock.patch.object(requests.Session, "request")
+    def test_count_machines_by_label(self, mock_request):
+        mock_request.side_effect = [
+            base.list_response([{"metadata": {}}] * 2, "token1"),
+            base.list_response([{"metadata": {}}] * 3),
+        ]
+
+        client = kubernetes.Client(TEST_KUBECONFIG)
+
+        self.assertEqual(
+            5, client.count_machines_by_label({"foo": "bar"}, "ns1")
+        )
+        self.assertEqual(
+            {"labelSelector": "foo=bar", "limit": 500, "continue": "token1"},
+            mock_request.call_args_list[1][1]["params"],
+        )
+
+    @mock.patch.object(requests.Session, "request")
+    def test_fetch_cached_read(self, mock_request):
+        mock_response = mock.MagicMock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = "mock_json"
+        mock_request.return_value = mock_response
+        client = kubernetes.Client(TEST_KUBECONFIG)
+
+        with kubernetes.read_consistency(kubernetes.CACHED_READ):
+            cluster = client.get_capi_cluster("name", "ns1")
+
+        self.assertEqual("mock_json", cluster)
+        mock_request.assert_called_once_with(
+            "GET",
+            "https://test:6443/apis/cluster.x-k8s.io/"
+            "v1beta1/namespaces/ns1/clusters/name",
+            params={"resourceVersion": "0"},
+            allow_redirects=True,
+        )
+
+    @mock.patch.object(requests.Session, "request")
+    def test_list_cached_read(self, mock_request):
+        mock_request.side_effect = [
+            base.list_response([{"metadata": {}}], "token1"),
+            base.list_response([{"metadata": {}}]),
+        ]
+        client = kubernetes.Client(TEST_KUBECONFIG)
+
+        machines = list(
+            kubernetes.Machine(client).fetch_all_by_label(
+                {"foo": "bar"}, "ns1", consistency=kubernetes.CACHED_READ
+            )
+        )
+
+        self.assertEqual(2, len(machines))
+        self.assertEqual(
+            [
+                {
+                    "labelSelector": "foo=bar",
+                    "resourceVersion": "0",
+                    "resourceVersionMatch": "NotOlderThan",
+                    "limit": 500,
+                },
+                # Continued at the resourceVersion of the first page
+                {
+                    "labelSelector": "foo=bar",
+                    "limit": 500,
+                    "continue": "token1",
+                },
+            ],
+            [call[1]["params"] for call in mock_request.call_args_list],
+        )
+
+    @mock.patch.object(kubernetes.Informer, "start")
+    @mock.patch.object(requests.Session, "request")
+    def test_consistent_read_bypasses_store(self, mock_request, mock_start):
+        self.config(informer_resources=["Cluster"], group="capi_helm")
+        client = kubernetes.Client(TEST_KUBECONFIG)
+        mock_response = mock.MagicMock()
+        mock_response.status_code = 404
+        mock_request.return_value = mock_response
+        client.get_capi_cluster("name", "ns1")
+        client._informers["Cluster"].store.replace(
+            [{"metadata": {"name": "name", "namespace": "ns1"}}], "1"
+        )
+        mock_request.reset_mock()
+
+        with kubernetes.read_consistency(kubernetes.CACHED_READ):
+            self.assertIsNotNone(client.get_capi_cluster("name", "ns1"))
+        mock_request.assert_not_called()
+        with kubernetes.read_consistency(kubernetes.CONSISTENT_READ):
+            self.assertIsNone(client.get_capi_cluster("name", "ns1"))
+        mock_request.assert_called_once()
+
+    def test_read_consistency_per_task(self):
+        async def read(consistency, entered, other_entered):
+            with kubernetes.read_consistency(consistency):
+                entered.set()
+                await other_entered.wait()
+                return kubernetes._consistency.get()
+
+        async def main():
+            first, second = asyncio.Event(), asyncio.Event()
+            return await asyncio.gather(
+                read(kubernetes.CONSISTENT_READ, first, second),
+                read(kubernetes.CACHED_READ, second, first),
+            )
+
+        self.assertEqual(
+            [kubernetes.CONSISTENT_READ, kubernetes.CACHED_READ],
+            asyncio.run(main()),
+        )
+
+    def test_list_decoder(self):
+        data = {
+            "kind": "MachineList",
+            "metadata": {"continue": "token1", "resourceVersion": "42"},
+            "items": [
+                {"metadata": {"name": f"m{idx}"}, "spec": {"n": 1.5e10}}
+                for idx in range(10)
+            ]
+            + [None, 12345, "caf\u00e9"],
+        }
+
+        # Items and numbers are split across chunks
+        for chunk_size in (1, 7, 1024):
+            decoder = kubernetes.ListDecoder(
+                base.list_content(data, chunk_size)
+            )
+            self.assertEqual(data["items"], list(decoder))
+            self.assertEqual(
+                {"kind": "MachineList", "metadata": data["metadata"]},
+                decoder.fields,
+            )
+
+        decoder = kubernetes.ListDecoder([b'{"items": null, "metadata": {}}'])
+        self.assertEqual([], list(decoder))
+        self.assertEqual({"metadata": {}}, decoder.fields)
+        decoder = kubernetes.ListDecoder([b'{"items": [{"a": 1}'])
+        self.assertRaises(ValueError, list, decoder)
+
+    @mock.patch.object(requests.Session, "request")
+    def test_list_stops_early(self, mock_request):
+        response = base.list_response(
+            [{"metadata": {"name": f"m{idx}"}} for idx in range(100)],
+            "token1",
+        )
+        mock_request.return_value = response
+
+        client = kubernetes.Client(TEST_KUBECONFIG)
+        machines = kubernetes.Machine(client).fetch_all_by_label({}, "ns1")
+
+        self.assertEqual({"metadata": {"name": "m0"}}, next(machines))
+        machines.close()
+        # The rest of the page is not read, and no more pages are fetched
+        response.close.assert_called_once_with()
+        mock_request.assert_called_once()
+
+    @mock.patch.object(requests.Session, "request")
+    def test_list_page_size(self, mock_request):
+        self.config(list_page_size=0, group="capi_helm")
+        mock_request.return_value = base.list_response([])
+
+        client = kubernetes.Client(TEST_KUBECONFIG)
+
+        self.assertEqual([], client.get_all_machines_by_label({}, "ns1"))
+        self.assertEqual(
+            {"labelSelector": ""}, mock_request.call_args[1]["params"]
+        )
+
+
+class TestInformer(base.TestCase):
+    def setUp(self):
+        super().setUp()
+        # Discovery is tested separately, see TestDiscovery
+        self.config(api_discovery_ttl=0, group="capi_helm")
+
+    def _machine(self, name, namespace="ns1", labels=None, rv="1"):
+        return {
+            "metadata": {
+                "name": name,
+                "namespace": namespace,
+                "labels": labels or {},
+                "resourceVersion": rv,
+            }
+        }
+
+    def test_store_get_and_list_by_label(self):
+        store = kubernetes.Store()
+        self.assertFalse(store.synced)
+        store.replace(
+            [
+                self._machine("m1", labels={"cluster": "a"}),
+                self._machine("m2", labels={"cluster": "b"}),
+                self._machine("m3", "ns2", labels={"cluster": "a"}),
+            ],
+            "10",
+        )
+
+        self.assertTrue(store.synced)
+        self.assertEqual("10", store.resource_version)
+        self.assertEqual("m1", store.get("m1", "ns1")["metadata"]["name"])
+        self.assertIsNone(store.get("m1", "ns2"))
+        self.assertEqual(
+            ["m1"],
+            [
+                m["metadata"]["name"]
+                for m in store.list_by_label({"cluster": "a"}, "ns1")
+            ],
+        )
+
+    def test_handle_event(self):
+        informer = kubernetes.Informer(
+            kubernetes.Machine(kubernetes.Client(TEST_KUBECONFIG))
+        )
+        informer.store.replace([self._machine("m1")], "1")
+
+        informer._handle_event(
+            {"type": "ADDED", "object": self._machine("m2", rv="2")}
+        )
+        informer._handle_event(
+            {"type": "DELETED", "object": self._machine("m1", rv="3")}
+        )
+        informer._handle_event(
+            {
+                "type": "BOOKMARK",
+                "object": {"metadata": {"resourceVersion": "4"}},
+            }
+        )
+
+        self.assertIsNone(informer.store.get("m1", "ns1"))
+        self.assertIsNotNone(informer.store.get("m2", "ns1"))
+        self.assertEqual("4", informer.store.resource_version)
+        self.assertRaises(
+            kubernetes.ResourceVersionExpired,
+            informer._handle_event,
+            {"type": "ERROR", "object": {"code": 410, "message": "gone"}},
+        )
+
+    @mock.patch.object(requests.Session, "request")
+    def test_list(self, mock_request):
+        mock_response = mock.Mock()
+        mock_response.iter_content.return_value = base.list_content(
+            {
+                "metadata": {"continue": "", "resourceVersion": "42"},
+                "items": [self._machine("m1")],
+            }
+        )
+        mock_request.return_value = mock_response
+        informer = kubernetes.Informer(
+            kubernetes.Machine(kubernetes.Client(TEST_KUBECONFIG))
+        )
+
+        informer._list()
+
+        mock_request.assert_called_once_with(
+            "GET",
+            "https://test:6443/apis/cluster.x-k8s.io/v1beta1/machines",
+            params={"limit": 500},
+            stream=True,
+            allow_redirects=True,
+        )
+        self.assertTrue(informer.store.synced)
+        self.assertEqual("42", informer.store.resource_version)
+
+    @mock.patch.object(requests.Session, "request")
+    def test_handlers(self, mock_request):
+        mock_response = mock.Mock()
+        mock_response.iter_content.return_value = base.list_content(
+            {
+                "metadata": {"continue": "", "resourceVersion": "42"},
+                "items": [self._machine("m2")],
+            }
+        )
+        mock_request.return_value = mock_response
+        informer = kubernetes.Informer(
+            kubernetes.Machine(kubernetes.Client(TEST_KUBECONFIG))
+        )
+        handler = mock.Mock()
+        informer.add_handler(mock.Mock(side_effect=Exception("bad")))
+        informer.add_handler(handler)
+        informer.store.replace([self._machine("m1")], "1")
+
+        informer._list()
+        informer._handle_event(
+            {"type": "MODIFIED", "object": self._machine("m2", rv="43")}
+        )
+        informer._handle_event(
+            {
+                "type": "BOOKMARK",
+                "object": {"metadata": {"resourceVersion": "44"}},
+            }
+        )
+
+        self.assertEqual(
+            [
+                mock.call("ADDED", self._machine("m2")),
+                mock.call("DELETED", self._machine("m1")),
+                mock.call("MODIFIED", self._machine("m2", rv="43")),
+            ],
+            handler.call_args_list,
+        )
+
+    @mock.patch.object(kubernetes.Informer, "start")
+    def test_get_informer(self, mock_start):
+        client = kubernetes.Client(TEST_KUBECONFIG)
+        handler = mock.Mock()
+
+        informer = client.get_informer(kubernetes.Cluster, handler=handler)
+
+        self.assertIs(informer, client.get_informer(kubernetes.Cluster))
+        mock_start.assert_called_once_with()
+        self.assertEqual([handler], informer._handlers)
+        # Started informers are used for reads, even if not configured
+        self.assertIsNone(client.get_store(kubernetes.Cluster(client)))
+        informer.store.replace([], "1")
+        self.assertIs(
+            informer.store, client.get_store(kubernetes.Cluster(client))
+        )
+
+    @mock.patch.object(kubernetes.Informer, "start")
+    @mock.patch.object(requests.Session, "request")
+    def test_fetch_from_synced_store(self, mock_request, mock_start):
+        self.config(informer_resources=["Cluster"], group="capi_helm")
+        client = kubernetes.Client(TEST_KUBECONFIG)
+        mock_response = mock.MagicMock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = "mock_json"
+        mock_request.return_value = mock_response
+
+        # Not yet synced, so fall back to the API
+        self.assertEqual("mock_json", client.get_capi_cluster("m1", "ns1"))
+        mock_start.assert_called_once_with()
+        self.assertEqual(1, mock_request.call_count)
+
+        cached = self._machine("m1")
+        client._informers["Cluster"].store.replace([cached], "1")
+
+        self.assertIs(cached, client.get_capi_cluster("m1", "ns1"))
+        self.assertIsNone(client.get_capi_cluster("m2", "ns1"))
+        self.assertEqual(1, mock_request.call_count)
+
+    @mock.patch.object(requests.Session, "request")
+    def test_fetch_not_cached_kind(self, mock_request):
+        self.config(informer_resources=["Cluster"], group="capi_helm")
+        client = kubernetes.Client(TEST_KUBECONFIG)
+        mock_response = mock.MagicMock()
+        mock_response.status_code = 200
+        mock_request.return_value = mock_response
+
+        client.get_k8s_control_plane("name", "ns1")
+
+        mock_request.assert_called_once()
+        self.assertEqual({}, client._informers)
+
+
+class TestSnapshot(base.TestCase):
+    def setUp(self):
+        super().setUp()
+        # Discovery is tested separately, see TestDiscovery
+        self.config(api_discovery_ttl=0, group="capi_helm")
+
+    def _obj(self, name, namespace, cluster):
+        return base.k8s_object(
+            name,
+            namespace,
+            labels={
+                "capi.stackhpc.com/cluster": cluster,
+                "addons.stackhpc.com/cluster": cluster,
+            },
+        )
+
+    def test_store_label_index(self):
+        store = kubernetes.Store()
+        store.replace(
+            [
+                self._obj("m1", "ns1", "a"),
+                self._obj("m2", "ns1", "b"),
+            ],
+            None,
+        )
+        store.update(self._obj("m1", "ns1", "b"))
+        store.delete(self._obj("m2", "ns1", "b"))
+
+        selector = {"capi.stackhpc.com/cluster": "b"}
+        self.assertEqual(
+            ["m1"],
+            [m["metadata"]["name"] for m in store.list_by_label(selector)],
+        )
+        self.assertEqual(
+            ["m1"],
+            [
+                m["metadata"]["name"]
+                for m in store.list_by_label(selector, "ns1")
+            ],
+        )
+        self.assertEqual(
+            [],
+            list(
+                store.list_by_label({"capi.stackhpc.com/cluster": "a"}, "ns1")
+            ),
+        )
+
+    @mock.patch.object(requests.Session, "request")
+    def test_exists_and_count_by_label_from_store(self, mock_request):
+        client = kubernetes.Client(TEST_KUBECONFIG)
+        store = kubernetes.Store()
+        store.replace(
+            [
+                self._obj("m1", "ns1", "a"),
+                self._obj("m2", "ns1", "a"),
+                self._obj("m3", "ns1", "b"),
+            ],
+            "1",
+        )
+        machines = kubernetes.Machine(client)
+        selector = {"capi.stackhpc.com/cluster": "a"}
+
+        with mock.patch.object(client, "get_store", return_value=store):
+            self.assertTrue(machines.exists_by_label(selector, "ns1"))
+            self.assertEqual(2, machines.count_by_label(selector, "ns1"))
+            selector = {"capi.stackhpc.com/cluster": "c"}
+            self.assertFalse(machines.exists_by_label(selector, "ns1"))
+            self.assertEqual(0, machines.count_by_label(selector, "ns1"))
+
+        # Answered from the store, without requests to the API
+        mock_request.assert_not_called()
+
+    @mock.patch.object(requests.Session, "request")
+    def test_snapshot(self, mock_request):
+        not_found = mock.MagicMock()
+        not_found.status_code = 404
+        not_found.raise_for_status.side_effect = requests.HTTPError(
+            response=not_found
+        )
+
+        def list_objects(method, url, params=None, **kwargs):
+            if "helmchartproxies" in url:
+                return not_found
+            namespace = url.split("/namespaces/")[1].split("/")[0]
+            return base.list_response(
+                [
+                    self._obj("c1", namespace, "c1"),
+                    self._obj("c2", namespace, "c2"),
+                ]
+            )
+
+        mock_request.side_effect = list_objects
+        client = kubernetes.Client(TEST_KUBECONFIG)
+
+        snapshot = kubernetes.Snapshot(client, ["ns1", "ns2"])
+
+        # One list per resource kind per namespace
+        self.assertEqual(12, mock_request.call_count)
+        mock_request.reset_mock()
+
+        self.assertEqual(
+            "c2", snapshot.get_capi_cluster("c2", "ns1")["metadata"]["name"]
+        )
+        self.assertIsNone(snapshot.get_machine_deployment("c3", "ns1"))
+        addons = snapshot.get_addons_by_label(
+            {"addons.stackhpc.com/cluster": "c1"}, "ns1"
+        )
+        self.assertEqual(2, len(addons))
+        mock_request.assert_not_called()
+
+        # Machines are not part of the snapshot
+        machines = snapshot.get_all_machines_by_label(
+            {"capi.stackhpc.com/cluster": "c1"}, "ns2"
+        )
+        self.assertEqual(2, len(machines))
+        mock_request.assert_called_once()
+        mock_request.reset_mock()
+
+        # Secrets are not part of the snapshot
+        mock_request.side_effect = None
+        snapshot.delete_all_secrets_by_label("label", "c1", "ns1")
+        mock_request.assert_called_once_with(
+            "DELETE",
+            "https://test:6443/api/v1/namespaces/ns1/secrets",
+            params={"labelSelector": "label=c1"},
+        )
+
+    @mock.patch.object(requests.Session, "request")
+    def test_close(self, mock_request):
+        client = kubernetes.Client(TEST_KUBECONFIG)
+        self.addCleanup(client.close)
+        cluster = self._obj("c1", "ns1", "c1")
+        snapshot = kubernetes.Snapshot(
+            client, ["ns1"], items={kubernetes.Cluster: [cluster]}
+        )
+        self.assertEqual(cluster, snapshot.get_capi_cluster("c1", "ns1"))
+        mock_request.assert_not_called()
+
+        snapshot.close()
+
+        # The wrapped client is left open
+        mock_request.return_value = base.response(cluster)
+        self.assertEqual(cluster, client.get_capi_cluster("c1", "ns1"))
+        mock_request.assert_called_once()
+
+
+class TestDiscovery(base.TestCase):
+    AGGREGATED = {
+        "kind": "APIGroupDiscoveryList",
+        "items": [
+            {
+                "metadata": {"name": "cluster.x-k8s.io"},
+                "versions": [
+                    {
+                        "version": "v1beta1",
+                        "resources": [
+                            {"resource": "clusters"},
+                            {"resource": "machines"},
+                        ],
+                    },
+                    {
+                        "version": "v1beta2",
+                        "resources": [{"resource": "clusters"}],
+                    },
+                ],
+            },
+            {
+                "metadata": {"name": "addons.stackhpc.com"},
+                "versions": [
+                    {
+                        "version": "v1alpha1",
+                        "resources": [
+                            {"resource": "helmreleases"},
+                            {"resource": "manifests"},
+                        ],
+                    }
+                ],
+            },
+        ],
+    }
+
+    def test_version_priority(self):
+        versions = ["v1alpha1", "v2", "v1beta1", "foo", "v1", "v1beta2"]
+        self.assertEqual(
+            ["v2", "v1", "v1beta2", "v1beta1", "v1alpha1", "foo"],
+            sorted(versions, key=kubernetes.version_priority, reverse=True),
+        )
+
+    @mock.patch.object(requests.Session, "request")
+    def test_aggregated_discovery(self, mock_request):
+        mock_request.return_value = base.response(self.AGGREGATED)
+        client = kubernetes.Client(TEST_KUBECONFIG)
+
+        cluster = kubernetes.Cluster(client)
+        machine = kubernetes.Machine(client)
+        proxy = kubernetes.HelmChartProxy(client)
+
+        # The built in version is used while it is served, even if newer
+        # versions are served, as objects are parsed using its schema
+        self.assertEqual("cluster.x-k8s.io/v1beta1", cluster.api_version)
+        self.assertEqual("cluster.x-k8s.io/v1beta1", machine.api_version)
+        self.assertEqual(
+            "addons.stackhpc.com/v1alpha1",
+            kubernetes.HelmRelease(client).api_version,
+        )
+        # The CRD is not installed, so it is never requested
+        self.assertTrue(proxy.absent)
+        self.assertEqual([], client.get_helm_chart_proxies_by_label({}, "ns1"))
+        self.assertIsNone(proxy.fetch("name", "ns1"))
+        mock_request.assert_called_once()
+        args, kwargs = mock_request.call_args
+        self.assertEqual(("GET", "https://test:6443/apis"), args)
+        self.assertEqual(
+            {"Accept": kubernetes.Discovery.AGGREGATED_ACCEPT},
+            kwargs["headers"],
+        )
+
+    @mock.patch.object(requests.Session, "request")
+    def test_api_resources_override(self, mock_request):
+        self.config(
+            api_resources=(
+                '{"Cluster": {"api_version": "cluster.x-k8s.io/v1beta1"},'
+                ' "K8sControlPlane": {"plural_name": "rke2controlplanes"}}'
+            ),
+            group="capi_helm",
+        )
+        mock_request.return_value = base.response(self.AGGREGATED)
+        client = kubernetes.Client(TEST_KUBECONFIG)
+
+        self.assertEqual(
+            "cluster.x-k8s.io/v1beta1", kubernetes.Cluster(client).api_version
+        )
+        kcp = kubernetes.K8sControlPlane(client)
+        self.assertEqual("rke2controlplanes", kcp.plural_name)
+        self.assertTrue(kcp.absent)
+
+    @mock.patch.object(time, "monotonic")
+    @mock.patch.object(requests.Session, "request")
+    def test_legacy_discovery(self, mock_request, mock_monotonic):
+        mock_monotonic.return_value = 1000
+        groups = {
+            "kind": "APIGroupList",
+            "groups": [
+                {
+                    "name": "cluster.x-k8s.io",
+                    "versions": [
+                        {"version": "v1beta1"},
+                        {"version": "v1alpha4"},
+                    ],
+                }
+            ],
+        }
+        responses = {
+            "https://test:6443/apis": base.response(groups),
+            "https://test:6443/apis/cluster.x-k8s.io/v1beta1": (
+                base.response({"resources": [{"name": "machines"}]})
+            ),
+            "https://test:6443/apis/cluster.x-k8s.io/v1alpha4": (
+                base.response({"resources": [{"name": "clusters"}]})
+            ),
+        }
+        mock_request.side_effect = lambda method, url, **kwargs: responses[url]
+        client = kubernetes.Client(TEST_KUBECONFIG)
+
+        self.assertEqual(
+            "cluster.x-k8s.io/v1beta1", kubernetes.Machine(client).api_version
+        )
+        self.assertEqual(
+            "cluster.x-k8s.io/v1alpha4", kubernetes.Cluster(client).api_version
+        )
+        self.assertEqual(
+            "cluster.x-k8s.io/v1beta1", kubernetes.Machine(client).api_version
+        )
+        self.assertEqual(3, mock_request.call_count)
+
+        # Discovered again once the TTL expires
+        mock_monotonic.return_value = 1300
+        kubernetes.Machine(client)
+        self.assertEqual(5, mock_request.call_count)
+
+    @mock.patch.object(requests.Session, "request")
+    def test_newest_version_when_default_not_served(self, mock_request):
+        aggregated = copy.deepcopy(self.AGGREGATED)
+        # Only the v1beta2 clusters are served
+        del aggregated["items"][0]["versions"][0]["resources"][0]
+        mock_request.return_value = base.response(aggregated)
+        client = kubernetes.Client(TEST_KUBECONFIG)
+
+        self.assertEqual(
+            "cluster.x-k8s.io/v1beta2", kubernetes.Cluster(client).api_version
+        )
+        self.assertEqual(
+            "cluster.x-k8s.io/v1beta1", kubernetes.Machine(client).api_version
+        )
+
+    @mock.patch.object(requests.Session, "request")
+    def test_consistent_read_of_absent_resource(self, mock_request):
+        mock_request.side_effect = [
+            base.response(self.AGGREGATED),
+            base.response({"metadata": {"name": "p1"}}),
+        ]
+        client = kubernetes.Client(TEST_KUBECONFIG)
+        proxy = kubernetes.HelmChartProxy(client)
+        self.assertTrue(proxy.absent)
+
+        self.assertIsNone(proxy.fetch("p1", "ns1"))
+        mock_request.assert_called_once()
+        # e.g. the CRD was installed since the last discovery
+        self.assertEqual(
+            {"metadata": {"name": "p1"}},
+            proxy.fetch("p1", "ns1", consistency=kubernetes.CONSISTENT_READ),
+        )
+        self.assertEqual(2, mock_request.call_count)
+
+    @mock.patch.object(requests.Session, "request")
+    def test_is_namespaced(self, mock_request):
+        aggregated = copy.deepcopy(self.AGGREGATED)
+        aggregated["items"].append(
+            {
+                "metadata": {"name": "rbac.authorization.k8s.io"},
+                "versions": [
+                    {
+                        "version": "v1",
+                        "resources": [
+                            {
+                                "resource": "clusterroles",
+                                "responseKind": {"kind": "ClusterRole"},
+                                "scope": "Cluster",
+                            },
+                            {
+                                "resource": "roles",
+                                "responseKind": {"kind": "Role"},
+                                "scope": "Namespaced",
+                            },
+                        ],
+                    }
+                ],
+            }
+        )
+        responses = {
+            "https://test:6443/apis": base.response(aggregated),
+            # The core group is not included in /apis
+            "https://test:6443/api/v1": base.response(
+                {
+                    "resources": [
+                        {"name": "secrets", "kind": "Secret"},
+                        {
+                            "name": "namespaces",
+                            "kind": "Namespace",
+                            "namespaced": False,
+                        },
+                    ]
+                }
+            ),
+        }
+        mock_request.side_effect = lambda method, url, **kwargs: responses[url]
+        discovery = kubernetes.Client(TEST_KUBECONFIG).discovery
+
+        rbac = "rbac.authorization.k8s.io/v1"
+        self.assertFalse(discovery.is_namespaced(rbac, "ClusterRole"))
+        self.assertTrue(discovery.is_namespaced(rbac, "Role"))
+        self.assertTrue(discovery.is_namespaced("v1", "Secret"))
+        self.assertFalse(discovery.is_namespaced("v1", "Namespace"))
+        self.assertIsNone(discovery.is_namespaced(rbac, "Missing"))
+        self.assertEqual(2, mock_request.call_count)
+
+    @mock.patch.object(requests.Session, "request")
+    def test_generic_resource_plural_name(self, mock_request):
+        aggregated = copy.deepcopy(self.AGGREGATED)
+        aggregated["items"].append(
+            {
+                "metadata": {"name": "example.com"},
+                "versions": [
+                    {
+                        "version": "v1",
+                        "resources": [
+                            {
+                                "resource": "people",
+                                "responseKind": {"kind": "Person"},
+                                "scope": "Namespaced",
+                            }
+                        ],
+                    }
+                ],
+            }
+        )
+        responses = {
+            "https://test:6443/apis": base.response(aggregated),
+            "https://test:6443/api/v1": base.response(
+                {
+                    "resources": [
+                        {"name": "pods/status", "kind": "Pod"},
+                        {"name": "pods", "kind": "Pod"},
+                    ]
+                }
+            ),
+        }
+        mock_request.side_effect = lambda method, url, **kwargs: responses[url]
+        client = kubernetes.Client(TEST_KUBECONFIG)
+
+        for api_version, kind, plural_name in [
+            ("example.com/v1", "Person", "people"),
+            ("v1", "Pod", "pods"),
+            # Not served, so guessed
+            ("example.com/v1", "Missing", "missings"),
+        ]:
+            self.assertEqual(
+                plural_name,
+                client.get_resource(api_version, kind).plural_name,
+            )
+
+    @mock.patch.object(requests.Session, "request")
+    def test_not_found_marks_absent(self, mock_request):
+        mock_request.side_effect = [
+            base.response(self.AGGREGATED),
+            base.response({}, 404),
+        ]
+        client = kubernetes.Client(TEST_KUBECONFIG)
+
+        # e.g. the CRD was removed since discovery
+        self.assertEqual([], client.get_addons_by_label({}, "ns1"))
+
+        self.assertTrue(kubernetes.HelmRelease(client).absent)
+        self.assertEqual(2, mock_request.call_count)
+
+    @mock.patch.object(requests.Session, "request")
+    def test_discovery_failed(self, mock_request):
+        # Retries are tested separately, see TestRetryPolicy
+        self.config(api_max_retries=0, group="capi_helm")
+        mock_request.return_value = base.response({}, 503)
+        client = kubernetes.Client(TEST_KUBECONFIG)
+
+        machine = kubernetes.Machine(client)
+        kubernetes.Machine(client)
+
+        self.assertEqual("cluster.x-k8s.io/v1beta1", machine.api_version)
+        self.assertFalse(machine.absent)
+        # Not retried until the TTL expires
+        mock_request.assert_called_once()
+
+    @mock.patch.object(requests.Session, "request")
+    def test_discovery_disabled(self, mock_request):
+        self.config(api_discovery_ttl=0, group="capi_helm")
+        client = kubernetes.Client(TEST_KUBECONFIG)
+
+        machine = kubernetes.Machine(client)
+
+        self.assertEqual("cluster.x-k8s.io/v1beta1", machine.api_version)
+        mock_request.assert_not_called()
+
+
+class TestRateLimiter(base.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.config(api_discovery_ttl=0, group="capi_helm")
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        self.now = 100.0
+
+    def test_reserve(self):
+        limiter = kubernetes.RateLimiter(10, 2, clock=lambda: self.now)
+
+        # The burst is allowed immediately, then each request is spaced
+        self.assertEqual(0, limiter.reserve())
+        self.assertEqual(0, limiter.reserve())
+        self.assertAlmostEqual(0.1, limiter.reserve())
+        self.assertAlmostEqual(0.2, limiter.reserve())
+
+        # Tokens refill over time, up to the burst
+        self.now += 10
+        self.assertEqual(0, limiter.reserve())
+        self.assertEqual(0, limiter.reserve())
+        self.assertAlmostEqual(0.1, limiter.reserve())
+
+    @mock.patch.object(time, "sleep")
+    @mock.patch.object(requests.Session, "request")
+    def test_request_rate_limited(self, mock_request, mock_sleep):
+        self.config(
+            api_read_qps=2,
+            api_read_burst=1,
+            api_write_qps=1,
+            api_write_burst=1,
+            group="capi_helm",
+        )
+        with mock.patch.object(time, "monotonic", return_value=self.now):
+            client = kubernetes.Client(TEST_KUBECONFIG)
+            client.get("/api/v1/namespaces")
+            client.get("/api/v1/namespaces")
+            # Writes use a separate bucket
+            client.delete("/api/v1/namespaces/ns1")
+            client.patch("/api/v1/namespaces/ns1")
+
+        self.assertEqual(4, mock_request.call_count)
+        mock_sleep.assert_has_calls([mock.call(0.5), mock.call(1.0)])
+        self.assertEqual(1, metrics.get("api_read_rate_limit_wait_count"))
+        self.assertEqual(0.5, metrics.get("api_read_rate_limit_wait_seconds"))
+        self.assertEqual(1, metrics.get("api_write_rate_limit_wait_count"))
+        self.assertEqual(1.0, metrics.get("api_write_rate_limit_wait_seconds"))
+
+    @mock.patch.object(time, "sleep")
+    @mock.patch.object(requests.Session, "request")
+    def test_request_rate_limited_past_deadline(
+        self, mock_request, mock_sleep
+    ):
+        self.config(api_read_qps=1, api_read_burst=1, group="capi_helm")
+        with mock.patch.object(time, "monotonic", return_value=self.now):
+            client = kubernetes.Client(TEST_KUBECONFIG)
+            with deadline.scope(0.5):
+                client.get("/api/v1/namespaces")
+                # Waiting for the next token would overrun the deadline
+                self.assertRaises(
+                    deadline.DeadlineExceeded,
+                    client.get,
+                    "/api/v1/namespaces",
+                )
+
+        self.assertEqual(1, mock_request.call_count)
+        mock_sleep.assert_not_called()
+        self.assertEqual(0, metrics.get("api_read_rate_limit_wait_count"))
+
+    @mock.patch.object(time, "sleep")
+    @mock.patch.object(requests.Session, "request")
+    def test_request_not_limited(self, mock_request, mock_sleep):
+        self.config(api_read_qps=0, api_read_burst=1, group="capi_helm")
+        client = kubernetes.Client(TEST_KUBECONFIG)
+
+        for _ in range(5):
+            client.get("/api/v1/namespaces")
+
+        self.assertEqual(5, mock_request.call_count)
+        mock_sleep.assert_not_called()
+
+
+class TestRetryPolicy(base.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.config(api_discovery_ttl=0, group="capi_helm")
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def test_delay(self):
+        policy = kubernetes.RetryPolicy(3, 1, 5)
+
+        with mock.patch.object(random, "uniform", side_effect=max):
+            self.assertEqual(1, policy.delay(0, "GET"))
+            self.assertEqual(4, policy.delay(2, "GET"))
+            # The backoff is capped
+            policy.max_retries = 5
+            self.assertEqual(5, policy.delay(4, "GET"))
+        self.assertIsNone(policy.delay(5, "GET"))
+
+    def test_delay_retry_after(self):
+        policy = kubernetes.RetryPolicy(3, 1, 5)
+
+        self.assertEqual(
+            2,
+            policy.delay(
+                0,
+                "POST",
+                {},
+                base.response(status_code=429, headers={"Retry-After": "2"}),
+            ),
+        )
+        self.assertEqual(
+            5,
+            policy.delay(
+                0,
+                "GET",
+                {},
+                base.response(status_code=503, headers={"Retry-After": "60"}),
+            ),
+        )
+
+    def test_delay_idempotent(self):
+        policy = kubernetes.RetryPolicy(3, 1, 5)
+        apply_headers = {"Content-Type": kubernetes.APPLY_PATCH_CONTENT_TYPE}
+
+        for method, headers, response, retried in [
+            ("GET", None, None, True),
+            ("DELETE", None, base.response(status_code=503), True),
+            ("PATCH", apply_headers, base.response(status_code=504), True),
+            (
+                "PATCH",
+                {"Content-Type": "application/merge-patch+json"},
+                None,
+                False,
+            ),
+            ("POST", None, None, False),
+            ("POST", None, base.response(status_code=503), False),
+            ("POST", None, base.response(status_code=429), True),
+            ("GET", None, base.response(status_code=500), False),
+            ("GET", None, base.response(status_code=404), False),
+        ]:
+            delay = policy.delay(0, method, headers, response)
+            self.assertEqual(retried, delay is not None, (method, response))
+
+    @mock.patch.object(time, "sleep")
+    @mock.patch.object(requests.Session, "request")
+    def test_request_retried(self, mock_request, mock_sleep):
+        throttled = base.response(
+            status_code=429, headers={"Retry-After": "1"}
+        )
+        ok = base.response(status_code=200)
+        mock_request.side_effect = [
+            requests.exceptions.ConnectionError("reset"),
+            throttled,
+            ok,
+        ]
+        client = kubernetes.Client(TEST_KUBECONFIG)
+
+        self.assertIs(ok, client.get("/api/v1/namespaces"))
+
+        self.assertEqual(3, mock_request.call_count)
+        throttled.close.assert_called_once_with()
+        self.assertEqual(mock.call(1.0), mock_sleep.call_args)
+        self.assertEqual(2, metrics.get("api_request_retry_wait_count"))
+
+    @mock.patch.object(time, "sleep")
+    @mock.patch.object(requests.Session, "request")
+    def test_request_retries_exhausted(self, mock_request, mock_sleep):
+        self.config(api_max_retries=2, group="capi_helm")
+        unavailable = base.response(status_code=503)
+        mock_request.return_value = unavailable
+        client = kubernetes.Client(TEST_KUBECONFIG)
+
+        self.assertIs(unavailable, client.get("/api/v1/namespaces"))
+
+        self.assertEqual(3, mock_request.call_count)
+        self.assertEqual(2, mock_sleep.call_count)
+        self.assertEqual(2, metrics.get("api_request_retry_wait_count"))
+
+    def test_delay_deadline(self):
+        policy = kubernetes.RetryPolicy(3, 1, 5)
+        response = base.response(status_code=429, headers={"Retry-After": "5"})
+
+        with deadline.scope(2):
+            self.assertIsNone(policy.delay(0, "GET", {}, response))
+
+    @mock.patch.object(requests.Session, "request")
+    def test_request_deadline_exceeded(self, mock_request):
+        mock_request.side_effect = requests.exceptions.ReadTimeout()
+        client = kubernetes.Client(TEST_KUBECONFIG)
+
+        with deadline.scope(60), mock.patch.object(
+            deadline, "remaining", return_value=0
+        ):
+            self.assertRaises(
+                deadline.DeadlineExceeded,
+                client.get,
+                "/api/v1/namespaces",
+            )
+
+        mock_request.assert_called_once()
+
+    def test_request_timeout(self):
+        client = kubernetes.Client(TEST_KUBECONFIG)
+
+        self.assertEqual((10, 60), client.request_timeout())
+        self.assertEqual((5, 5), client.request_timeout(5))
+        with deadline.scope(30):
+            connect, read = client.request_timeout((10, 60))
+            self.assertEqual(10, connect)
+            self.assertTrue(29 < read <= 30)
+        with deadline.scope(60), mock.patch.object(
+            deadline, "remaining", return_value=-1
+        ):
+            self.assertRaises(
+                deadline.DeadlineExceeded, client.request_timeout
+            )
+
+    @mock.patch.object(requests.adapters.HTTPAdapter, "send")
+    def test_send_timeout(self, mock_send):
+        response = requests.Response()
+        response.status_code = 200
+        mock_send.return_value = response
+        client = kubernetes.Client(TEST_KUBECONFIG)
+
+        client.get("/api/v1/namespaces")
+
+        self.assertEqual((10, 60), mock_send.call_args[1]["timeout"])
+
+    @mock.patch.object(time, "sleep")
+    @mock.patch.object(requests.Session, "request")
+    def test_request_not_idempotent(self, mock_request, mock_sleep):
+        mock_request.side_effect = requests.exceptions.ConnectionError("reset")
+        client = kubernetes.Client(TEST_KUBECONFIG)
+
+        self.assertRaises(
+            requests.exceptions.ConnectionError,
+            client.post,
+            "/api/v1/namespaces",
+        )
+
+        mock_request.assert_called_once()
+        mock_sleep.assert_not_called()
+
+
+class TestCircuitBreaker(base.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.config(api_discovery_ttl=0, api_max_retries=0, group="capi_helm")
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        self.now = 100.0
+
+    def test_breaker(self):
+        breaker = kubernetes.CircuitBreaker(2, 30, clock=lambda: self.now)
+        probe = mock.Mock(return_value=False)
+
+        breaker.record(False)
+        breaker.record(True)
+        breaker.record(False)
+        breaker.check(probe)
+        self.assertEqual(breaker.CLOSED, breaker.state)
+
+        breaker.record(False)
+        self.assertEqual(breaker.OPEN, breaker.state)
+        self.assertRaises(kubernetes.CircuitOpen, breaker.check, probe)
+        probe.assert_not_called()
+
+        # The probe fails, so the circuit stays open for another period
+        self.now += 30
+        self.assertRaises(kubernetes.CircuitOpen, breaker.check, probe)
+        probe.assert_called_once_with()
+        self.assertEqual(breaker.OPEN, breaker.state)
+        self.now += 10
+        self.assertRaises(kubernetes.CircuitOpen, breaker.check, probe)
+        probe.assert_called_once_with()
+
+        self.now += 20
+        probe.return_value = True
+        breaker.check(probe)
+        self.assertEqual(breaker.CLOSED, breaker.state)
+        self.assertEqual(1, metrics.get("api_circuit_opened"))
+        self.assertEqual(3, metrics.get("api_circuit_rejected_requests"))
+
+    def test_breaker_half_open(self):
+        breaker = kubernetes.CircuitBreaker(1, 30, clock=lambda: self.now)
+        breaker.record(False)
+        self.now += 30
+
+        def probe():
+            # Other requests fail fast while the probe is made
+            self.assertEqual(breaker.HALF_OPEN, breaker.state)
+            self.assertRaises(kubernetes.CircuitOpen, breaker.check, probe)
+            return True
+
+        breaker.check(probe)
+
+        self.assertEqual(breaker.CLOSED, breaker.state)
+
+    @mock.patch.object(requests.Session, "request")
+    def test_request_fails_fast(self, mock_request):
+        self.config(api_circuit_failure_threshold=2, group="capi_helm")
+        mock_request.side_effect = requests.exceptions.ConnectionError()
+        client = kubernetes.Client(TEST_KUBECONFIG)
+
+        for _ in range(2):
+            self.assertRaises(
+                requests.exceptions.ConnectionError,
+                client.get,
+                "/api/v1/namespaces",
+            )
+        self.assertRaises(
+            kubernetes.CircuitOpen, client.get, "/api/v1/namespaces"
+        )
+
+        self.assertEqual(2, mock_request.call_count)
+
+    @mock.patch.object(time, "monotonic")
+    @mock.patch.object(requests.Session, "request")
+    def test_request_probe(self, mock_request, mock_monotonic):
+        self.config(api_circuit_failure_threshold=1, group="capi_helm")
+        mock_monotonic.return_value = self.now
+        unavailable = mock.MagicMock(status_code=503)
+        ready = mock.MagicMock(status_code=200)
+        ok = mock.MagicMock(status_code=200)
+        mock_request.side_effect = [unavailable, ready, ok]
+        client = kubernetes.Client(TEST_KUBECONFIG)
+
+        self.assertIs(unavailable, client.get("/api/v1/namespaces"))
+        mock_monotonic.return_value += 30
+        self.assertIs(ok, client.get("/api/v1/namespaces"))
+
+        self.assertEqual(
+            "https://test:6443/readyz", mock_request.call_args_list[1][0][1]
+        )
+        self.assertEqual(
+            client.circuit_breaker.CLOSED, client.circuit_breaker.state
+        )
+
+
+class TestSingleFlight(base.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.config(api_discovery_ttl=0, group="capi_helm")
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def _wait_for_collapsed(self, count):
+        for _ in range(500):
+            if metrics.get("api_requests_collapsed") >= count:
+                return
+            time.sleep(0.01)
+        self.fail("Calls were not collapsed")
+
+    def _run_concurrently(self, func, count):
+        results = []
+
+        def run():
+            try:
+                results.append(func())
+            except Exception as e:
+                results.append(e)
+
+        threads = [threading.Thread(target=run) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads, results
+
+    def test_do(self):
+        singleflight = kubernetes.SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def call():
+            calls.append(1)
+            release.wait()
+            return {"a": 1}
+
+        threads, results = self._run_concurrently(
+            lambda: singleflight.do(("key",), call), 3
+        )
+        self._wait_for_collapsed(2)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(1, len(calls))
+        self.assertEqual([{"a": 1}] * 3, results)
+        self.assertIs(results[0], results[1])
+        # Later calls are made again
+        self.assertEqual({"a": 1}, singleflight.do(("key",), call))
+        self.assertEqual(2, len(calls))
+
+    def test_do_error(self):
+        singleflight = kubernetes.SingleFlight()
+        release = threading.Event()
+
+        def call():
+            release.wait()
+            raise ValueError("failed")
+
+        threads, results = self._run_concurrently(
+            lambda: singleflight.do(("key",), call), 2
+        )
+        self._wait_for_collapsed(1)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(2, len(results))
+        for result in results:
+            self.assertIsInstance(result, ValueError)
+
+    @mock.patch.object(requests.Session, "request")
+    def test_fetch_collapsed(self, mock_request):
+        release = threading.Event()
+        response = mock.MagicMock()
+        response.status_code = 200
+        response.json.return_value = {"kind": "Cluster"}
+
+        def request(*args, **kwargs):
+            release.wait()
+            return response
+
+        mock_request.side_effect = request
+        client = kubernetes.Client(TEST_KUBECONFIG)
+
+        threads, results = self._run_concurrently(
+            lambda: client.get_capi_cluster("name", "ns1"), 3
+        )
+        self._wait_for_collapsed(2)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([{"kind": "Cluster"}] * 3, results)
+        mock_request.assert_called_once()
+
+    @mock.patch.object(requests.Session, "request")
+    def test_fetch_not_collapsed(self, mock_request):
+        self.config(api_coalesce_reads=False, group="capi_helm")
+        release = threading.Event()
+        response = mock.MagicMock()
+        response.status_code = 404
+
+        def request(*args, **kwargs):
+            release.wait()
+            return response
+
+        mock_request.side_effect = request
+        client = kubernetes.Client(TEST_KUBECONFIG)
+
+        threads, results = self._run_concurrently(
+            lambda: client.get_capi_cluster("name", "ns1"), 2
+        )
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([None, None], results)
+        self.assertEqual(2, mock_request.call_count)
+        self.assertEqual(0, metrics.get("api_requests_collapsed"))
+
+    @mock.patch.object(requests.adapters.HTTPAdapter, "send")
+    def test_write_starts_new_flight(self, mock_send):
+        response = requests.Response()
+        response.status_code = 200
+        mock_send.return_value = response
+        client = kubernetes.Client(TEST_KUBECONFIG)
+        keys = []
+        client._singleflight = mock.Mock()
+        client._singleflight.do.side_effect = lambda key, func: keys.append(
+            key
+        )
+
+        client.coalesce(("path",), mock.Mock())
+        client.get("/api/v1/namespaces")
+        client.coalesce(("path",), mock.Mock())
+        client.delete("/api/v1/namespaces/ns1")
+        client.coalesce(("path",), mock.Mock())
+
+        self.assertEqual(keys[0], keys[1])
+        self.assertNotEqual(keys[1], keys[2])
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = b"{}"
+        if self.path == "/large":
+            body = json.dumps({"items": [{"a": "b"}] * 1000}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestPoolAdapter(base.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.config(api_discovery_ttl=0, group="capi_helm")
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.kubeconfig = {
+            "current-context": "default",
+            "clusters": [
+                {
+                    "name": "default",
+                    "cluster": {
+                        "server": f"http://127.0.0.1:{server.server_port}"
+                    },
+                }
+            ],
+            "contexts": [
+                {
+                    "name": "default",
+                    "context": {"cluster": "default", "user": "default"},
+                }
+            ],
+            "users": [{"name": "default", "user": {"token": "token"}}],
+        }
+
+    def test_pool_options(self):
+        self.config(
+            api_pool_maxsize=7,
+            api_pool_block=True,
+            api_pool_idle_timeout=0,
+            group="capi_helm",
+        )
+        client = kubernetes.Client(self.kubeconfig)
+
+        for url in (TEST_SERVER, "http://test"):
+            adapter = client.get_adapter(url)
+            self.assertIsInstance(adapter, kubernetes.PoolAdapter)
+            self.assertEqual(7, adapter._pool_maxsize)
+            self.assertTrue(adapter._pool_block)
+            self.assertIsNone(adapter.idle_timeout)
+
+    def test_connections_reused(self):
+        client = kubernetes.Client(self.kubeconfig)
+
+        for _ in range(3):
+            client.get("/api")
+
+        self.assertEqual(1, metrics.get("api_pool_connections_created"))
+        self.assertEqual(2, metrics.get("api_pool_connections_reused"))
+        self.assertEqual(1, metrics.get("api_pool_peak_in_use"))
+
+    def test_response_compressed(self):
+        client = kubernetes.Client(self.kubeconfig)
+
+        data = client.get("/large").json()
+
+        self.assertEqual(1000, len(data["items"]))
+        received = metrics.get("api_response_bytes_received")
+        decoded = metrics.get("api_response_bytes_decoded")
+        self.assertEqual(len(json.dumps(data)), decoded)
+        self.assertLess(received, decoded / 10)
+
+    def test_response_not_compressed(self):
+        self.config(api_compression_verbs=["list"], group="capi_helm")
+        client = kubernetes.Client(self.kubeconfig)
+
+        response = client.get("/large")
+
+        self.assertEqual(
+            "identity", response.request.headers["Accept-Encoding"]
+        )
+        self.assertEqual(
+            len(response.content), metrics.get("api_response_bytes_received")
+        )
+        self.assertEqual(
+            len(response.content), metrics.get("api_response_bytes_decoded")
+        )
+
+    def test_encoding_headers(self):
+        self.assertEqual("gzip", kubernetes.accept_encoding("get"))
+        self.assertEqual({}, kubernetes.encoding_headers("list"))
+        self.assertEqual(
+            {"Accept-Encoding": "identity"},
+            kubernetes.encoding_headers("watch"),
+        )
+        self.config(api_compression_verbs=["list"], group="capi_helm")
+        self.assertEqual("identity", kubernetes.accept_encoding("get"))
+        self.assertEqual(
+            {"Accept-Encoding": "gzip"}, kubernetes.encoding_headers("list")
+        )
+
+    def test_response_json(self):
+        client = kubernetes.Client(self.kubeconfig)
+
+        response = client.get("/api")
+
+        self.assertIsInstance(response, kubernetes.Response)
+        self.assertEqual({}, response.json())
+
+    @mock.patch.object(time, "monotonic")
+    def test_idle_connection_closed(self, mock_monotonic):
+        mock_monotonic.return_value = 100.0
+        self.config(api_pool_idle_timeout=60, group="capi_helm")
+        client = kubernetes.Client(self.kubeconfig)
+
+        client.get("/api")
+        mock_monotonic.return_value += 61
+        client.get("/api")
+
+        self.assertEqual(1, metrics.get("api_pool_connections_idle_closed"))
+        self.assertEqual(0, metrics.get("api_pool_connections_reused"))
+
+    def test_full_pool_discards(self):
+        self.config(api_pool_maxsize=1, group="capi_helm")
+        client = kubernetes.Client(self.kubeconfig)
+
+        responses = [client.get("/api", stream=True) for _ in range(2)]
+        for response in responses:
+            response.content
+
+        self.assertEqual(2, metrics.get("api_pool_peak_in_use"))
+        self.assertEqual(1, metrics.get("api_pool_connections_discarded"))
@@ -0,0 +1,298 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+from unittest import mock
+
+import requests
+
+from magnum_capi_helm import helm
+from magnum_capi_helm import kubernetes
+from magnum_capi_helm import release
+from magnum_capi_helm.tests import base
+
+
+CAPI_VERSION = "cluster.x-k8s.io/v1beta1"
+
+
+class TestApplyClient(base.TestCase):
+    def setUp(self):
+        super(TestApplyClient, self).setUp()
+        self.helm_client = mock.MagicMock(spec=helm.Client)
+        self.k8s_client = mock.MagicMock(spec=kubernetes.Client)
+        self.client = release.ApplyClient(self.helm_client, self.k8s_client)
+        self.rendered = [
+            base.k8s_object(
+                "c1", kind="Cluster", api_version=CAPI_VERSION, labels={}
+            ),
+            base.k8s_object(
+                "c1-md1",
+                kind="MachineDeployment",
+                api_version=CAPI_VERSION,
+                labels={},
+            ),
+        ]
+        self.helm_client.template.return_value = self.rendered
+
+    def test_install_or_upgrade(self):
+        self.k8s_client.get_secret_value.return_value = json.dumps(
+            [
+                ["cluster.x-k8s.io/v1beta1", "MachineDeployment"],
+                ["infrastructure.cluster.x-k8s.io/v1beta1", "OldKind"],
+            ]
+        )
+        resources = {}
+
+        def get_resource(api_version, kind, namespaced):
+            resource = resources.setdefault(kind, mock.MagicMock())
+            resource.namespaced = namespaced
+            resource.fetch_all_by_label.return_value = [
+                base.k8s_object("c1-md1", kind=kind, api_version=CAPI_VERSION),
+                base.k8s_object("c1-md2", kind=kind, api_version=CAPI_VERSION),
+            ]
+            return resource
+
+        self.k8s_client.get_resource.side_effect = get_resource
+
+        objects = self.client.install_or_upgrade(
+            "c1", "chart", {"a": 1}, namespace="ns1", repo="r", version="1"
+        )
+
+        self.helm_client.template.assert_called_once_with(
+            "c1", "chart", {"a": 1}, namespace="ns1", repo="r", version="1"
+        )
+        # The objects are labelled and namespaced, without modifying
+        # the cached render
+        self.assertEqual(
+            {
+                "name": "c1",
+                "namespace": "ns1",
+                "labels": {release.RELEASE_LABEL: "c1"},
+            },
+            objects[0]["metadata"],
+        )
+        self.assertEqual({}, self.rendered[0]["metadata"]["labels"])
+        self.k8s_client.apply_object.assert_has_calls(
+            [mock.call(objects[0]), mock.call(objects[1])], any_order=True
+        )
+
+        # Objects no longer rendered are pruned, including for old kinds
+        resources[
+            "MachineDeployment"
+        ].fetch_all_by_label.assert_called_once_with(
+            {release.RELEASE_LABEL: "c1"}, "ns1"
+        )
+        resources["MachineDeployment"].delete.assert_called_once_with(
+            "c1-md2", "ns1"
+        )
+        self.assertEqual(2, resources["OldKind"].delete.call_count)
+        resources["Cluster"].delete.assert_has_calls(
+            [mock.call("c1-md1", "ns1"), mock.call("c1-md2", "ns1")]
+        )
+
+        # The inventory includes the old kinds until pruned
+        self.assertEqual(
+            [
+                mock.call(
+                    "c1-inventory",
+                    {
+                        "metadata": {"labels": {}},
+                        "stringData": {
+                            "kinds": json.dumps(
+                                [
+                                    ["cluster.x-k8s.io/v1beta1", "Cluster"],
+                                    [
+                                        "cluster.x-k8s.io/v1beta1",
+                                        "MachineDeployment",
+                                    ],
+                                    [
+                                        "infrastructure.cluster.x-k8s.io/"
+                                        "v1beta1",
+                                        "OldKind",
+                                    ],
+                                ]
+                            )
+                        },
+                    },
+                    "ns1",
+                ),
+                mock.call(
+                    "c1-inventory",
+                    {
+                        "metadata": {"labels": {}},
+                        "stringData": {
+                            "kinds": json.dumps(
+                                [
+                                    ["cluster.x-k8s.io/v1beta1", "Cluster"],
+                                    [
+                                        "cluster.x-k8s.io/v1beta1",
+                                        "MachineDeployment",
+                                    ],
+                                ]
+                            )
+                        },
+                    },
+                    "ns1",
+                ),
+            ],
+            self.k8s_client.apply_secret.call_args_list,
+        )
+
+    def test_install_or_upgrade_cluster_scoped(self):
+        self.k8s_client.get_secret_value.return_value = None
+        self.k8s_client.discovery = mock.MagicMock()
+        self.k8s_client.discovery.is_namespaced.side_effect = (
+            lambda api_version, kind: kind != "ClusterRole"
+        )
+        role = base.k8s_object(
+            "c1-role",
+            "ns1",
+            kind="ClusterRole",
+            api_version="rbac.authorization.k8s.io/v1",
+        )
+        self.rendered.append(role)
+        client = release.ApplyClient(
+            self.helm_client,
+            self.k8s_client,
+            labels={"magnum.openstack.org/cluster-uuid": "uuid"},
+        )
+
+        objects = client.install_or_upgrade("c1", "chart", namespace="ns1")
+
+        # Only namespaced objects are given the release namespace
+        self.assertEqual("ns1", objects[0]["metadata"]["namespace"])
+        self.assertNotIn("namespace", objects[2]["metadata"])
+        self.k8s_client.get_resource.assert_any_call(
+            "rbac.authorization.k8s.io/v1", "ClusterRole", False
+        )
+        # The inventory is labelled for the cluster
+        self.assertEqual(
+            {"labels": {"magnum.openstack.org/cluster-uuid": "uuid"}},
+            self.k8s_client.apply_secret.call_args[0][1]["metadata"],
+        )
+
+    def test_install_or_upgrade_keeps_resources(self):
+        self.k8s_client.get_secret_value.return_value = None
+        self.helm_client.template.return_value = [
+            base.k8s_object("c1", kind="Cluster", api_version=CAPI_VERSION)
+        ]
+        kept = base.k8s_object(
+            "c1-kept", kind="Cluster", api_version=CAPI_VERSION
+        )
+        kept["metadata"]["annotations"] = {
+            release.RESOURCE_POLICY_ANNOTATION: "keep"
+        }
+        resource = self.k8s_client.get_resource.return_value
+        resource.namespaced = True
+        resource.fetch_all_by_label.return_value = [
+            base.k8s_object("c1", kind="Cluster", api_version=CAPI_VERSION),
+            base.k8s_object(
+                "c1-old", kind="Cluster", api_version=CAPI_VERSION
+            ),
+            kept,
+        ]
+
+        self.client.install_or_upgrade("c1", "chart", namespace="ns1")
+
+        # Objects helm would keep are not pruned
+        resource.delete.assert_called_once_with("c1-old", "ns1")
+
+    def test_install_or_upgrade_apply_error(self):
+        self.k8s_client.get_secret_value.return_value = None
+        self.k8s_client.apply_object.side_effect = [
+            None,
+            requests.HTTPError("bad"),
+        ]
+
+        self.assertRaises(
+            requests.HTTPError,
+            self.client.install_or_upgrade,
+            "c1",
+            "chart",
+            {},
+            namespace="ns1",
+        )
+
+        self.k8s_client.get_resource.assert_not_called()
+
+    def test_uninstall_release(self):
+        self.k8s_client.get_secret_value.return_value = json.dumps(
+            [["cluster.x-k8s.io/v1beta1", "Cluster"]]
+        )
+        self.k8s_client.get_resource.return_value.namespaced = True
+
+        self.client.uninstall_release("c1", "ns1")
+
+        self.k8s_client.get_resource.assert_has_calls(
+            [
+                mock.call("cluster.x-k8s.io/v1beta1", "Cluster", True),
+                mock.call().delete_all_by_label(
+                    release.RELEASE_LABEL, "c1", "ns1"
+                ),
+                mock.call("v1", "Secret"),
+                mock.call().delete("c1-inventory", "ns1"),
+            ]
+        )
+        self.helm_client.uninstall_release.assert_not_called()
+
+    def test_uninstall_release_installed_by_helm(self):
+        # Installed before the deploy mode was changed to apply
+        self.k8s_client.get_secret_value.return_value = None
+
+        self.client.uninstall_release("c1", "ns1")
+
+        self.helm_client.uninstall_release.assert_called_once_with(
+            "c1", namespace="ns1"
+        )
+        self.k8s_client.get_resource.assert_not_called()
+
+
+class TestHelmClient(base.TestCase):
+    def setUp(self):
+        super(TestHelmClient, self).setUp()
+        self.helm_client = mock.MagicMock(spec=helm.Client)
+        self.k8s_client = mock.MagicMock(spec=kubernetes.Client)
+        self.client = release.HelmClient(self.helm_client, self.k8s_client)
+
+    def test_install_or_upgrade(self):
+        result = self.client.install_or_upgrade(
+            "c1", "chart", {"a": 1}, namespace="ns1", repo="r", version="1"
+        )
+
+        self.assertIs(self.helm_client.install_or_upgrade.return_value, result)
+        self.helm_client.install_or_upgrade.assert_called_once_with(
+            "c1", "chart", {"a": 1}, namespace="ns1", repo="r", version="1"
+        )
+
+    def test_uninstall_release(self):
+        self.k8s_client.get_secret_value.return_value = None
+
+        self.client.uninstall_release("c1", "ns1")
+
+        self.helm_client.uninstall_release.assert_called_once_with(
+            "c1", namespace="ns1"
+        )
+
+    def test_uninstall_release_applied(self):
+        # Applied before the deploy mode was changed to helm
+        self.k8s_client.get_secret_value.return_value = json.dumps(
+            [["cluster.x-k8s.io/v1beta1", "Cluster"]]
+        )
+        resource = self.k8s_client.get_resource.return_value
+        resource.namespaced = True
+
+        self.client.uninstall_release("c1", "ns1")
+
+        self.helm_client.uninstall_release.assert_not_called()
+        resource.delete_all_by_label.assert_called_once_with(
+            release.RELEASE_LABEL, "c1", "ns1"
+        )
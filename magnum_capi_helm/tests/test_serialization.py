@@ -0,0 +1,67 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import io
+import json
+from unittest import mock
+
+import yaml
+
+from magnum_capi_helm import serialization
+from magnum_capi_helm.tests import base
+
+DATA = {"metadata": {"name": "c1", "labels": {"a": "b"}}, "items": [1, 2.5]}
+
+
+class TestSerialization(base.TestCase):
+    def _test_json(self):
+        encoded = serialization.json_dumpb(DATA)
+        self.assertIsInstance(encoded, bytes)
+        self.assertEqual(DATA, json.loads(encoded))
+        self.assertEqual(encoded.decode(), serialization.json_dumps(DATA))
+        self.assertEqual(DATA, serialization.json_loads(encoded))
+        self.assertEqual(DATA, serialization.json_loads(encoded.decode()))
+        self.assertRaises(ValueError, serialization.json_loads, b"{")
+
+    def test_json(self):
+        self._test_json()
+
+    def test_json_fallback(self):
+        with mock.patch.object(serialization, "orjson", None):
+            self._test_json()
+
+    def test_json_wide_integer(self):
+        # Not supported by orjson, so encoded by the standard library
+        self.assertEqual(
+            b'{"a":%d}' % 2**70, serialization.json_dumpb({"a": 2**70})
+        )
+
+    def test_json_non_string_keys(self):
+        self.assertEqual(
+            {"1": True}, json.loads(serialization.json_dumpb({1: True}))
+        )
+
+    def test_yaml(self):
+        encoded = serialization.yaml_dump(DATA)
+        self.assertEqual(yaml.safe_dump(DATA), encoded)
+        self.assertEqual(DATA, serialization.yaml_load(encoded))
+        self.assertEqual(DATA, serialization.yaml_load(io.StringIO(encoded)))
+        self.assertEqual(
+            [DATA, None, DATA],
+            list(serialization.yaml_load_all(f"{encoded}---\n---\n{encoded}")),
+        )
+        # Only the safe subset of YAML is loaded
+        self.assertRaises(
+            yaml.YAMLError,
+            serialization.yaml_load,
+            "!!python/object/apply:os.system ['true']",
+        )
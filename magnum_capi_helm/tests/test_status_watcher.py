@@ -0,0 +1,213 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from unittest import mock
+
+from magnum.common import exception
+from magnum import objects
+from magnum.objects import fields
+from magnum.service import periodic
+from oslo_service import loopingcall
+
+from magnum_capi_helm import kubernetes
+from magnum_capi_helm import status_watcher
+from magnum_capi_helm.tests import base
+
+
+NAMESPACE = "magnum-project1"
+
+
+class TestStatusWatcher(base.TestCase):
+    def setUp(self):
+        super(TestStatusWatcher, self).setUp()
+        self.k8s_client = mock.MagicMock(spec=kubernetes.Client)
+        self.watcher = status_watcher.StatusWatcher(self.k8s_client)
+        self.cluster = mock.Mock(
+            uuid="uuid1", status=fields.ClusterStatus.CREATE_IN_PROGRESS
+        )
+        self.cluster.nodegroups = [
+            mock.Mock(status=fields.ClusterStatus.CREATE_IN_PROGRESS)
+        ]
+
+    def test_cluster_key(self):
+        self.assertEqual(
+            ("uuid", "uuid1"),
+            status_watcher.cluster_key(
+                base.k8s_object(
+                    "s1",
+                    NAMESPACE,
+                    kind="Secret",
+                    labels={"magnum.openstack.org/cluster-uuid": "uuid1"},
+                )
+            ),
+        )
+        self.assertEqual(
+            ("stack_id", "cluster1"),
+            status_watcher.cluster_key(
+                base.k8s_object(
+                    "cluster1-md",
+                    NAMESPACE,
+                    kind="MachineDeployment",
+                    labels={"capi.stackhpc.com/cluster": "cluster1"},
+                )
+            ),
+        )
+        self.assertEqual(
+            ("stack_id", "cluster1"),
+            status_watcher.cluster_key(
+                base.k8s_object(
+                    "cluster1-cni",
+                    NAMESPACE,
+                    kind="HelmRelease",
+                    labels={"addons.stackhpc.com/cluster": "cluster1"},
+                )
+            ),
+        )
+        self.assertEqual(
+            ("stack_id", "cluster1"),
+            status_watcher.cluster_key(
+                base.k8s_object("cluster1", NAMESPACE, kind="Cluster")
+            ),
+        )
+        self.assertIsNone(
+            status_watcher.cluster_key(
+                base.k8s_object("md", NAMESPACE, kind="MachineDeployment")
+            )
+        )
+
+    def test_start(self):
+        self.addCleanup(self.watcher.stop)
+
+        self.watcher.start()
+
+        self.assertEqual(
+            [
+                mock.call(resource_cls, handler=self.watcher._on_event)
+                for resource_cls in status_watcher.WATCHED_RESOURCES
+            ],
+            self.k8s_client.get_informer.call_args_list,
+        )
+
+    def test_on_event(self):
+        self.watcher._on_event(
+            "ADDED", base.k8s_object("cluster1", NAMESPACE, kind="Cluster")
+        )
+        self.watcher._on_event(
+            "MODIFIED", base.k8s_object("cluster2", "other", kind="Cluster")
+        )
+        self.watcher._on_event(
+            "DELETED", base.k8s_object("cluster3", "magnum", kind="Cluster")
+        )
+
+        self.assertEqual({("stack_id", "cluster1")}, self.watcher._pending)
+
+    def test_should_poll(self):
+        self.cluster.status = fields.ClusterStatus.CREATE_COMPLETE
+        self.cluster.nodegroups[0].status = (
+            fields.ClusterStatus.CREATE_COMPLETE
+        )
+        informer = mock.Mock()
+        informer.store.synced = False
+        self.watcher._informers = [informer]
+
+        # Not synced, so always poll
+        self.assertTrue(self.watcher.should_poll(self.cluster, "status"))
+        self.assertTrue(self.watcher.should_poll(self.cluster, "status"))
+
+        informer.store.synced = True
+        self.assertFalse(self.watcher.should_poll(self.cluster, "status"))
+        self.assertTrue(self.watcher.should_poll(self.cluster, "health"))
+
+        self.config(status_poll_interval=0, group="capi_helm")
+        self.assertTrue(self.watcher.should_poll(self.cluster, "status"))
+
+    def test_should_poll_in_progress(self):
+        informer = mock.Mock()
+        informer.store.synced = True
+        self.watcher._informers = [informer]
+        self.assertTrue(self.watcher.should_poll(self.cluster, "status"))
+
+        # Checked recently, but still in progress
+        self.assertTrue(self.watcher.should_poll(self.cluster, "status"))
+
+    def test_should_poll_nodegroup_deleting(self):
+        # No watched object changes while the Machines are deleted
+        informer = mock.Mock()
+        informer.store.synced = True
+        self.watcher._informers = [informer]
+        self.cluster.status = fields.ClusterStatus.UPDATE_COMPLETE
+        self.cluster.nodegroups = [
+            mock.Mock(status=fields.ClusterStatus.UPDATE_COMPLETE),
+            mock.Mock(status=fields.ClusterStatus.DELETE_IN_PROGRESS),
+        ]
+        self.assertTrue(self.watcher.should_poll(self.cluster, "health"))
+
+        self.assertTrue(self.watcher.should_poll(self.cluster, "health"))
+
+        self.cluster.nodegroups.pop()
+        self.assertFalse(self.watcher.should_poll(self.cluster, "health"))
+
+    @mock.patch.object(objects.Cluster, "list")
+    @mock.patch.object(objects.Cluster, "get_by_uuid")
+    def test_find_clusters(self, mock_get, mock_list):
+        context = mock.Mock()
+        mock_get.side_effect = exception.ClusterNotFound(cluster="uuid1")
+
+        self.assertEqual(
+            [], self.watcher._find_clusters(context, ("uuid", "uuid1"))
+        )
+        self.assertEqual(
+            mock_list.return_value,
+            self.watcher._find_clusters(context, ("stack_id", "cluster1")),
+        )
+        mock_list.assert_called_once_with(
+            context, filters={"stack_id": "cluster1"}
+        )
+
+    @mock.patch.object(periodic, "ClusterHealthUpdateJob")
+    @mock.patch.object(periodic, "ClusterUpdateJob")
+    def test_update(self, mock_update_job, mock_health_job):
+        context = mock.Mock()
+        mock_update_job.return_value.update_status.side_effect = (
+            loopingcall.LoopingCallDone
+        )
+
+        self.watcher._update(context, self.cluster)
+
+        mock_update_job.assert_called_once_with(context, self.cluster)
+        mock_health_job.assert_called_once_with(context, self.cluster)
+        self.assertEqual(
+            {("status", "uuid1"), ("health", "uuid1")},
+            set(self.watcher._last_checked),
+        )
+
+    @mock.patch.object(periodic, "ClusterHealthUpdateJob")
+    @mock.patch.object(periodic, "ClusterUpdateJob")
+    def test_update_stable_cluster(self, mock_update_job, mock_health_job):
+        self.cluster.status = fields.ClusterStatus.CREATE_COMPLETE
+
+        self.watcher._update(mock.Mock(), self.cluster)
+
+        mock_update_job.assert_not_called()
+        mock_health_job.return_value.update_health_status.assert_called_once()
+
+    @mock.patch.object(status_watcher, "_watcher", None)
+    @mock.patch.object(status_watcher.StatusWatcher, "start")
+    @mock.patch.object(kubernetes.Client, "shared")
+    def test_get_watcher(self, mock_shared, mock_start):
+        self.assertIsNone(status_watcher.get_watcher())
+
+        self.config(status_watch_enabled=True, group="capi_helm")
+        watcher = status_watcher.get_watcher()
+
+        self.assertIs(watcher, status_watcher.get_watcher())
+        mock_start.assert_called_once_with()
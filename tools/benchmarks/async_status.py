@@ -0,0 +1,186 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Compare checking many clusters using threads and using asyncio.
+
+Runs a fake management cluster API server that answers each request after
+a fixed latency, then fetches the Cluster, OpenStackCluster, control plane
+and machine deployment of every cluster, as the health monitor does. This
+is done with a pool of threads sharing the blocking client, and with the
+async client on one event loop.
+
+Usage: python tools/benchmarks/async_status.py [--clusters N]
+"""
+
+import argparse
+import asyncio
+from concurrent import futures
+import json
+import logging
+import threading
+import time
+
+from magnum_capi_helm import async_kubernetes
+from magnum_capi_helm import conf
+from magnum_capi_helm import kubernetes
+
+OBJECT = json.dumps(
+    {
+        "metadata": {"name": "cluster", "namespace": "magnum-project"},
+        "status": {"conditions": [{"type": "Ready", "status": "True"}]},
+    }
+).encode()
+
+
+def _start_server(latency):
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+    server = {}
+
+    async def serve(reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                while (await reader.readline()) != b"\r\n":
+                    pass
+                await asyncio.sleep(latency)
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    b"Content-Length: %d\r\n\r\n%s" % (len(OBJECT), OBJECT)
+                )
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def start():
+        server["server"] = await asyncio.start_server(
+            serve, "127.0.0.1", 0, backlog=4096
+        )
+        server["port"] = server["server"].sockets[0].getsockname()[1]
+        started.set()
+
+    thread = threading.Thread(
+        target=lambda: (loop.run_until_complete(start()), loop.run_forever()),
+        daemon=True,
+    )
+    thread.start()
+    started.wait()
+    return server["port"]
+
+
+def _client(port):
+    return kubernetes.Client(
+        {
+            "current-context": "default",
+            "clusters": [
+                {
+                    "name": "default",
+                    "cluster": {"server": f"http://127.0.0.1:{port}"},
+                }
+            ],
+            "contexts": [
+                {
+                    "name": "default",
+                    "context": {"cluster": "default", "user": "default"},
+                }
+            ],
+            "users": [{"name": "default", "user": {"token": "token"}}],
+        }
+    )
+
+
+def _names(cluster):
+    return f"cluster-{cluster}", "magnum-project"
+
+
+def threaded(client, clusters, workers):
+    def check(cluster):
+        name, namespace = _names(cluster)
+        return [
+            client.get_capi_cluster(name, namespace),
+            client.get_capi_openstackcluster(name, namespace),
+            client.get_k8s_control_plane(f"{name}-control-plane", namespace),
+            client.get_machine_deployment(f"{name}-default", namespace),
+        ]
+
+    with futures.ThreadPoolExecutor(workers) as executor:
+        return list(executor.map(check, range(clusters)))
+
+
+async def concurrent(client, clusters, connections):
+    async def check(async_client, cluster):
+        name, namespace = _names(cluster)
+        return await asyncio.gather(
+            async_client.get_capi_cluster(name, namespace),
+            async_client.get_capi_openstackcluster(name, namespace),
+            async_client.get_k8s_control_plane(
+                f"{name}-control-plane", namespace
+            ),
+            async_client.get_machine_deployment(f"{name}-default", namespace),
+        )
+
+    async with async_kubernetes.AsyncClient(
+        client, max_connections=connections
+    ) as async_client:
+        return await asyncio.gather(
+            *(check(async_client, cluster) for cluster in range(clusters))
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clusters", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.01)
+    parser.add_argument("--workers", type=int, default=50)
+    args = parser.parse_args()
+
+    conf.CONF([], project="magnum")
+    conf.CONF.set_override("api_discovery_ttl", 0, group="capi_helm")
+    conf.CONF.set_override("api_read_qps", 0, group="capi_helm")
+    # The urllib3 pool warns each time a thread finds it full
+    logging.getLogger("urllib3").setLevel(logging.ERROR)
+    port = _start_server(args.latency)
+    client = _client(port)
+    requests = args.clusters * 4
+
+    print(
+        f"{args.clusters} clusters, {requests} requests, "
+        f"{args.latency * 1000:.0f} ms latency"
+    )
+    for name, run in [
+        (
+            f"{args.workers} threads",
+            lambda: threaded(client, args.clusters, args.workers),
+        ),
+        (
+            f"asyncio, {args.workers} connections",
+            lambda: asyncio.run(
+                concurrent(client, args.clusters, args.workers)
+            ),
+        ),
+    ]:
+        start = time.perf_counter()
+        results = run()
+        elapsed = time.perf_counter() - start
+        assert len(results) == args.clusters
+        print(
+            f"{name:>26}: {elapsed:6.2f} s, "
+            f"{requests / elapsed:7.0f} requests/s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Compare per-lookup label resolution with resolving labels once.
+
+Builds the node group values for a cluster with autoscaling enabled, as
+done for every helm upgrade, which looks up several labels for each node
+group.
+
+Usage: python tools/benchmarks/cluster_labels.py [--nodegroups N]
+"""
+
+import argparse
+import timeit
+import types
+
+from magnum_capi_helm import conf
+from magnum_capi_helm import driver
+
+
+def _make_cluster(nodegroups):
+    template_labels = {
+        opt.name: str(opt.default)
+        for opt in conf.capi_helm_cluster_labels_opts
+        if opt.default is not None
+    }
+    template_labels.update(
+        auto_scaling_enabled="true",
+        min_node_count="1",
+        max_node_count="10",
+        kube_tag="v1.30.2",
+    )
+    nodegroups = [
+        types.SimpleNamespace(
+            id=i,
+            name=f"group-{i}",
+            role="worker",
+            # As created by Magnum, the first worker group is the default
+            is_default=i == 0,
+            flavor_id="m1.large",
+            node_count=3,
+            min_node_count=None,
+            max_node_count=None,
+        )
+        for i in range(nodegroups)
+    ]
+    return types.SimpleNamespace(
+        cluster_template=types.SimpleNamespace(labels=template_labels),
+        labels={"monitoring_enabled": "true", "boot_volume_size": "40"},
+        nodegroups=nodegroups,
+        default_ng_worker=nodegroups[0],
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--nodegroups", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    conf.CONF([], project="magnum")
+    capi_driver = driver.Driver()
+    cluster = _make_cluster(args.nodegroups)
+
+    def per_lookup():
+        capi_driver._process_node_groups(cluster, cluster.nodegroups)
+
+    def resolved_once():
+        with capi_driver._use_cluster_labels(driver.ClusterLabels(cluster)):
+            capi_driver._process_node_groups(cluster, cluster.nodegroups)
+
+    for name, func in [("per lookup", per_lookup), ("once", resolved_once)]:
+        elapsed = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        print(
+            f"{name:>10}: {elapsed * 1000:8.2f} ms for "
+            f"{args.nodegroups} node groups"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Compare listing Machines with and without gzip compression.
+
+Runs a local HTTP server returning a list of synthetic Machines, with the
+managedFields and conditions kept by the API server, gzip compressed when
+the client asks for it as the API server does. The list is fetched
+through the list decoder with compression requested and not, recording
+the bytes received and decoded and the CPU time used, which includes the
+server writing the precompressed response. The time to transfer the
+bytes received over a link of the given bandwidth is estimated, as for a
+management cluster in another region.
+
+Usage: python tools/benchmarks/compression.py [--machines N] [--mbps N]
+"""
+
+import argparse
+import gzip
+import http.server
+import json
+import random
+import threading
+import time
+
+from magnum_capi_helm import conf
+from magnum_capi_helm import kubernetes
+from magnum_capi_helm import metrics
+
+
+def _machine(idx):
+    name = f"cluster-md-0-{idx:06d}"
+    # Unique IDs, which compress poorly
+    uid = f"{random.getrandbits(128):032x}"
+    return {
+        "apiVersion": "cluster.x-k8s.io/v1beta1",
+        "kind": "Machine",
+        "metadata": {
+            "name": name,
+            "namespace": "magnum-project",
+            "uid": uid,
+            "resourceVersion": str(100000 + idx),
+            "labels": {
+                "capi.stackhpc.com/cluster": "cluster",
+                "capi.stackhpc.com/component": "worker",
+                "capi.stackhpc.com/node-group": "md-0",
+            },
+            "managedFields": [
+                {
+                    "apiVersion": "cluster.x-k8s.io/v1beta1",
+                    "fieldsType": "FieldsV1",
+                    "fieldsV1": {
+                        f"f:{field}": {"f:conditions": {}, "f:phase": {}}
+                        for field in ("status", "spec", "metadata")
+                    },
+                    "manager": manager,
+                    "operation": "Update",
+                    "time": "2024-06-01T12:05:00Z",
+                }
+                for manager in ("manager", "capi-controller-manager")
+            ],
+        },
+        "spec": {
+            "clusterName": "cluster",
+            "version": "v1.30.2",
+            "providerID": f"openstack:///{random.getrandbits(128):032x}",
+            "infrastructureRef": {"kind": "OpenStackMachine", "name": name},
+        },
+        "status": {
+            "phase": "Running",
+            "conditions": [
+                {
+                    "type": t,
+                    "status": "True",
+                    "lastTransitionTime": "2024-06-01T12:05:00Z",
+                    "message": "",
+                }
+                for t in (
+                    "Ready",
+                    "BootstrapReady",
+                    "InfrastructureReady",
+                    "NodeHealthy",
+                    "HealthCheckSucceeded",
+                )
+            ],
+        },
+    }
+
+
+def _start_server(body):
+    compressed = gzip.compress(body, compresslevel=6)
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            content = body
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            if "gzip" in self.headers.get("Accept-Encoding", ""):
+                content = compressed
+                self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_port
+
+
+def _client(port):
+    return kubernetes.Client(
+        {
+            "current-context": "default",
+            "clusters": [
+                {
+                    "name": "default",
+                    "cluster": {"server": f"http://127.0.0.1:{port}"},
+                }
+            ],
+            "contexts": [
+                {
+                    "name": "default",
+                    "context": {"cluster": "default", "user": "default"},
+                }
+            ],
+            "users": [{"name": "default", "user": {"token": "token"}}],
+        }
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--machines", type=int, default=2000)
+    parser.add_argument("--mbps", type=float, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    conf.CONF([], project="magnum")
+    conf.CONF.set_override("api_discovery_ttl", 0, group="capi_helm")
+    conf.CONF.set_override("api_read_qps", 0, group="capi_helm")
+    conf.CONF.set_override("list_page_size", 0, group="capi_helm")
+    body = json.dumps(
+        {
+            "kind": "MachineList",
+            "metadata": {"resourceVersion": "1"},
+            "items": [_machine(idx) for idx in range(args.machines)],
+        }
+    ).encode()
+    port = _start_server(body)
+
+    print(f"{args.machines} machines, {args.mbps:.0f} Mbit/s link")
+    for name, verbs in [("identity", ["get"]), ("gzip", ["get", "list"])]:
+        conf.CONF.set_override(
+            "api_compression_verbs", verbs, group="capi_helm"
+        )
+        client = _client(port)
+        metrics.reset()
+        start = time.process_time()
+        for _ in range(args.repeat):
+            items = list(kubernetes.iter_list(client, "/machines", {}))
+            assert len(items) == args.machines
+        cpu = (time.process_time() - start) / args.repeat
+        received = metrics.get("api_response_bytes_received") / args.repeat
+        decoded = metrics.get("api_response_bytes_decoded") / args.repeat
+        transfer = received * 8 / (args.mbps * 1e6)
+        print(
+            f"{name:>8}: {received / 2**20:6.2f} MiB received, "
+            f"{decoded / 2**20:6.2f} MiB decoded, "
+            f"{cpu * 1000:7.1f} ms CPU, "
+            f"{transfer * 1000:7.1f} ms transfer"
+        )
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Measure the cost of handling the output of each helm upgrade.
+
+helm is replaced by a mock returning what it prints for a cluster
+release, either the release as JSON with --output json, which includes
+the whole rendered manifest, or the summary now requested. The peak
+memory and CPU time per upgrade are measured with debug logging disabled,
+for the previous handling of the JSON output, which formatted it for a
+debug message and decoded it in full, and for helm.Client.install_or_upgrade
+parsing the summary.
+
+Usage: python tools/benchmarks/helm_upgrade.py [--manifest-kib N]
+"""
+
+import argparse
+import json
+import logging
+import time
+import tracemalloc
+from unittest import mock
+
+from magnum.common import utils
+
+from magnum_capi_helm import conf
+from magnum_capi_helm import helm
+
+SUMMARY = """Release "cluster" has been upgraded. Happy Helming!
+NAME: cluster
+LAST DEPLOYED: Mon Jun  3 12:00:00 2024
+NAMESPACE: magnum-project
+STATUS: deployed
+REVISION: 3
+TEST SUITE: None
+"""
+
+
+def _release_json(manifest_kib):
+    # Rendered objects of roughly the size of a cluster with addons
+    document = (
+        "---\n"
+        "apiVersion: v1\n"
+        "kind: ConfigMap\n"
+        "metadata:\n"
+        "  name: addon\n"
+        "data:\n"
+        "  values.yaml: |\n" + "    key: value\n" * 60
+    )
+    manifest = document * (manifest_kib * 1024 // len(document) + 1)
+    return json.dumps(
+        {
+            "name": "cluster",
+            "namespace": "magnum-project",
+            "version": 3,
+            "info": {"status": "deployed", "notes": ""},
+            "chart": {"metadata": {"name": "openstack-cluster"}},
+            "config": {"kubernetesVersion": "1.30.2"},
+            "manifest": manifest,
+        }
+    )
+
+
+def _previous():
+    def upgrade():
+        stdout, stderr = utils.execute("helm", "upgrade", "cluster")
+        # As logged with an f-string before
+        f"Ran helm {['upgrade', 'cluster']} got out:{stdout} err:{stderr}"
+        return json.loads(stdout)
+
+    return upgrade
+
+
+def _current(client):
+    def upgrade():
+        return client.install_or_upgrade(
+            "cluster",
+            "openstack-cluster",
+            {"kubernetesVersion": "1.30.2"},
+            namespace="magnum-project",
+        )
+
+    return upgrade
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--manifest-kib", type=int, default=500)
+    parser.add_argument("--upgrades", type=int, default=50)
+    args = parser.parse_args()
+
+    conf.CONF([], project="magnum")
+    logging.getLogger().setLevel(logging.INFO)
+    release_json = _release_json(args.manifest_kib)
+
+    print(
+        f"{args.upgrades} upgrades, {len(release_json) / 1024:.0f} KiB "
+        f"json output, {len(SUMMARY)} B summary"
+    )
+    client = helm.Client()
+    for name, upgrade, output in [
+        ("json output", _previous(), release_json),
+        ("summary", _current(client), SUMMARY),
+    ]:
+        with mock.patch.object(utils, "execute", return_value=(output, "")):
+            tracemalloc.start()
+            start = time.process_time()
+            for _ in range(args.upgrades):
+                upgrade()
+            elapsed = time.process_time() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        print(
+            f"{name:>12}: peak {peak / 2**20:7.2f} MiB, "
+            f"{elapsed * 1000 / args.upgrades:7.3f} ms CPU per upgrade"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Compare the peak memory of decoding a list in full and streamed.
+
+Lists a large number of synthetic Machines from a single response body,
+either decoding the whole body with json.loads, or streaming the items
+through the list decoder as the chunks arrive. The streamed case is also
+measured stopping at the first item, as done by existence checks.
+
+Usage: python tools/benchmarks/list_memory.py [--machines N]
+"""
+
+import argparse
+import io
+import json
+import time
+import tracemalloc
+
+from magnum_capi_helm import kubernetes
+
+
+def _machine(idx):
+    return {
+        "apiVersion": "cluster.x-k8s.io/v1beta1",
+        "kind": "Machine",
+        "metadata": {
+            "name": f"cluster-md-0-{idx:06d}",
+            "namespace": "magnum-project",
+            "labels": {
+                "capi.stackhpc.com/cluster": "cluster",
+                "capi.stackhpc.com/component": "worker",
+                "capi.stackhpc.com/node-group": "md-0",
+            },
+            "annotations": {"controlplane": "x" * 256},
+        },
+        "spec": {
+            "clusterName": "cluster",
+            "version": "v1.30.2",
+            "providerID": f"openstack:///{idx:032x}",
+        },
+        "status": {
+            "phase": "Running",
+            "conditions": [
+                {"type": t, "status": "True"}
+                for t in ("Ready", "BootstrapReady", "InfrastructureReady")
+            ],
+        },
+    }
+
+
+def _chunks(body):
+    # As returned by iter_content for a streamed response
+    stream = io.BytesIO(body)
+    return iter(lambda: stream.read(kubernetes.LIST_CHUNK_SIZE), b"")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--machines", type=int, default=20000)
+    args = parser.parse_args()
+
+    body = json.dumps(
+        {
+            "kind": "MachineList",
+            "metadata": {"resourceVersion": "1"},
+            "items": [_machine(idx) for idx in range(args.machines)],
+        }
+    ).encode()
+
+    def full():
+        for item in json.loads(body)["items"]:
+            pass
+
+    def streamed():
+        for item in kubernetes.ListDecoder(_chunks(body)):
+            pass
+
+    def first():
+        next(iter(kubernetes.ListDecoder(_chunks(body))))
+
+    print(f"{args.machines} machines, {len(body) / 2**20:.1f} MiB body")
+    for name, func in [
+        ("json.loads", full),
+        ("streamed", streamed),
+        ("first only", first),
+    ]:
+        tracemalloc.start()
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(
+            f"{name:>10}: peak {peak / 2**20:8.2f} MiB, "
+            f"{elapsed * 1000:8.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Compare the standard library and fast serialization backends.
+
+Decodes a list of synthetic Machines as returned by the management
+cluster, encodes a set of Helm values, loads a kubeconfig and dumps a
+clouds.yaml, each with the standard library or pure Python PyYAML and
+with the backends chosen by magnum_capi_helm.serialization. The cost of
+building an apply body with a deep copy and with the shallow copies now
+used is also measured.
+
+Usage: python tools/benchmarks/serialization.py [--machines N]
+"""
+
+import argparse
+import copy
+import json
+import time
+
+import yaml
+
+from magnum_capi_helm import kubernetes
+from magnum_capi_helm import serialization
+
+KUBECONFIG = {
+    "apiVersion": "v1",
+    "kind": "Config",
+    "current-context": "default",
+    "clusters": [
+        {
+            "name": "default",
+            "cluster": {
+                "server": "https://10.0.0.1:6443",
+                "certificate-authority-data": "Q" * 1500,
+            },
+        }
+    ],
+    "contexts": [
+        {"name": "default", "context": {"cluster": "default", "user": "u"}}
+    ],
+    "users": [
+        {
+            "name": "u",
+            "user": {
+                "client-certificate-data": "Q" * 1500,
+                "client-key-data": "Q" * 300,
+            },
+        }
+    ],
+}
+
+CLOUDS = {
+    "clouds": {
+        "openstack": {
+            "identity_api_version": 3,
+            "region_name": "RegionOne",
+            "interface": "public",
+            "verify": True,
+            "auth": {
+                "auth_url": "https://keystone.example.com:5000/v3",
+                "application_credential_id": "0" * 32,
+                "application_credential_secret": "s" * 86,
+            },
+            "auth_type": "v3applicationcredential",
+        },
+    },
+}
+
+
+def _machine(idx):
+    return {
+        "apiVersion": "cluster.x-k8s.io/v1beta1",
+        "kind": "Machine",
+        "metadata": {
+            "name": f"cluster-md-0-{idx:06d}",
+            "namespace": "magnum-project",
+            "uid": f"{idx:032x}",
+            "resourceVersion": str(100000 + idx),
+            "creationTimestamp": "2024-06-01T12:00:00Z",
+            "labels": {
+                "capi.stackhpc.com/cluster": "cluster",
+                "capi.stackhpc.com/component": "worker",
+                "capi.stackhpc.com/node-group": "md-0",
+                "cluster.x-k8s.io/cluster-name": "cluster",
+            },
+            "ownerReferences": [
+                {
+                    "apiVersion": "cluster.x-k8s.io/v1beta1",
+                    "kind": "MachineSet",
+                    "name": "cluster-md-0-abcde",
+                    "uid": "f" * 32,
+                    "controller": True,
+                }
+            ],
+        },
+        "spec": {
+            "clusterName": "cluster",
+            "version": "v1.30.2",
+            "providerID": f"openstack:///{idx:032x}",
+            "bootstrap": {
+                "configRef": {
+                    "kind": "KubeadmConfig",
+                    "name": f"cluster-md-0-{idx:06d}",
+                }
+            },
+            "infrastructureRef": {
+                "kind": "OpenStackMachine",
+                "name": f"cluster-md-0-{idx:06d}",
+            },
+        },
+        "status": {
+            "phase": "Running",
+            "nodeRef": {"kind": "Node", "name": f"node-{idx}"},
+            "addresses": [
+                {"type": "InternalIP", "address": f"10.0.{idx // 256}.1"}
+            ],
+            "conditions": [
+                {
+                    "type": t,
+                    "status": "True",
+                    "lastTransitionTime": "2024-06-01T12:05:00Z",
+                }
+                for t in (
+                    "Ready",
+                    "BootstrapReady",
+                    "InfrastructureReady",
+                    "NodeHealthy",
+                )
+            ],
+        },
+    }
+
+
+def _values(machines):
+    # Roughly the size of the values for a cluster with many node groups
+    return {
+        "kubernetesVersion": "1.30.2",
+        "nodeGroups": [
+            {"name": f"ng-{idx}", "machineCount": 3, "machineFlavor": "m1"}
+            for idx in range(machines // 100)
+        ],
+        "addons": {"monitoring": {"enabled": True, "values": _machine(0)}},
+    }
+
+
+def _timed(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--machines", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    body = json.dumps(
+        {
+            "kind": "MachineList",
+            "metadata": {"resourceVersion": "1"},
+            "items": [_machine(idx) for idx in range(args.machines)],
+        }
+    ).encode()
+    values = _values(args.machines)
+    kubeconfig = yaml.safe_dump(KUBECONFIG)
+    objects = json.loads(body)["items"]
+    resource = kubernetes.Machine(None)
+
+    def deep_apply():
+        for obj in objects:
+            body_data = copy.deepcopy(obj)
+            body_data.setdefault("metadata", {})["name"] = "name"
+
+    def shallow_apply():
+        for obj in objects:
+            resource._apply_body("name", obj, "magnum-project")
+
+    print(
+        f"{args.machines} machines, {len(body) / 2**20:.1f} MiB body, "
+        f"json backend {'orjson' if serialization.orjson else 'json'}, "
+        f"yaml loader {serialization.SafeLoader.__name__}"
+    )
+    for name, standard, fast, repeat in [
+        (
+            "decode list",
+            lambda: json.loads(body),
+            lambda: serialization.json_loads(body),
+            args.repeat,
+        ),
+        (
+            "encode values",
+            lambda: json.dumps(values),
+            lambda: serialization.json_dumps(values),
+            args.repeat * 100,
+        ),
+        (
+            "load kubeconfig",
+            lambda: yaml.safe_load(kubeconfig),
+            lambda: serialization.yaml_load(kubeconfig),
+            args.repeat * 20,
+        ),
+        (
+            "dump clouds.yaml",
+            lambda: yaml.safe_dump(CLOUDS),
+            lambda: serialization.yaml_dump(CLOUDS),
+            args.repeat * 20,
+        ),
+        ("apply bodies", deep_apply, shallow_apply, args.repeat),
+    ]:
+        before = _timed(standard, repeat)
+        after = _timed(fast, repeat)
+        print(
+            f"{name:>16}: {before * 1000:8.2f} ms -> {after * 1000:8.2f} ms "
+            f"({before / after:5.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Compare per-caller Client.load() with the shared management client.
+
+Simulates one driver or monitor instance per cluster, as the conductor
+creates during a periodic run, and reports the time taken, the memory
+allocated and the certificate tempfiles written.
+
+Usage: python tools/benchmarks/shared_client.py [--clusters N]
+"""
+
+import argparse
+import base64
+import datetime
+import os
+import tempfile
+import time
+import tracemalloc
+
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import serialization
+from cryptography import x509
+import yaml
+
+from magnum_capi_helm import conf
+from magnum_capi_helm import kubernetes
+
+
+def _certificate():
+    # A throwaway self-signed certificate and key, as the credentials are
+    # loaded into an SSLContext
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(x509.NameOID.COMMON_NAME, "bench")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), True)
+        .sign(key, hashes.SHA256())
+    )
+    return (
+        cert.public_bytes(serialization.Encoding.PEM),
+        key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        ),
+    )
+
+
+def _write_kubeconfig(directory):
+    cert, key = (base64.b64encode(pem).decode() for pem in _certificate())
+    kubeconfig = {
+        "apiVersion": "v1",
+        "kind": "Config",
+        "current-context": "default",
+        "clusters": [
+            {
+                "name": "default",
+                "cluster": {
+                    "server": "https://management:6443",
+                    "certificate-authority-data": cert,
+                },
+            }
+        ],
+        "contexts": [
+            {
+                "name": "default",
+                "context": {"cluster": "default", "user": "default"},
+            }
+        ],
+        "users": [
+            {
+                "name": "default",
+                "user": {
+                    "client-certificate-data": cert,
+                    "client-key-data": key,
+                },
+            }
+        ],
+    }
+    path = os.path.join(directory, "kubeconfig")
+    with open(path, "w") as fd:
+        yaml.safe_dump(kubeconfig, fd)
+    return path
+
+
+def _count_tempfiles():
+    return len(os.listdir(tempfile.gettempdir()))
+
+
+def _measure(name, clusters, get_client, put_client):
+    tempfiles_before = _count_tempfiles()
+    tracemalloc.start()
+    start = time.perf_counter()
+    clients = [get_client() for _ in range(clusters)]
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    tempfiles = _count_tempfiles() - tempfiles_before
+    for client in clients:
+        put_client(client)
+    print(
+        f"{name:>8}: {elapsed * 1000:9.1f} ms  "
+        f"{current / 1024:9.1f} KiB held  {peak / 1024:9.1f} KiB peak  "
+        f"{len(set(map(id, clients))):5d} sessions  "
+        f"{tempfiles:5d} tempfiles"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clusters", type=int, default=500)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        conf.CONF([], project="magnum")
+        conf.CONF.set_override(
+            "kubeconfig_file", _write_kubeconfig(directory), "capi_helm"
+        )
+        _measure(
+            "load",
+            args.clusters,
+            kubernetes.Client.load,
+            lambda client: client.close(),
+        )
+        _measure(
+            "shared",
+            args.clusters,
+            kubernetes.Client.shared,
+            lambda client: client.release(),
+        )
+
+
+if __name__ == "__main__":
+    main()